@@ -0,0 +1,193 @@
+import os
+import random
+import zlib
+
+"""
+    基准测试用的页面语料
+    结构照着链家线上的列表页 / 小区详情页仿写, 只保留解析器会用到的部分, 数据用固定的随机种子生成
+    生成一次写到 corpus 目录下, 之后每次都读同一批文件, 前后两次跑的结果才有可比性
+    也可以把从归档里导出的真实页面放进 corpus/<prefix>/ 里代替生成的页面
+"""
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+
+def _page(body, title="链家"):
+    return (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{title}</title></head>'
+            f'<body><div class="content">{body}</div></body></html>').encode("utf-8")
+
+
+def ershoufang_page(seed=0, n_items=30, total_page=100):
+    r = random.Random(seed)
+    items = []
+    for i in range(n_items):
+        house_id = f"10710{seed:03d}{i:05d}"
+        taxfree = '<span class="taxfree">满五年</span>' if r.random() < 0.5 else ''
+        id_attr = f'data-housecode="{house_id}"' if r.random() < 0.7 else f'data-lj_action_housedel_id="{house_id}"'
+        items.append(f'''<li class="clear LOGVIEWDATA LOGCLICKDATA">
+<a class="noresultRecommend img" href="https://sh.lianjia.com/ershoufang/{house_id}.html"><img src="x.jpg"></a>
+<div class="info clear"><div class="title"><a class="" href="https://sh.lianjia.com/ershoufang/{house_id}.html" target="_blank" {id_attr}>南北通透 精装 {i} 房&amp;厅</a><span class="goodhouse_tag tagBlock">必看好房</span></div>
+<div class="flood"><div class="positionInfo"><span class="positionIcon"></span><a href="#">小区{i % 7}</a>   -  <a href="#">张江</a> </div></div>
+<div class="address"><div class="houseInfo"><span class="houseIcon"></span>{r.randint(1, 4)}室{r.randint(1, 2)}厅 | {r.uniform(40, 150):.2f}平米 | 南 北 | 精装 | 中楼层(共{r.randint(6, 30)}层) | {r.randint(1990, 2020)}年建 | 板楼</div></div>
+<div class="followInfo"><span class="starIcon"></span>{r.randint(0, 99)}人关注 / {r.randint(1, 30)}天以前发布</div>
+<div class="tag"><span class="subway">近地铁</span>{taxfree}<span class="haskey">随时看房</span></div>
+<div class="priceInfo"><div class="totalPrice totalPrice2"><i> </i><span class="">{r.randint(200, 1500)}</span><i>万</i></div><div class="unitPrice" data-hid="{house_id}" data-rid="1" data-price="{r.randint(30000, 120000)}"><span>单价{r.randint(30000, 120000)}元/平</span></div></div></div>
+<script>var x = 1;</script></li>''')
+    return _page('<ul class="sellListContent" log-mod="list">' + "\n".join(items) + '</ul>'
+                 '<div class="page-box house-lst-page-box" comp-module="page" page-url="/ershoufang/pg{page}" '
+                 f'page-data=\'{{"totalPage":{total_page},"curPage":1}}\'></div>')
+
+
+def zufang_page(seed=0, n_items=30, total_page=100):
+    r = random.Random(seed)
+    items = []
+    for i in range(n_items):
+        house_id = f"SH{seed:03d}{i:07d}"
+        decoration = '<i class="content__item__tag--decoration">精装</i>' if r.random() < 0.5 else ''
+        subway = '<i class="content__item__tag--is_subway_house">近地铁</i>' if r.random() < 0.5 else ''
+        items.append(f'''<div class="content__list--item" data-group="list" data-house_code="{house_id}" data-c_type="1">
+<a class="content__list--item--aside" href="/zufang/{house_id}.html"><img alt=""></a>
+<div class="content__list--item--main">
+<p class="content__list--item--title twoline">
+<a class="twoline" target="_blank" href="/zufang/{house_id}.html">
+            {r.choice(["整租", "合租"])}·小区{i % 5} {r.randint(1, 4)}室1厅 南        </a>
+</p>
+<p class="content__list--item--des">
+<a target="_blank" href="/zufang/pudong/">浦东</a>-<a href="/zufang/zhangjiang/" target="_blank">张江</a>-<a title="小区{i % 5}" href="/zufang/c1/" target="_blank">小区{i % 5}</a>
+<i>/</i>
+{r.randint(20, 150)}㎡
+<i>/</i>南        <i>/</i>
+{r.randint(1, 4)}室1厅1卫        <span class="hide">
+<i>/</i>
+          中楼层                        （{r.randint(6, 30)}层）
+          </span>
+</p>
+<p class="content__list--item--bottom oneline">{decoration}{subway}</p>
+<span class="content__list--item-price"><em>{r.randint(2000, 20000)}</em> 元/月</span>
+</div></div>''')
+    return _page('<div class="content__list">' + "\n".join(items) + '</div>'
+                 '<div class="content__pg" data-el="page_navigation" data-url="/zufang/pg{page}" '
+                 f'data-totalpage="{total_page}" data-curpage="1"></div>')
+
+
+def xiaoqu_page(seed=0, n_items=30, total_page=100):
+    r = random.Random(seed)
+    items = []
+    for i in range(n_items):
+        community_id = f"5011{seed:03d}{i:06d}"
+        title = f"小区{seed}_{i}"
+        rent = (f'<a title="{title}租房" href="https://sh.lianjia.com/zufang/c{community_id}/">'
+                f'{r.randint(0, 60)}套正在出租</a>') if r.random() < 0.9 else ''
+        items.append(f'''<li class="clear xiaoquListItem" data-housecode="{community_id}" data-id="{community_id}">
+<a class="img" href="https://sh.lianjia.com/xiaoqu/{community_id}/"><img></a>
+<div class="info"><div class="title">
+<a href="https://sh.lianjia.com/xiaoqu/{community_id}/" target="_blank">{title}</a>
+</div>
+<div class="houseInfo"><span class="houseIcon"></span><a title="{title}网签">30天成交{r.randint(0, 9)}套</a> | {rent}</div>
+<div class="positionInfo"><span class="positionIcon"></span><a href="#" class="district" title="浦东小区">浦东</a>&nbsp;<a href="#" class="bizcircle" title="张江小区">张江</a>&nbsp;/{r.randint(1990, 2020)}年建成</div>
+<div class="tagList">
+<span>近地铁2号线</span>
+</div></div>
+<div class="xiaoquListItemRight"><div class="xiaoquListItemPrice"><div class="totalPrice"><span>{r.randint(30000, 120000)}</span>元/m2</div></div>
+<div class="xiaoquListItemSellCount"><a class="totalSellCount" href="#"><span>{r.randint(0, 99)}</span>套</a></div></div></li>''')
+    return _page('<ul class="listContent">' + "\n".join(items) + '</ul>'
+                 f'<div class="page-box house-lst-page-box" page-data=\'{{"totalPage":{total_page},"curPage":1}}\'></div>')
+
+
+def chengjiao_page(seed=0, n_items=30, total_page=100):
+    r = random.Random(seed)
+    items = []
+    for i in range(n_items):
+        house_id = f"10710{seed:03d}{i:05d}"
+        total_price = f'<span class="number">{r.randint(200, 1500)}</span>万' if r.random() < 0.8 else '暂无价格'
+        unit_price = f'<span class="number">{r.randint(30000, 120000)}</span>元/平' if r.random() < 0.8 else '暂无'
+        deal_cycle = (f'<span class="dealCycleTxt"><span>挂牌{r.randint(200, 1500)}万</span>'
+                      f'<span>成交周期{r.randint(5, 300)}天</span></span>') if r.random() < 0.8 else ''
+        items.append(f'''<li><a class="img" href="https://sh.lianjia.com/chengjiao/{house_id}.html"><img></a>
+<div class="info"><div class="title"><a href="https://sh.lianjia.com/chengjiao/{house_id}.html" target="_blank">小区{i % 9} {r.randint(1, 4)}室1厅 {r.uniform(40, 150):.2f}平米</a></div>
+<div class="address"><div class="houseInfo"><span class="houseIcon"></span>南 北 | 精装</div><div class="dealDate">2019.{r.randint(1, 12):02d}.{r.randint(1, 28):02d}</div><div class="totalPrice">{total_price}</div></div>
+<div class="flood"><div class="positionInfo"><span class="positionIcon"></span>中楼层(共6层) {r.randint(1990, 2020)}年建板楼</div><div class="unitPrice">{unit_price}</div></div>
+<div class="dealHouseInfo"><span class="dealHouseTxt"><span>满五年</span></span></div>
+<div class="dealCycleeInfo"><span class="dealCycleIcon"></span>{deal_cycle}</div></div></li>''')
+    return _page('<ul class="listContent">' + "\n".join(items) + '</ul>'
+                 f'<div class="page-box house-lst-page-box" page-data=\'{{"totalPage":{total_page},"curPage":1}}\'></div>')
+
+
+def xiaoqu_detail_page(seed=0, n_subways=6):
+    r = random.Random(seed)
+    infos = {
+        "建筑年代": f"{r.randint(1990, 2020)}年建成",
+        "建筑类型": "板楼",
+        "物业费用": f"{r.uniform(0.5, 5):.1f}元/平米/月",
+        "物业公司": "某某物业管理有限公司",
+        "开发商": "某某房地产开发有限公司",
+        "楼栋总数": f"{r.randint(5, 60)}栋",
+        "房屋总数": f"{r.randint(200, 3000)}户",
+    }
+    info_items = "".join(
+        f'<div class="xiaoquInfoItem"><span class="xiaoquInfoLabel">{k}</span>'
+        f'<span class="xiaoquInfoContent">{v}</span></div>' for k, v in infos.items())
+    around_items = []
+    for i in range(n_subways):
+        around_items.append(
+            f'<li data-index="subway_{i}"><span class="itemTitle">{r.randint(1, 18)}号线</span>'
+            f'<div class="itemInfo">站点{i}</div><span class="itemdistance">{r.randint(100, 1500)}m</span></li>')
+        around_items.append(
+            f'<li data-index="bus_{i}"><span class="itemTitle">公交{i}</span>'
+            f'<div class="itemInfo">公交站{i}</div><span class="itemdistance">{r.randint(100, 1500)}m</span></li>')
+    return _page(f'<div class="xiaoquInfo">{info_items}</div>'
+                 f'<div id="around"><ul>{"".join(around_items)}</ul></div>', title=f"小区{seed}")
+
+
+LIST_PAGE_GENERATORS = {
+    "ershoufang": ershoufang_page,
+    "zufang": zufang_page,
+    "xiaoqu": xiaoqu_page,
+    "chengjiao": chengjiao_page,
+}
+
+PAGE_GENERATORS = {
+    **LIST_PAGE_GENERATORS,
+    "xiaoqu_detail": xiaoqu_detail_page,
+}
+
+
+def build_corpus(corpus_dir=None, n_pages=50):
+    """
+        生成语料, 已经存在的文件不会覆盖
+    """
+    corpus_dir = corpus_dir or CORPUS_DIR
+    for prefix, generator in PAGE_GENERATORS.items():
+        directory = os.path.join(corpus_dir, prefix)
+        os.makedirs(directory, exist_ok=True)
+        for seed in range(n_pages):
+            path = os.path.join(directory, f"{seed:04d}.html")
+            if not os.path.exists(path):
+                with open(path, "wb") as fp:
+                    fp.write(generator(seed))
+
+
+def load_corpus(prefix, corpus_dir=None):
+    """
+        读出某一类页面的全部语料, 按文件名排序
+    """
+    directory = os.path.join(corpus_dir or CORPUS_DIR, prefix)
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".html"):
+            with open(os.path.join(directory, name), "rb") as fp:
+                pages.append(fp.read())
+    return pages
+
+
+def mock_total_page(prefix, region, filters, max_page=100):
+    """
+        模拟站点上某个过滤器组合的页数
+        区域本身和一部分一级过滤器的页数都到了上限, 需要继续往下展开, 其余的按路径的 crc32 给一个固定的页数
+    """
+    if not filters:
+        return max_page
+    key = zlib.crc32(f"{prefix}/{region}/{''.join(filters)}".encode("utf-8"))
+    if len(filters) == 1 and key % 3 == 0:
+        return max_page
+    return key % (max_page - 1) + 1
@@ -0,0 +1,332 @@
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from peewee import SqliteDatabase
+
+import db.settings as settings
+from benchmarks import fixtures
+from db.model import HouseInfoModel, PriceHistoryModel
+from lianjia.fetcher import AsyncFetcher
+from lianjia.info_crawlers import LianjiaErShouFangCrawler, LianjiaZuFangCrawler, LianjiaXiaoQuCrawler, \
+    LianjiaChengJiaoCrawler
+from lianjia.planner import FilterPlanner
+from lianjia.utils import logger
+from lianjia.writer import BatchWriter
+
+"""
+    离线基准测试, 不访问链家
+    1. 各个 parse_html (bs4 / lxml 两个后端) 在语料上的 页/秒 和 行/秒
+    2. 生成候选url (完整展开过滤器树 / FilterPlanner) 对着本地模拟站点从头跑到尾的耗时和探测次数
+    3. insert_many / BatchWriter 写 sqlite 的 行/秒
+    结果写成 json, 用 --baseline 和之前的结果比较, 吞吐下降超过 --tolerance 的项会列出来并以非 0 退出
+
+    python -m benchmarks.run --output benchmarks/results.json
+    python -m benchmarks.run --baseline baseline.json
+"""
+
+CRAWLER_CLASSES = {
+    "ershoufang": LianjiaErShouFangCrawler,
+    "zufang": LianjiaZuFangCrawler,
+    "xiaoqu": LianjiaXiaoQuCrawler,
+    "chengjiao": LianjiaChengJiaoCrawler,
+}
+
+_FILTER = re.compile(r"[a-z]+\d+")
+
+
+def _count_rows(data):
+    # 二手房和小区详情返回的是 (主表的行, 附表的行)
+    if isinstance(data, tuple):
+        data = data[0] if isinstance(data[0], list) else data[1]
+    return len(data) if data else 0
+
+
+def _timed(func, pages, repeat):
+    """
+        跑 repeat 遍取最快的一遍, 返回 (秒数, 行数)
+        第一遍之前先预热一页, 把导入和缓存的开销排除在外
+    """
+    func(pages[0])
+    best, n_rows = None, 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n_rows = sum(_count_rows(func(html)) for html in pages)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, n_rows
+
+
+def bench_parsers(corpus_dir, repeat):
+    results = {}
+    for prefix, crawler_class in CRAWLER_CLASSES.items():
+        pages = fixtures.load_corpus(prefix, corpus_dir)
+        crawler = crawler_class(settings.CITY)
+        for backend, parse in (("bs4", crawler.parse_html_bs4), ("lxml", crawler.parse_html_lxml)):
+            seconds, n_rows = _timed(lambda html: parse(html=html, default_info={"region": "pudong"}), pages, repeat)
+            results[f"{prefix}.{backend}"] = {
+                "pages": len(pages),
+                "rows": n_rows,
+                "seconds": seconds,
+                "pages_per_second": len(pages) / seconds,
+                "rows_per_second": n_rows / seconds,
+            }
+            logger.info(f"parse {prefix}.{backend}: {len(pages) / seconds:.1f} pages/s, {n_rows / seconds:.1f} rows/s")
+
+    try:
+        # 详情爬虫的模块顶层导入了 selenium
+        from lianjia.detail_crawlers import LianjiaXiaoquDetailCrawler
+    except ImportError as e:
+        logger.warning(f"Skip xiaoqu_detail: {e!r}")
+        return results
+    pages = fixtures.load_corpus("xiaoqu_detail", corpus_dir)
+    detail_crawler = LianjiaXiaoquDetailCrawler()
+    seconds, n_rows = _timed(
+        lambda html: detail_crawler.parse_html(html=html, default_subway_info={"community_id": "0"}), pages, repeat)
+    results["xiaoqu_detail.bs4"] = {
+        "pages": len(pages),
+        "rows": n_rows,
+        "seconds": seconds,
+        "pages_per_second": len(pages) / seconds,
+        "rows_per_second": n_rows / seconds,
+    }
+    logger.info(f"parse xiaoqu_detail.bs4: {len(pages) / seconds:.1f} pages/s, {n_rows / seconds:.1f} rows/s")
+    return results
+
+
+class MockSite:
+    """
+        本地模拟的链家列表页站点, /<prefix>/<region>/<过滤器>/ 返回对应页数的列表页
+        页数由 fixtures.mock_total_page 决定, 同样的参数每次都一样
+    """
+
+    def __init__(self, max_page=100):
+        self.max_page = max_page
+        self.n_requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _render(prefix, total_page):
+        return fixtures.LIST_PAGE_GENERATORS[prefix](seed=total_page, total_page=total_page)
+
+    def _handle(self, path):
+        parts = [p for p in path.split("/") if p]
+        if len(parts) < 2 or parts[0] not in fixtures.LIST_PAGE_GENERATORS:
+            return None
+        prefix, region = parts[0], parts[1]
+        filters = [f for f in _FILTER.findall(parts[2] if len(parts) > 2 else "") if not f.startswith("pg")]
+        return self._render(prefix, fixtures.mock_total_page(prefix, region, filters, self.max_page))
+
+    def start(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with site._lock:
+                    site.n_requests += 1
+                body = site._handle(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+def bench_candidate_urls(region="pudong"):
+    site = MockSite()
+    host = site.start()
+    # 本地站点不用限速, 看的是展开过滤器树本身的开销
+    fetcher = AsyncFetcher(concurrency_per_host=settings.PROBE_CONCURRENCY, rate_per_host=10000)
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for prefix, crawler_class in CRAWLER_CLASSES.items():
+                crawler = crawler_class(settings.CITY, fetcher=fetcher)
+                crawler.base_url = f"{host}/{prefix}/"
+                stats_file = os.path.join(directory, f"{prefix}_page_stats.json")
+                # tree 是按固定顺序完整展开, planner 是默认的 FILTER_PLANNER 路径:
+                # 第一次没有历史 (cold), 第二次用第一次攒下的历史页数 (warm, 日常运行的情况)
+                paths = {
+                    "tree": lambda urls: crawler.get_candidate_urls(urls, region),
+                    "planner_cold": lambda urls: FilterPlanner(crawler, region, stats_file).get_candidate_urls(urls),
+                    "planner_warm": lambda urls: FilterPlanner(crawler, region, stats_file).get_candidate_urls(urls),
+                }
+                for path, expand in paths.items():
+                    n_requests = site.n_requests
+                    urls = []
+                    start = time.perf_counter()
+                    expand(urls)
+                    seconds = time.perf_counter() - start
+                    n_probes = site.n_requests - n_requests
+                    results[f"{prefix}.{path}"] = {
+                        "urls": len(urls),
+                        "probes": n_probes,
+                        "seconds": seconds,
+                        "probes_per_second": n_probes / seconds,
+                    }
+                    logger.info(f"candidate urls {prefix}.{path}: {len(urls)} urls, {n_probes} probes "
+                                f"in {seconds:.2f}s")
+    finally:
+        fetcher.close()
+        site.stop()
+    return results
+
+
+def _house_rows(corpus_dir, n_rows):
+    """
+        用语料解析出来的真实行, 改写 house_id 凑够 n_rows 行
+    """
+    crawler = LianjiaErShouFangCrawler(settings.CITY)
+    template = []
+    for html in fixtures.load_corpus("ershoufang", corpus_dir):
+        template.extend(crawler.parse_html_lxml(html=html, default_info={"region": "pudong"})[0])
+    return [{**template[i % len(template)], "house_id": f"bench{i:08d}"} for i in range(n_rows)]
+
+
+def bench_writes(corpus_dir, n_rows):
+    results = {}
+    rows = _house_rows(corpus_dir, n_rows)
+    models = [HouseInfoModel, PriceHistoryModel]
+    with tempfile.TemporaryDirectory() as directory:
+        database = SqliteDatabase(os.path.join(directory, "bench.db"), pragmas={"journal_mode": "wal"})
+        with database.bind_ctx(models):
+            database.create_tables(models)
+
+            start = time.perf_counter()
+            with database.atomic():
+                for i in range(0, len(rows), settings.WRITER_INSERT_CHUNK):
+                    HouseInfoModel.insert_many(rows[i:i + settings.WRITER_INSERT_CHUNK]).on_conflict_replace().execute()
+            results["insert_many"] = time.perf_counter() - start
+
+            HouseInfoModel.delete().execute()
+            writer = BatchWriter(database=database, upsert=False)
+            start = time.perf_counter()
+            writer.add(HouseInfoModel, rows)
+            writer.flush()
+            results["batch_writer"] = time.perf_counter() - start
+
+            # 上面的写入没有存内容摘要, 先用 upsert 重写一遍 (不计时), 表里才有能比对的摘要
+            HouseInfoModel.delete().execute()
+            writer = BatchWriter(database=database, upsert=True)
+            writer.add(HouseInfoModel, rows)
+            writer.flush()
+
+            # 表里已经有同样内容的行, upsert 模式下应该全部跳过
+            writer = BatchWriter(database=database, upsert=True)
+            start = time.perf_counter()
+            writer.add(HouseInfoModel, rows)
+            writer.flush()
+            results["batch_writer_upsert_unchanged"] = time.perf_counter() - start
+            if writer.n_unchanged != len(rows):
+                logger.warning(f"upsert skipped only {writer.n_unchanged} of {len(rows)} unchanged rows")
+        database.close()
+
+    for name, seconds in results.items():
+        logger.info(f"write {name}: {n_rows / seconds:.1f} rows/s")
+    return {
+        name: {"rows": n_rows, "seconds": seconds, "rows_per_second": n_rows / seconds}
+        for name, seconds in results.items()
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except:
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """
+        找出所有 *_per_second 比 baseline 低了超过 tolerance 的项
+    """
+    regressions = []
+    for group, entries in baseline.get("results", {}).items():
+        for name, metrics in entries.items():
+            current = results.get(group, {}).get(name)
+            if current is None:
+                continue
+            for key, value in metrics.items():
+                if key.endswith("_per_second") and key in current and current[key] < value * (1 - tolerance):
+                    regressions.append(f"{group}.{name}.{key}: {value:.1f} -> {current[key]:.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="解析 / 展开过滤器 / 写库的离线基准测试")
+    parser.add_argument("--corpus", default=fixtures.CORPUS_DIR, help="语料目录, 不存在的页面会自动生成")
+    parser.add_argument("--pages", type=int, default=50, help="每一类页面生成多少个")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=20000, help="写库测试的行数")
+    parser.add_argument("--only", choices=["parse", "candidate_urls", "write"], action="append")
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(fixtures.CORPUS_DIR), "results.json"))
+    parser.add_argument("--baseline", help="之前的结果文件, 用来检查性能回退")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    # 基准测试抓到的都是假页面, 不进归档, 也不进 http 缓存 (不然会在 ../.cache/http 下面留一堆文件)
+    settings.ARCHIVE_ENABLED = False
+    settings.HTTP_CACHE_ENABLED = False
+    fixtures.build_corpus(args.corpus, args.pages)
+    only = args.only or ["parse", "candidate_urls", "write"]
+
+    results = {}
+    if "parse" in only:
+        results["parse"] = bench_parsers(args.corpus, args.repeat)
+    if "candidate_urls" in only:
+        results["candidate_urls"] = bench_candidate_urls()
+    if "write" in only:
+        results["write"] = bench_writes(args.corpus, args.rows)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parser_backend": settings.PARSER_BACKEND,
+        "results": results,
+    }
+    with open(args.output, "w") as fp:
+        json.dump(report, fp, indent=2, ensure_ascii=False)
+    logger.info(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for regression in regressions:
+            logger.error(f"Regression {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
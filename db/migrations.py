@@ -0,0 +1,153 @@
+from playhouse.migrate import SchemaMigrator, migrate
+
+import db.settings as settings
+from db.model import HouseInfoModel, RentInfoModel, SellInfoModel, CommunityModel, HistoricalPriceModel, \
+    PriceHistoryModel, CrawlTaskModel
+
+"""
+    create_tables(safe=True) 不会给已经存在的表加列
+    这里放已有的库升级要做的变更, 每一步都可以重复执行
+"""
+
+
+def add_missing_columns(model, *fields):
+    database = model._meta.database
+    table_name = model._meta.table_name
+    existing = {column.name for column in database.get_columns(table_name)}
+    migrator = SchemaMigrator.from_database(database)
+    operations = [
+        migrator.add_column(table_name, field.column_name, field)
+        for field in fields if field.column_name not in existing
+    ]
+    if operations:
+        migrate(*operations)
+
+
+def add_missing_indexes(model, *indexes):
+    """
+        indexes 里每一项是一个列名的 tuple, 按列判断索引是否已经存在, 不依赖索引的名字
+    """
+    database = model._meta.database
+    table_name = model._meta.table_name
+    existing = {tuple(index.columns) for index in database.get_indexes(table_name)}
+    migrator = SchemaMigrator.from_database(database)
+    operations = [
+        migrator.add_index(table_name, columns, False)
+        for columns in indexes if tuple(columns) not in existing
+    ]
+    if operations:
+        migrate(*operations)
+
+
+def add_content_hash():
+    for model in [HouseInfoModel, RentInfoModel, SellInfoModel]:
+        add_missing_columns(model, model.content_hash)
+
+
+def add_typed_columns():
+    """
+        lianjia.normalize 解析出来的数值列和范围查询用的索引, 已有的行用 python -m lianjia.normalize 回填
+    """
+    typed_columns = {
+        HouseInfoModel: ["area_m2", "total_price_wan", "unit_price_yuan", "build_year"],
+        SellInfoModel: ["area_m2", "list_price_wan", "total_price_wan", "unit_price_yuan", "turnover_days",
+                        "deal_day", "build_year"],
+        RentInfoModel: ["area_m2", "monthly_rent_yuan"],
+        CommunityModel: ["avg_price_yuan", "on_sale_count", "on_rent_count", "build_year", "cost_yuan",
+                         "building_count", "house_count"],
+    }
+    indexed_columns = {
+        HouseInfoModel: ["area_m2", "total_price_wan", "unit_price_yuan"],
+        SellInfoModel: ["area_m2", "total_price_wan", "unit_price_yuan", "deal_day"],
+        RentInfoModel: ["area_m2", "monthly_rent_yuan"],
+        CommunityModel: ["avg_price_yuan"],
+    }
+    for model, names in typed_columns.items():
+        add_missing_columns(model, *[model._meta.fields[name] for name in names])
+        add_missing_indexes(model, *[(name,) for name in indexed_columns[model]])
+
+
+def add_query_indexes():
+    """
+        db.queries 里那些查询用的组合索引
+    """
+    add_missing_indexes(HouseInfoModel, ("community", "total_price_wan"), ("region", "valid_date"))
+    add_missing_indexes(SellInfoModel, ("community", "deal_day"), ("region", "deal_day"))
+    add_missing_indexes(RentInfoModel, ("community", "monthly_rent_yuan"), ("region", "update_date"))
+    add_missing_indexes(CommunityModel, ("title",), ("region", "title"))
+
+
+def add_export_indexes():
+    """
+        lianjia.export 增量导出按更新时间筛选
+    """
+    add_missing_indexes(CommunityModel, ("valid_date",))
+    add_missing_indexes(HouseInfoModel, ("valid_date",))
+    add_missing_indexes(SellInfoModel, ("update_date",))
+    add_missing_indexes(RentInfoModel, ("update_date",))
+    add_missing_indexes(HistoricalPriceModel, ("date",))
+
+
+def add_crawl_task_city():
+    """
+        分布式队列的任务记下城市, 以前的任务没有城市, worker 按 --city 处理
+    """
+    add_missing_columns(CrawlTaskModel, CrawlTaskModel.city)
+
+
+def copy_historical_prices():
+    """
+        historical_price 里的旧数据复制到 price_history, 每个房源按时间排好, 相邻的相同价格合并成一段
+        price_history 里已经有数据就跳过
+    """
+    from lianjia.normalize import to_float
+
+    if PriceHistoryModel.select().exists() or not HistoricalPriceModel.select().exists():
+        return
+    database = PriceHistoryModel._meta.database
+    runs = []
+    query = HistoricalPriceModel.select(
+        HistoricalPriceModel.house_id, HistoricalPriceModel.total_price, HistoricalPriceModel.date
+    ).order_by(HistoricalPriceModel.house_id, HistoricalPriceModel.date).tuples()
+    with database.atomic():
+        for house_id, total_price, date in query.iterator():
+            last = runs[-1] if runs and runs[-1]["house_id"] == house_id else None
+            if last is not None and last["total_price"] == total_price:
+                continue
+            if last is not None:
+                last["latest"] = False
+            total_price_wan = to_float(total_price)
+            previous_price_wan = None if last is None else last["total_price_wan"]
+            runs.append({
+                "house_id": house_id, "observed_at": date, "last_observed_at": date, "n_observations": 1,
+                "total_price": total_price, "total_price_wan": total_price_wan,
+                "previous_price_wan": previous_price_wan,
+                "price_change": None if total_price_wan is None or previous_price_wan is None
+                else total_price_wan - previous_price_wan,
+                "latest": True,
+            })
+            # 最后一段还可能被下一行改掉 latest, 先留着
+            if len(runs) > settings.WRITER_INSERT_CHUNK:
+                PriceHistoryModel.insert_many(runs[:-1]).execute()
+                runs = runs[-1:]
+        if runs:
+            PriceHistoryModel.insert_many(runs).execute()
+
+
+MIGRATIONS = [
+    add_content_hash,
+    add_typed_columns,
+    add_query_indexes,
+    add_export_indexes,
+    copy_historical_prices,
+    add_crawl_task_city,
+]
+
+
+def run_migrations():
+    for migration in MIGRATIONS:
+        migration()
+
+
+if __name__ == '__main__':
+    run_migrations()
@@ -1,16 +1,46 @@
 from peewee import *
+from playhouse.pool import PooledMySQLDatabase, PooledSqliteDatabase
+from playhouse.shortcuts import ReconnectMixin
 import datetime
 import db.settings as settings
 
-database = MySQLDatabase(
-    settings.DB_NAME,
-    host=settings.DB_HOST,
-    port=settings.DB_PORT,
-    user=settings.DB_USER,
-    passwd=settings.DB_PASSWORD,
-    charset='utf8',
-    use_unicode=True,
-)
+
+class ReconnectPooledMySQLDatabase(ReconnectMixin, PooledMySQLDatabase):
+    """
+        连接池 + 断线重连, 被 MySQL 服务端踢掉的连接 (wait_timeout) 会自动重连
+    """
+    pass
+
+
+def make_database():
+    """
+        根据 settings 创建数据库对象
+        DB_POOL 打开时每个线程从池里拿自己的连接, 超过 DB_STALE_TIMEOUT 秒没用的连接会被回收
+    """
+    pool_kwargs = dict(
+        max_connections=settings.DB_MAX_CONNECTIONS,
+        stale_timeout=settings.DB_STALE_TIMEOUT,
+        timeout=settings.DB_POOL_TIMEOUT,
+    )
+    if settings.DB_ENGINE == 'sqlite':
+        if settings.DB_POOL:
+            return PooledSqliteDatabase(settings.DB_NAME, check_same_thread=False, **pool_kwargs)
+        return SqliteDatabase(settings.DB_NAME)
+
+    mysql_kwargs = dict(
+        host=settings.DB_HOST,
+        port=settings.DB_PORT,
+        user=settings.DB_USER,
+        passwd=settings.DB_PASSWORD,
+        charset='utf8',
+        use_unicode=True,
+    )
+    if settings.DB_POOL:
+        return ReconnectPooledMySQLDatabase(settings.DB_NAME, **pool_kwargs, **mysql_kwargs)
+    return MySQLDatabase(settings.DB_NAME, **mysql_kwargs)
+
+
+database = make_database()
 
 
 class BaseModel(Model):
@@ -41,6 +71,15 @@ class CommunityModel(BaseModel):
     price = CharField(null=True)
     city = CharField(null=True)
     valid_date = DateTimeField(default=datetime.datetime.now)
+    # 下面是 lianjia.normalize 从上面的文本字段解析出来的数值, 解析不出来的是 NULL
+    # 这些列的索引在 db.migrations 里建: 老的库 create_tables 的时候还没有这些列, 不能在这里声明索引
+    avg_price_yuan = IntegerField(null=True)  # 均价, 元/平米
+    on_sale_count = IntegerField(null=True)
+    on_rent_count = IntegerField(null=True)
+    build_year = IntegerField(null=True)
+    cost_yuan = FloatField(null=True)  # 物业费, 元/平米/月
+    building_count = IntegerField(null=True)
+    house_count = IntegerField(null=True)
 
     class Meta:
         table_name = "community"
@@ -64,12 +103,21 @@ class HouseInfoModel(BaseModel):
     follow_info = CharField()
     decoration = CharField()
     valid_date = DateTimeField(default=datetime.datetime.now)
+    content_hash = CharField(max_length=40, null=True)  # 解析出来的内容的摘要, 没变化就不重写
+    area_m2 = FloatField(null=True)
+    total_price_wan = FloatField(null=True)  # 总价, 万元
+    unit_price_yuan = IntegerField(null=True)  # 单价, 元/平米
+    build_year = IntegerField(null=True)
 
     class Meta:
         table_name = "house_info"
 
 
 class HistoricalPriceModel(BaseModel):
+    """
+        老的价格历史, 同一个价格只能有一行, 价格变回去的时候历史就丢了
+        现在写的是 PriceHistoryModel, 这张表只留着以前的数据, 升级时由 db.migrations 复制过去
+    """
     house_id = CharField()
     total_price = CharField()
     date = DateTimeField(default=datetime.datetime.now)
@@ -79,6 +127,31 @@ class HistoricalPriceModel(BaseModel):
         table_name = "historical_price"
 
 
+class PriceHistoryModel(BaseModel):
+    """
+        二手房的挂牌价历史, 一行是一段价格没变的时间 (游程编码)
+        observed_at 是这个价格第一次看到的时间, 之后每次看到同样的价格只更新 last_observed_at 和 n_observations
+        价格变了就把原来那一段的 latest 置为 False, 新开一段, 记下上一段的价格和变化量
+    """
+    house_id = CharField()
+    observed_at = DateTimeField(default=datetime.datetime.now)
+    last_observed_at = DateTimeField(default=datetime.datetime.now)
+    n_observations = IntegerField(default=1)
+    total_price = CharField()
+    total_price_wan = FloatField(null=True)
+    previous_price_wan = FloatField(null=True)
+    price_change = FloatField(null=True)  # 相对上一段的变化, 万元, 负数是降价
+    latest = BooleanField(default=True)
+
+    class Meta:
+        primary_key = CompositeKey('house_id', 'observed_at')
+        table_name = "price_history"
+        indexes = (
+            (('observed_at', 'price_change'), False),
+            (('last_observed_at',), False),
+        )
+
+
 class SellInfoModel(BaseModel):
     house_id = CharField(primary_key=True)
     title = CharField()
@@ -98,6 +171,14 @@ class SellInfoModel(BaseModel):
     unit_price = CharField()
     deal_date = CharField(null=True)
     update_date = DateTimeField(default=datetime.datetime.now)
+    content_hash = CharField(max_length=40, null=True)
+    area_m2 = FloatField(null=True)
+    list_price_wan = FloatField(null=True)  # 挂牌价, 万元
+    total_price_wan = FloatField(null=True)  # 成交价, 万元
+    unit_price_yuan = IntegerField(null=True)
+    turnover_days = IntegerField(null=True)
+    deal_day = DateField(null=True)
+    build_year = IntegerField(null=True)
 
     class Meta:
         table_name = "sell_info"
@@ -119,6 +200,9 @@ class RentInfoModel(BaseModel):
     direction = CharField()
     rent_type = CharField()
     update_date = DateTimeField(default=datetime.datetime.now)
+    content_hash = CharField(max_length=40, null=True)
+    area_m2 = FloatField(null=True)
+    monthly_rent_yuan = IntegerField(null=True)  # 租金, 元/月
 
     class Meta:
         table_name = "rent_info"
@@ -135,9 +219,62 @@ class SubwayCommunityModel(BaseModel):
         table_name = "subway_community"
 
 
+class CommunityDetailStateModel(BaseModel):
+    """
+        小区详情上次刷新的时间, 以及当时的在售 / 在租套数
+        community 表每次爬列表都会整行替换, 所以单独放一张表
+    """
+    community_id = BigIntegerField(primary_key=True)
+    detail_updated_at = DateTimeField()
+    on_sale = IntegerField(null=True)
+    on_rent = IntegerField(null=True)
+
+    class Meta:
+        table_name = "community_detail_state"
+
+
+class CrawlTaskModel(BaseModel):
+    """
+        分布式爬取的共享队列, 一行是一个待爬的列表页
+        worker 领取时写上自己的 id 和租约到期时间, 心跳续约; 租约过期还没完成的会被其它 worker 收回
+    """
+    queue = CharField()  # 爬虫类型, 例如 chengjiao
+    url = CharField(unique=True)
+    region = CharField()
+    city = CharField(null=True)  # 同一个队列里可以有多个城市, 解析和入库要用对应城市的爬虫
+    state = CharField(default="pending")
+    retries = IntegerField(default=0)
+    worker = CharField(null=True)
+    claim_token = CharField(null=True)
+    lease_until = DateTimeField(null=True)
+    updated_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        table_name = "crawl_task"
+        indexes = (
+            (('queue', 'state'), False),
+            (('state', 'lease_until'), False),
+        )
+
+
+class CrawlWorkerModel(BaseModel):
+    worker_id = CharField(primary_key=True)
+    queue = CharField()
+    host = CharField()
+    started_at = DateTimeField(default=datetime.datetime.now)
+    heartbeat_at = DateTimeField(default=datetime.datetime.now)
+    n_done = IntegerField(default=0)
+
+    class Meta:
+        table_name = "crawl_worker"
+
+
 def database_init():
     database.connect()
     database.create_tables(
-        [CommunityModel, HouseInfoModel, HistoricalPriceModel, SellInfoModel, RentInfoModel, SubwayCommunityModel],
+        [CommunityModel, HouseInfoModel, HistoricalPriceModel, PriceHistoryModel, SellInfoModel, RentInfoModel,
+         SubwayCommunityModel, CommunityDetailStateModel, CrawlTaskModel, CrawlWorkerModel],
         safe=True)
+    from db.migrations import run_migrations
+    run_migrations()
     database.close()
@@ -0,0 +1,162 @@
+import argparse
+import datetime
+
+from peewee import fn, JOIN, MySQLDatabase
+
+from db.model import database, database_init, CommunityModel, HouseInfoModel, SellInfoModel, RentInfoModel
+from lianjia.utils import logger
+
+"""
+    常用的查询, 每个都有 db.migrations.add_query_indexes 里对应的索引
+    返回的都是还没执行的 peewee 查询, 调用方自己 .dicts() / .tuples() / 再加条件
+
+    python -m db.queries 用 EXPLAIN 检查每个查询都走了索引, 有全表扫描的退出码为 1
+"""
+
+
+def listings_by_community(community, min_price=None, max_price=None):
+    """
+        一个小区在售的二手房, 按总价 (万元) 从低到高, 可以限定总价范围
+    """
+    query = HouseInfoModel.select().where(HouseInfoModel.community == community)
+    if min_price is not None:
+        query = query.where(HouseInfoModel.total_price_wan >= min_price)
+    if max_price is not None:
+        query = query.where(HouseInfoModel.total_price_wan <= max_price)
+    return query.order_by(HouseInfoModel.total_price_wan)
+
+
+def listings_in_region(region, since):
+    """
+        一个区域 since 之后爬到 (新上或者有变化) 的二手房
+    """
+    return HouseInfoModel.select().where(
+        (HouseInfoModel.region == region) & (HouseInfoModel.valid_date >= since)
+    ).order_by(HouseInfoModel.valid_date.desc())
+
+
+def deals_in_region(region, start, end):
+    """
+        一个区域 [start, end] 之间成交的房子, 按成交日期
+    """
+    return SellInfoModel.select().where(
+        (SellInfoModel.region == region) & (SellInfoModel.deal_day.between(start, end))
+    ).order_by(SellInfoModel.deal_day)
+
+
+def deals_by_community(community, start=None, end=None):
+    query = SellInfoModel.select().where(SellInfoModel.community == community)
+    if start is not None:
+        query = query.where(SellInfoModel.deal_day >= start)
+    if end is not None:
+        query = query.where(SellInfoModel.deal_day <= end)
+    return query.order_by(SellInfoModel.deal_day)
+
+
+def rents_by_community(community, max_rent=None):
+    query = RentInfoModel.select().where(RentInfoModel.community == community)
+    if max_rent is not None:
+        query = query.where(RentInfoModel.monthly_rent_yuan <= max_rent)
+    return query.order_by(RentInfoModel.monthly_rent_yuan)
+
+
+def community_by_title(title):
+    """
+        二手房 / 成交 / 租房里的 community 是小区名, 用它找回小区
+    """
+    return CommunityModel.select().where(CommunityModel.title == title)
+
+
+def rent_to_price_ratio(region):
+    """
+        一个区域每个小区的租售比: 每平米年租金 / 每平米挂牌单价
+        租房和二手房按小区名分别聚合, 再和小区按 title 连起来; 只有租房或者只有二手房的小区比例是 NULL
+    """
+    titles = CommunityModel.select(CommunityModel.title).where(CommunityModel.region == region)
+    rent = (RentInfoModel
+            .select(RentInfoModel.community,
+                    fn.AVG(RentInfoModel.monthly_rent_yuan / RentInfoModel.area_m2).alias("rent_per_m2"),
+                    fn.COUNT(RentInfoModel.house_id).alias("n_rent"))
+            .where(RentInfoModel.community.in_(titles) & (RentInfoModel.area_m2 > 0))
+            .group_by(RentInfoModel.community)
+            .alias("rent"))
+    sale = (HouseInfoModel
+            .select(HouseInfoModel.community,
+                    fn.AVG(HouseInfoModel.unit_price_yuan).alias("unit_price"),
+                    fn.COUNT(HouseInfoModel.house_id).alias("n_sale"))
+            .where(HouseInfoModel.community.in_(titles))
+            .group_by(HouseInfoModel.community)
+            .alias("sale"))
+    return (CommunityModel
+            .select(CommunityModel.id, CommunityModel.title,
+                    rent.c.rent_per_m2, rent.c.n_rent, sale.c.unit_price, sale.c.n_sale,
+                    (rent.c.rent_per_m2 * 12 / sale.c.unit_price).alias("ratio"))
+            .join_from(CommunityModel, rent, JOIN.LEFT_OUTER, on=(rent.c.community == CommunityModel.title))
+            .join_from(CommunityModel, sale, JOIN.LEFT_OUTER, on=(sale.c.community == CommunityModel.title))
+            .where(CommunityModel.region == region)
+            .order_by(CommunityModel.title))
+
+
+def _sample_queries():
+    today = datetime.date.today()
+    return {
+        "listings_by_community": listings_by_community("x", 100, 500),
+        "listings_in_region": listings_in_region("x", today),
+        "deals_in_region": deals_in_region("x", today, today),
+        "deals_by_community": deals_by_community("x", today),
+        "rents_by_community": rents_by_community("x", 5000),
+        "community_by_title": community_by_title("x"),
+        "rent_to_price_ratio": rent_to_price_ratio("x"),
+    }
+
+
+def _full_scans_sqlite(sql, params):
+    """
+        EXPLAIN QUERY PLAN 里没有用索引的 SCAN 就是全表扫描, 扫描物化的子查询的不算
+    """
+    rows = database.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    details = [row[-1] for row in rows]
+    subqueries = {detail.split()[-1] for detail in details if detail.startswith(("MATERIALIZE", "CO-ROUTINE"))}
+    return [detail for detail in details
+            if detail.startswith("SCAN") and "INDEX" not in detail and detail.split()[1] not in subqueries]
+
+
+def _full_scans_mysql(sql, params):
+    """
+        EXPLAIN 里 type 是 ALL 的表, 派生表 (<derived2>) 不算
+    """
+    cursor = database.execute_sql("EXPLAIN " + sql, params)
+    columns = [column[0] for column in cursor.description]
+    rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    return [f"{row['table']}: type ALL" for row in rows
+            if row["type"] == "ALL" and not str(row["table"]).startswith("<")]
+
+
+def check_query_plans():
+    """
+        返回 {查询名: [全表扫描的步骤]}, 都走了索引的查询不在结果里
+    """
+    explain = _full_scans_mysql if isinstance(database, MySQLDatabase) else _full_scans_sqlite
+    result = {}
+    for name, query in _sample_queries().items():
+        sql, params = query.sql()
+        full_scans = explain(sql, params)
+        if full_scans:
+            result[name] = full_scans
+    return result
+
+
+def main():
+    argparse.ArgumentParser(description="用 EXPLAIN 检查 db.queries 里的查询都走了索引").parse_args()
+    database_init()
+    with database.connection_context():
+        result = check_query_plans()
+    for name, full_scans in result.items():
+        logger.error(f"{name} does a full scan: {'; '.join(full_scans)}")
+    if result:
+        exit(1)
+    logger.info("All queries use indexes")
+
+
+if __name__ == '__main__':
+    main()
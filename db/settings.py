@@ -1,10 +1,152 @@
-DB_ENGINE = 'mysql'
+DB_ENGINE = 'mysql'  # 'mysql' 或者 'sqlite', sqlite 时 DB_NAME 是数据库文件的路径
 DB_NAME = 'sa_zyy_home'
 DB_USER = 'root'
 DB_PASSWORD = '000000'
 DB_HOST = '127.0.0.1'
 DB_PORT = 3306
+# 连接池: 最多多少个连接, 空闲多少秒的连接回收掉, 池子满了等多少秒
+DB_POOL = True
+DB_MAX_CONNECTIONS = 16
+DB_STALE_TIMEOUT = 300
+DB_POOL_TIMEOUT = 30
+# 要爬的城市, 一个或者一组; REGION_LIST 是所有城市共用的区域列表, 或者 {城市: [区域]}
 CITY = 'sh'
-REGION_LIST = [
-    'pudong'
-]
+REGION_LIST = {
+    'sh': [
+        "pudong",  # 浦东
+        "jingan",  # 静安
+        "xuhui",  # 徐汇
+        "huangpu",  # 黄浦
+        "changning",  # 长宁
+        "putuo",  # 普陀
+        "baoshan",  # 宝山
+        "hongkou",  # 虹口
+        "yangpu",  # 杨浦
+        "minhang",  # 闵行
+        "jinshan",  # 金山
+        "jiading",  # 嘉定
+        "chongming",  # 崇明
+        "fengxian",  # 奉贤
+        "songjiang",  # 松江
+        "qingpu"  # 青浦
+    ],
+}
+
+# 抓取引擎: 每个 host 同时在飞的请求数, 每秒请求数 (令牌桶), 超时秒数
+FETCH_CONCURRENCY_PER_HOST = 4
+FETCH_RATE_PER_HOST = 2.0
+FETCH_TIMEOUT = 30
+
+# 过滤器树展开: 同时探测页数的节点数, 单个节点探测失败的重试次数
+PROBE_CONCURRENCY = 8
+PROBE_RETRIES = 3
+
+# 自适应过滤器拆分: 历史页数不超过 max_page * PLANNER_SAFE_RATIO 的节点不再探测
+# 直接按历史页数 + PLANNER_PAD_PAGES 生成url, 历史数据超过 PLANNER_STATS_MAX_AGE 天就不再使用
+FILTER_PLANNER = True
+PLANNER_SAFE_RATIO = 0.8
+PLANNER_PAD_PAGES = 1
+PLANNER_STATS_MAX_AGE = 7
+PLANNER_SPLIT_PENALTY = 7
+# 历史页数是预测的, 节点可能已经变大了: 爬到满页 (LIST_PAGE_SIZE 条) 而页面上的总页数还更多时, 把下一页加进队列
+LIST_PAGE_SIZE = 30
+
+# 列表页解析后端: "bs4" (BeautifulSoup) 或者 "lxml" (预编译 XPath, 输出和 bs4 一致)
+PARSER_BACKEND = "lxml"
+
+# 解析进程数, 0 表示在抓取的循环里直接解析; 流水线各段之间队列的长度
+# 解析进程的启动方式: 调度器在多个线程里跑流水线, 不能直接 fork, 用 forkserver (不支持的平台用 spawn)
+PARSER_PROCESSES = 4
+PIPELINE_QUEUE_SIZE = 64
+PARSER_START_METHOD = "forkserver"
+
+# 攒批写库: 攒够多少行或者多少秒写一次, 每条 insert 语句最多多少行
+# WRITER_UPSERT 打开时二手房/租房/成交只重写内容有变化的行
+WRITER_BATCH_SIZE = 2000
+WRITER_FLUSH_INTERVAL = 30
+WRITER_INSERT_CHUNK = 500
+WRITER_UPSERT = True
+
+# 小区详情爬虫的线程数, 每个线程从连接池拿自己的连接
+DETAIL_CRAWLER_THREADS = 4
+# 详情爬虫的浏览器池: 每个浏览器打开多少页之后换新的, 等待页面加载的超时 (秒), 所有浏览器合起来两次打开页面的最小间隔 (秒)
+BROWSER_RECYCLE_PAGES = 200
+BROWSER_WAIT_TIMEOUT = 15
+BROWSER_MIN_INTERVAL = 0.5
+# 小区详情先试静态页面, 缺的部分再用浏览器补
+DETAIL_STATIC_FIRST = True
+# 小区详情增量刷新: 每次最多刷新多少个小区, 时间预算 (秒), 在售 / 在租每变化一套相当于陈旧多少天
+DETAIL_REFRESH_TOP_N = 2000
+DETAIL_REFRESH_BUDGET = 3600
+DETAIL_ACTIVITY_WEIGHT = 0.5
+
+# 待爬队列: 每次领取多少个url, 一个url最多失败几次
+# 领取的url是一份租约, 超过 FRONTIER_LEASE_TIMEOUT 秒还没完成才当作领取它的进程已经挂了, 放回 pending
+FRONTIER_CLAIM_BATCH = 50
+FRONTIER_MAX_RETRIES = 3
+FRONTIER_LEASE_TIMEOUT = 1800
+
+# 原始页面归档: 目录, 单个段文件的大小上限, zlib 压缩级别
+ARCHIVE_ENABLED = True
+ARCHIVE_DIR = "../.cache/archive"
+ARCHIVE_SEGMENT_SIZE = 256 * 1024 * 1024
+ARCHIVE_COMPRESS_LEVEL = 6
+
+# http 缓存: 目录, 总大小上限 (字节), 探测页数的页面在多少秒内直接用缓存
+HTTP_CACHE_ENABLED = True
+HTTP_CACHE_DIR = "../.cache/http"
+HTTP_CACHE_MAX_BYTES = 512 * 1024 * 1024
+HTTP_CACHE_PROBE_TTL = 6 * 3600
+
+# 二手房和成交默认按从新到旧增量爬取, 遇到全是已入库房源的页就停止这个分支
+# 一页抓取或者解析失败时这一页最多重试 DELTA_MAX_RETRIES 次, 还不行就放弃这个分支
+DELTA_CRAWL = False
+DELTA_MAX_RETRIES = 3
+
+# 一次爬取内按主键去重: 行数不超过 DEDUP_EXACT_LIMIT 时精确去重, 超过后换成 Bloom filter (容量, 误判率)
+DEDUP_ENABLED = True
+DEDUP_EXACT_LIMIT = 200000
+DEDUP_CAPACITY = 2000000
+DEDUP_ERROR_RATE = 1e-6
+
+# 调度: 同时爬几个 (爬虫, 城市, 区域), 默认跑哪些爬虫, 失败重试次数, 重试的退避时间 (秒, 指数增长到上限)
+SCHEDULER_CONCURRENCY = 4
+SCHEDULER_CRAWLERS = ["ershoufang", "zufang", "xiaoqu", "chengjiao"]
+SCHEDULER_MAX_RETRIES = 5
+SCHEDULER_BACKOFF_BASE = 10
+SCHEDULER_BACKOFF_MAX = 600
+
+# 分布式 worker: 一次领多少个任务, 租约秒数, 心跳间隔 (秒), 没有任务时多久再看一次 (秒), 最多重试次数
+WORKER_BATCH_SIZE = 50
+WORKER_LEASE_SECONDS = 300
+WORKER_HEARTBEAT_INTERVAL = 30
+WORKER_POLL_INTERVAL = 10
+WORKER_MAX_RETRIES = 3
+
+# 自适应限速: 被封 (验证码 / 414 / 429) 时速率和并发乘以 THROTTLE_DECREASE 并暂停 THROTTLE_BLOCK_PAUSE 秒,
+# 5xx 时乘以 THROTTLE_SERVER_ERROR_DECREASE; 每连续成功 THROTTLE_INCREASE_EVERY 次速率加 THROTTLE_INCREASE,
+# 速率在 [THROTTLE_MIN_RATE, THROTTLE_MAX_RATE] 之间; 一个页面最多重试 THROTTLE_MAX_RETRIES 次
+THROTTLE_ENABLED = True
+THROTTLE_DECREASE = 0.5
+THROTTLE_SERVER_ERROR_DECREASE = 0.8
+THROTTLE_BLOCK_PAUSE = 60
+THROTTLE_INCREASE = 0.1
+THROTTLE_INCREASE_EVERY = 20
+THROTTLE_MIN_RATE = 0.2
+THROTTLE_MAX_RATE = 4.0
+THROTTLE_MAX_RETRIES = 3
+
+# 回填数值列时每批读多少行
+NORMALIZE_BACKFILL_BATCH = 1000
+
+# 市场分析: 从数据库每次取多少行, csv 输出目录
+ANALYTICS_CHUNK_SIZE = 50000
+ANALYTICS_OUTPUT_DIR = "../analytics"
+
+# 导出: 输出目录, 格式 (parquet / arrow), 每次从数据库取多少行, 同时最多打开多少个分区文件,
+# 增量导出和上一次重叠的秒数
+EXPORT_DIR = "../export"
+EXPORT_FORMAT = "parquet"
+EXPORT_CHUNK_SIZE = 20000
+EXPORT_MAX_OPEN_FILES = 64
+EXPORT_OVERLAP = 300
@@ -0,0 +1,230 @@
+import argparse
+import os
+import time
+
+import pandas as pd
+
+import db.settings as settings
+from db.model import database, database_init, CommunityModel, HouseInfoModel, SellInfoModel, RentInfoModel
+from lianjia.utils import logger
+
+"""
+    市场分析
+    成交 / 在售 / 租房三张表按列读进 pandas 的 DataFrame (一条 select, 游标按 chunk_size 分块取),
+    之后所有的统计都是整列的向量运算和 groupby, 不再一行一行地过 peewee 的 model
+
+    数值优先用 lianjia.normalize 写好的数值列, 还没回填的老数据在这里从文本列向量化地解析
+
+    python -m lianjia.analytics
+    python -m lianjia.analytics --region pudong --output ../analytics
+"""
+
+_NUMBER = r"(\d+(?:\.\d+)?)"
+_DATE = r"(\d{4})\D(\d{1,2})(?:\D(\d{1,2}))?"
+
+
+def read_frame(query, columns, chunk_size=None):
+    """
+        执行 query, 按块取结果拼成 DataFrame, columns 是 select 的列名
+    """
+    chunk_size = chunk_size or settings.ANALYTICS_CHUNK_SIZE
+    cursor = database.execute(query)
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunks.append(pd.DataFrame.from_records(rows, columns=columns))
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def parse_numbers(raw):
+    """
+        lianjia.normalize.to_float 的向量化版本: 第一个数字, 打了码的 ("2**") 是 NaN
+    """
+    text = raw.astype("string").str.replace(",", "", regex=False)
+    values = pd.to_numeric(text.str.extract(_NUMBER, expand=False), errors="coerce")
+    return values.mask(text.str.contains("*", regex=False, na=False)).astype("float64")
+
+
+def parse_dates(raw):
+    parts = raw.astype("string").str.extract(_DATE).astype("float64")
+    parts.columns = ["year", "month", "day"]
+    parts["day"] = parts["day"].fillna(1)
+    return pd.to_datetime(parts, errors="coerce")
+
+
+def _fill(frame, typed, raw, parse):
+    """
+        数值列是空的 (还没回填) 的行用文本列解析出来的值补上, 然后丢掉文本列
+    """
+    missing = frame[typed].isna()
+    if missing.any():
+        # 文本的取值重复很多 (日期, 成交周期, 单价), 只解析不重复的那些再按编码展开
+        codes, uniques = pd.factorize(frame.loc[missing, raw])
+        parsed = parse(pd.Series(uniques, dtype="object")).to_numpy()
+        values = parsed.take(codes)
+        values[codes < 0] = None
+        frame.loc[missing, typed] = values
+    return frame.drop(columns=raw)
+
+
+def _load(model, columns, fills, where=None, chunk_size=None):
+    names = columns + [typed for typed, _, _ in fills] + [raw for _, raw, _ in fills]
+    query = model.select(*[getattr(model, name) for name in names])
+    if where is not None:
+        query = query.where(where)
+    frame = read_frame(query, names, chunk_size)
+    for typed, raw, parse in fills:
+        if parse is parse_dates:
+            frame[typed] = pd.to_datetime(frame[typed], errors="coerce")
+        else:
+            frame[typed] = pd.to_numeric(frame[typed], errors="coerce").astype("float64")
+        frame = _fill(frame, typed, raw, parse)
+    for name in ("community", "region"):
+        frame[name] = frame[name].astype("category")
+    return frame
+
+
+def load_deals(region=None, chunk_size=None):
+    """
+        成交: 成交日期, 成交总价 (万元), 单价 (元/平米), 面积, 成交周期 (天)
+    """
+    return _load(SellInfoModel, ["house_id", "community", "region"], [
+        ("deal_day", "deal_date", parse_dates),
+        ("total_price_wan", "total_price", parse_numbers),
+        ("unit_price_yuan", "unit_price", parse_numbers),
+        ("area_m2", "square", parse_numbers),
+        ("turnover_days", "turnover", parse_numbers),
+    ], None if region is None else SellInfoModel.region == region, chunk_size)
+
+
+def load_listings(region=None, chunk_size=None):
+    """
+        在售的二手房: 挂牌总价 (万元), 单价 (元/平米), 面积
+    """
+    return _load(HouseInfoModel, ["house_id", "community", "region"], [
+        ("total_price_wan", "total_price", parse_numbers),
+        ("unit_price_yuan", "unit_price", parse_numbers),
+        ("area_m2", "square", parse_numbers),
+    ], None if region is None else HouseInfoModel.region == region, chunk_size)
+
+
+def load_rents(region=None, chunk_size=None):
+    """
+        租房: 月租金 (元), 面积
+        租房页面上的 region 是中文的区名, 和其它表对不上, 按小区名筛选区域
+    """
+    where = None
+    if region is not None:
+        where = RentInfoModel.community.in_(
+            CommunityModel.select(CommunityModel.title).where(CommunityModel.region == region))
+    return _load(RentInfoModel, ["house_id", "community", "region"], [
+        ("monthly_rent_yuan", "price", parse_numbers),
+        ("area_m2", "square", parse_numbers),
+    ], where, chunk_size)
+
+
+def _community_regions(*frames):
+    """
+        小区名 -> 区域, 用成交和在售里的 region
+    """
+    pairs = pd.concat([frame[["community", "region"]].astype("object") for frame in frames], ignore_index=True)
+    return pairs.dropna().drop_duplicates("community").set_index("community")["region"]
+
+
+def market_summary(deals, listings, rents, by):
+    """
+        按 by (community 或者 region) 分组:
+            成交单价中位数, 挂牌单价中位数, 成交周期中位数 (天), 每平米月租金中位数,
+            租售比 (price_to_rent, 挂牌单价 / 每平米年租金, 即多少年的租金能买下; 没有挂牌的用成交单价)
+    """
+    if by == "region":
+        # 租房按小区名归到成交 / 在售的区域上
+        regions = _community_regions(deals, listings)
+        rents = rents.assign(region=rents["community"].astype("object").map(regions)
+                             .fillna(rents["region"].astype("object")))
+    deal = deals.groupby(by, observed=True).agg(
+        n_deals=("house_id", "size"),
+        deal_unit_price=("unit_price_yuan", "median"),
+        days_on_market=("turnover_days", "median"),
+    )
+    listing = listings.groupby(by, observed=True).agg(
+        n_listings=("house_id", "size"),
+        listing_unit_price=("unit_price_yuan", "median"),
+    )
+    area = rents["area_m2"].where(rents["area_m2"] > 0)
+    rent = rents.assign(rent_per_m2=rents["monthly_rent_yuan"] / area).groupby(by, observed=True).agg(
+        n_rents=("house_id", "size"),
+        rent_per_m2=("rent_per_m2", "median"),
+    )
+    for frame in (deal, listing, rent):
+        frame.index = frame.index.astype("object")
+    result = deal.join(listing, how="outer").join(rent, how="outer")
+    for column in ("n_deals", "n_listings", "n_rents"):
+        result[column] = result[column].fillna(0).astype("int64")
+    unit_price = result["listing_unit_price"].fillna(result["deal_unit_price"])
+    result["price_to_rent"] = unit_price / (result["rent_per_m2"] * 12)
+    result.index.name = by
+    return result.sort_index()
+
+
+def monthly_price_index(deals, by="region"):
+    """
+        按月的成交单价中位数和指数, by 为 None 时是全部数据一条线
+        index 以每条线的第一个月为 100, mom 是环比
+    """
+    frame = deals.dropna(subset=["deal_day", "unit_price_yuan"])
+    month = frame["deal_day"].dt.to_period("M").rename("month")
+    keys = [month] if by is None else [frame[by].astype("object"), month]
+    result = frame.groupby(keys)["unit_price_yuan"].agg(n_deals="size", median_unit_price="median").reset_index()
+    if by is None:
+        groups = result["median_unit_price"]
+        result["mom"] = groups.pct_change()
+        result["index"] = groups / groups.iloc[0] * 100 if len(groups) else groups
+        return result
+    grouped = result.groupby(by)["median_unit_price"]
+    result["mom"] = grouped.pct_change()
+    result["index"] = result["median_unit_price"] / grouped.transform("first") * 100
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="成交 / 在售 / 租房的市场统计")
+    parser.add_argument("--region", help="只统计一个区域, 默认全部")
+    parser.add_argument("--output", default=settings.ANALYTICS_OUTPUT_DIR, help="csv 输出目录")
+    parser.add_argument("--chunk-size", type=int, default=settings.ANALYTICS_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    database_init()
+    start = time.perf_counter()
+    with database.connection_context():
+        deals = load_deals(args.region, args.chunk_size)
+        listings = load_listings(args.region, args.chunk_size)
+        rents = load_rents(args.region, args.chunk_size)
+    logger.info(f"Loaded {len(deals)} deals, {len(listings)} listings, {len(rents)} rents "
+                f"in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    results = {
+        "community": market_summary(deals, listings, rents, "community"),
+        "region": market_summary(deals, listings, rents, "region"),
+        "monthly_index_region": monthly_price_index(deals, "region"),
+        "monthly_index": monthly_price_index(deals, None),
+    }
+    logger.info(f"Computed statistics in {time.perf_counter() - start:.1f}s")
+
+    os.makedirs(args.output, exist_ok=True)
+    for name, frame in results.items():
+        path = os.path.join(args.output, f"{name}.csv")
+        frame.to_csv(path, index=not isinstance(frame.index, pd.RangeIndex), float_format="%.4f")
+        logger.info(f"Wrote {len(frame)} rows to {path}")
+    with pd.option_context("display.width", 160, "display.max_columns", 20):
+        print(results["region"])
+        print(results["monthly_index"].tail(12))
+
+
+if __name__ == '__main__':
+    main()
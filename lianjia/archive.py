@@ -0,0 +1,262 @@
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+
+import db.settings as settings
+from lianjia.utils import logger
+
+"""
+    原始页面归档
+    每个抓下来的页面按内容的 sha1 去重, 用 zlib 压缩后追加写进按天分的段文件
+    同一个段里所有页面共用一份预置字典 (段里的第一个页面), 链家页面的模板部分基本一样, 压缩率很高
+    索引放在 sqlite 里: 页面 (url, 抓取日期) -> 内容摘要 -> (段文件, 偏移, 长度)
+    读的时候用 mmap 映射段文件
+    修了 parse_html 的 bug 之后可以用 replay 把某一天的页面离线重新解析入库, 不用再爬一遍
+"""
+
+# zlib 的窗口最大 32KB, 字典再长也用不上
+_MAX_DICT_SIZE = 32 * 1024
+
+
+class PageArchive:
+
+    def __init__(self, root=None, segment_size=None):
+        self.root = root or settings.ARCHIVE_DIR
+        self.segment_size = segment_size or settings.ARCHIVE_SEGMENT_SIZE
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(self.root, "index.sqlite"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                fetch_date TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                digest TEXT NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pages_date_url ON pages (fetch_date, url)")
+        self._conn.commit()
+
+        self._segment = None
+        self._segment_fp = None
+        self._compressor_dict = None
+        self._dicts = {}
+        self._maps = {}
+
+    def _segment_path(self, segment):
+        return os.path.join(self.root, segment)
+
+    def _open_segment(self, date):
+        """
+            当天的段文件写满了或者换了一天就开一个新的段
+            多个进程可能同时往同一个目录里写, 段名里带上进程号和随机串, 用 O_EXCL 创建, 不会写到别人的段里
+        """
+        if self._segment is not None and self._segment.startswith(date) and \
+                self._segment_fp.tell() < self.segment_size:
+            return
+        if self._segment_fp is not None:
+            self._segment_fp.close()
+        os.makedirs(self._segment_path(date), exist_ok=True)
+        segment = f"{date}/{int(time.time())}-{os.getpid()}-{uuid.uuid4().hex[:8]}.seg"
+        fd = os.open(self._segment_path(segment), os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+        self._segment = segment
+        self._segment_fp = os.fdopen(fd, "ab")
+        self._compressor_dict = None
+
+    def _load_dict(self, segment):
+        if segment not in self._dicts:
+            dict_path = self._segment_path(segment) + ".dict"
+            with open(dict_path, "rb") as fp:
+                self._dicts[segment] = fp.read()
+        return self._dicts[segment]
+
+    def put(self, url, html, fetched_at=None):
+        if html is None:
+            return None
+        if isinstance(html, str):
+            html = html.encode("utf-8")
+        fetched_at = fetched_at or time.time()
+        date = datetime.fromtimestamp(fetched_at).strftime("%Y-%m-%d")
+        digest = hashlib.sha1(html).hexdigest()
+        with self._lock:
+            # 多个进程共用一个索引, 整个写入放在一个 IMMEDIATE 事务里: 先拿到写锁再查摘要,
+            # 两个进程不会同时认为内容不存在而各写一份
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                exists = self._conn.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone()
+                if exists is None:
+                    self._open_segment(date)
+                    if self._compressor_dict is None:
+                        # 段里的第一个页面当作这个段的字典, 字典文件只创建一次, 已经有了就报错而不是覆盖
+                        self._compressor_dict = html[:_MAX_DICT_SIZE]
+                        with open(self._segment_path(self._segment) + ".dict", "xb") as fp:
+                            fp.write(self._compressor_dict)
+                        self._dicts[self._segment] = self._compressor_dict
+                    compressor = zlib.compressobj(settings.ARCHIVE_COMPRESS_LEVEL, zdict=self._compressor_dict)
+                    blob = compressor.compress(html) + compressor.flush()
+                    offset = self._segment_fp.tell()
+                    self._segment_fp.write(blob)
+                    self._segment_fp.flush()
+                    self._conn.execute("INSERT OR IGNORE INTO blobs (digest, segment, offset, length) "
+                                       "VALUES (?, ?, ?, ?)", (digest, self._segment, offset, len(blob)))
+                self._conn.execute("INSERT INTO pages (url, fetch_date, fetched_at, digest) VALUES (?, ?, ?, ?)",
+                                   (url, date, fetched_at, digest))
+                self._conn.commit()
+            except:
+                self._conn.rollback()
+                raise
+        return digest
+
+    def _map(self, segment, end):
+        """
+            mmap 整个段文件, 正在写的段变长了就重新映射
+        """
+        mapped = self._maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            if mapped is not None:
+                mapped.close()
+            with open(self._segment_path(segment), "rb") as fp:
+                mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = mapped
+        return mapped
+
+    def get_blob(self, digest):
+        with self._lock:
+            row = self._conn.execute("SELECT segment, offset, length FROM blobs WHERE digest = ?",
+                                     (digest,)).fetchone()
+            if row is None:
+                return None
+            segment, offset, length = row
+            blob = self._map(segment, offset + length)[offset:offset + length]
+            zdict = self._load_dict(segment)
+        return zlib.decompressobj(zdict=zdict).decompress(blob)
+
+    def get(self, url, date=None):
+        """
+            取某个url (某一天) 最后一次抓到的页面
+        """
+        sql = "SELECT digest FROM pages WHERE url = ?"
+        args = [url]
+        if date is not None:
+            sql += " AND fetch_date = ?"
+            args.append(date)
+        with self._lock:
+            row = self._conn.execute(sql + " ORDER BY id DESC LIMIT 1", args).fetchone()
+        return None if row is None else self.get_blob(row[0])
+
+    def iter_pages(self, date, url_prefix="", with_time=False):
+        """
+            按抓取顺序遍历某一天的页面, 同一个url只取最后一次, yield (url, html)
+            with_time 时 yield (url, html, 抓取时间的时间戳)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT url, digest, fetched_at FROM pages WHERE id IN ("
+                "  SELECT MAX(id) FROM pages WHERE fetch_date = ? AND url >= ? AND url < ? GROUP BY url"
+                ") ORDER BY id", (date, url_prefix, url_prefix + "\uffff")).fetchall()
+        for url, digest, fetched_at in rows:
+            if with_time:
+                yield url, self.get_blob(digest), fetched_at
+            else:
+                yield url, self.get_blob(digest)
+
+    def close(self):
+        with self._lock:
+            if self._segment_fp is not None:
+                self._segment_fp.close()
+                self._segment_fp = None
+                self._segment = None
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps = {}
+            self._conn.close()
+
+
+_default_archive = None
+_default_archive_lock = threading.Lock()
+
+
+def get_default_archive():
+    global _default_archive
+    with _default_archive_lock:
+        if _default_archive is None:
+            _default_archive = PageArchive()
+        return _default_archive
+
+
+def archive_page(url, html):
+    """
+        抓取引擎和 selenium 抓到页面之后调用, ARCHIVE_ENABLED 关掉时什么都不做
+    """
+    if not settings.ARCHIVE_ENABLED or html is None:
+        return
+    try:
+        get_default_archive().put(url, html)
+    except Exception as e:
+        logger.error(f"Failed to archive {url}: {e!r}")
+
+
+def replay(crawler, date, archive=None):
+    """
+        离线重放: 把某一天抓到的列表页重新解析并入库, 不访问网络
+        只取带 pg 的列表页, 探测页数用的页面跳过
+        价格历史按页面当时的抓取时间记, 不是重放的时间
+    """
+    from lianjia.writer import BatchWriter
+
+    archive = archive or get_default_archive()
+    n_pages = 0
+    crawler.writer = BatchWriter()
+    try:
+        for url, html, fetched_at in archive.iter_pages(date, url_prefix=crawler.base_url, with_time=True):
+            path = url[len(crawler.base_url):].strip("/").split("/")
+            if len(path) < 2 or not path[1].startswith("pg"):
+                continue
+            try:
+                data = crawler.parse_html(html=html, default_info={"region": path[0]})
+            except Exception as e:
+                logger.error(f"Failed to parse {url}: {e!r}")
+                continue
+            crawler.observed_at = datetime.fromtimestamp(fetched_at)
+            crawler.save_data(data)
+            n_pages += 1
+    finally:
+        crawler.writer.close()
+        crawler.writer = None
+        crawler.observed_at = None
+    logger.info(f"Replayed {n_pages} pages of {crawler.base_url} from {date}")
+    return n_pages
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from lianjia.info_crawlers import LianjiaErShouFangCrawler, LianjiaZuFangCrawler, LianjiaXiaoQuCrawler, \
+        LianjiaChengJiaoCrawler
+
+    crawler_classes = {
+        "ershoufang": LianjiaErShouFangCrawler,
+        "zufang": LianjiaZuFangCrawler,
+        "xiaoqu": LianjiaXiaoQuCrawler,
+        "chengjiao": LianjiaChengJiaoCrawler,
+    }
+    parser = argparse.ArgumentParser(description="重新解析归档里某一天的列表页")
+    parser.add_argument("crawler", choices=sorted(crawler_classes))
+    parser.add_argument("--date", default=datetime.now().strftime("%Y-%m-%d"))
+    parser.add_argument("--city", default=settings.CITY if isinstance(settings.CITY, str) else settings.CITY[0])
+    args = parser.parse_args()
+    replay(crawler_classes[args.crawler](args.city), args.date)
@@ -0,0 +1,130 @@
+import contextlib
+import queue
+import threading
+import time
+
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
+
+import db.settings as settings
+from lianjia.utils import logger
+
+
+class BrowserPool:
+    """
+        可复用的 headless Chrome 池
+        浏览器用到的时候才启动, 用完放回池子; 打开超过 recycle_after 个页面就关掉换一个新的, 防止内存越涨越多
+        min_interval 是所有浏览器合起来两次打开页面的最小间隔, 代替原来每页固定 sleep 的限速作用
+    """
+
+    def __init__(self, size=None, recycle_after=None, timeout=None, min_interval=None):
+        self.size = size or settings.DETAIL_CRAWLER_THREADS
+        self.recycle_after = recycle_after or settings.BROWSER_RECYCLE_PAGES
+        self.timeout = timeout or settings.BROWSER_WAIT_TIMEOUT
+        self.min_interval = settings.BROWSER_MIN_INTERVAL if min_interval is None else min_interval
+
+        self._idle = queue.Queue()
+        self._n_created = 0
+        self._n_pages = {}
+        self._lock = threading.Lock()
+        self._next_request_at = 0.0
+        self._closed = False
+
+    def _create(self):
+        chrome_options = Options()
+        chrome_options.add_argument("--headless")
+        browser = webdriver.Chrome(options=chrome_options)
+        self._n_pages[id(browser)] = 0
+        return browser
+
+    def _quit(self, browser):
+        self._n_pages.pop(id(browser), None)
+        try:
+            browser.quit()
+        except WebDriverException as e:
+            logger.warning(f"Failed to quit browser: {e!r}")
+
+    def _take(self):
+        with self._lock:
+            new_slot = self._idle.empty() and self._n_created < self.size
+            if new_slot:
+                self._n_created += 1
+        browser = None if new_slot else self._idle.get()
+        if browser is None:
+            browser = self._fill_slot()
+        return browser
+
+    def _fill_slot(self):
+        """
+            在一个空名额上启动浏览器, 启动失败就把空名额 (None) 放回池子再把异常抛出去
+            排队等着的线程会拿到这个空名额自己再试一次, 池子不会因为一次启动失败少一个名额
+        """
+        try:
+            return self._create()
+        except:
+            self._idle.put(None)
+            raise
+
+    def _release(self, browser, broken=False):
+        if broken or self._closed or self._n_pages.get(id(browser), 0) >= self.recycle_after:
+            self._quit(browser)
+            if self._closed:
+                return
+            # 新的浏览器留给下一个借的线程启动, 启动失败的异常也由它收到
+            browser = None
+        self._idle.put(browser)
+
+    @contextlib.contextmanager
+    def browser(self):
+        """
+            借一个浏览器, 出了异常就当它坏了, 关掉换新的
+        """
+        browser = self._take()
+        try:
+            yield browser
+        except:
+            self._release(browser, broken=True)
+            raise
+        self._release(browser)
+
+    def _wait_turn(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + self.min_interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def get_page(self, browser, url, ready_selector="#around li[data-index]", container_selector="#around"):
+        """
+            打开页面, 先等 container_selector 出现, 再等 ready_selector 出现, 返回页面的 html
+            周边的容器 #around 是先出来的, 里面的列表是 js 后填进去的, 所以容器出来以后还要等列表项
+            容器都没等到返回 None (通常是被封了或者页面结构变了), 调用方当作失败重试
+            容器在但是列表项一直没出来, 说明周边本来就是空的 (比如附近没有地铁), 照样返回 html
+        """
+        self._wait_turn()
+        browser.get(url)
+        self._n_pages[id(browser)] = self._n_pages.get(id(browser), 0) + 1
+        try:
+            WebDriverWait(browser, self.timeout).until(
+                expected_conditions.presence_of_element_located((By.CSS_SELECTOR, container_selector)))
+        except TimeoutException:
+            logger.warning(f"Timed out waiting for {container_selector} on {url}")
+            return None
+        try:
+            WebDriverWait(browser, self.timeout).until(
+                expected_conditions.presence_of_element_located((By.CSS_SELECTOR, ready_selector)))
+        except TimeoutException:
+            logger.info(f"No {ready_selector} on {url}, treating it as empty")
+        return browser.execute_script("return document.getElementsByTagName('html')[0].innerHTML")
+
+    def close(self):
+        self._closed = True
+        while not self._idle.empty():
+            browser = self._idle.get()
+            if browser is not None:
+                self._quit(browser)
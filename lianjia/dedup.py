@@ -0,0 +1,105 @@
+import hashlib
+import math
+
+import db.settings as settings
+from lianjia.utils import logger
+
+"""
+    一次爬取内的去重
+    过滤器的桶有重叠, 同一个房源经常出现在好几页上, 重复的行在写库之前就丢掉
+"""
+
+
+class BloomFilter:
+    """
+        按 capacity 和 error_rate 算出位数组大小和哈希个数, 用 blake2b 的结果做双重哈希
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.n_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.n_items = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, key):
+        """
+            加入 key, 之前 (可能) 已经加过的返回 False
+        """
+        is_new = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                is_new = True
+        if is_new:
+            self.n_items += 1
+            if self.n_items == self.capacity + 1:
+                logger.warning(f"Bloom filter is over capacity {self.capacity}, false positives will go up")
+        return is_new
+
+
+class SeenSet:
+    """
+        数量少的时候用普通的 set, 精确而且不会误判
+        超过 exact_limit 之后换成 Bloom filter, 内存固定, 有 error_rate 的概率把没见过的误判成见过
+    """
+
+    def __init__(self, exact_limit=None, capacity=None, error_rate=None):
+        self.exact_limit = exact_limit or settings.DEDUP_EXACT_LIMIT
+        self.capacity = capacity or settings.DEDUP_CAPACITY
+        self.error_rate = error_rate or settings.DEDUP_ERROR_RATE
+        self._exact = set()
+        self._bloom = None
+
+    def add(self, key):
+        if self._bloom is not None:
+            return self._bloom.add(key)
+        if key in self._exact:
+            return False
+        self._exact.add(key)
+        if len(self._exact) > self.exact_limit:
+            self._bloom = BloomFilter(max(self.capacity, self.exact_limit * 2), self.error_rate)
+            for k in self._exact:
+                self._bloom.add(k)
+            self._exact = None
+        return True
+
+
+class Deduplicator:
+    """
+        每个 model 一个 SeenSet, 用 model 的主键判断重复
+    """
+
+    def __init__(self):
+        self.seen = {}
+        self.n_rows = {}
+        self.n_duplicates = {}
+
+    @staticmethod
+    def _key(model, row):
+        primary_key = model._meta.primary_key
+        names = primary_key.field_names if hasattr(primary_key, "field_names") else [primary_key.name]
+        return "\x00".join(str(row.get(name)) for name in names)
+
+    def filter(self, model, rows):
+        seen = self.seen.setdefault(model, SeenSet())
+        unique = [row for row in rows if seen.add(self._key(model, row))]
+        self.n_rows[model] = self.n_rows.get(model, 0) + len(rows)
+        self.n_duplicates[model] = self.n_duplicates.get(model, 0) + len(rows) - len(unique)
+        return unique
+
+    def duplicate_rate(self, model):
+        n_rows = self.n_rows.get(model, 0)
+        return self.n_duplicates.get(model, 0) / n_rows if n_rows else 0.0
+
+    def report(self, name):
+        for model, n_rows in self.n_rows.items():
+            logger.info(f"{name} {model._meta.table_name}: dropped {self.n_duplicates[model]} of {n_rows} rows "
+                        f"as duplicates ({self.duplicate_rate(model):.1%})")
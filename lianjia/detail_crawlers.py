@@ -1,15 +1,23 @@
+import datetime
+import heapq
 import threading
 import time
 
 import tqdm
 from bs4 import BeautifulSoup
+from peewee import JOIN
 
-from db.model import HouseInfoModel, database_init, database, SubwayCommunityModel, CommunityModel
-from lianjia.info_crawlers import load_cache, save_cache
-from lianjia.utils import get_html_content, run_with_threads, check_block
+import db.settings as settings
+from db.model import HouseInfoModel, database_init, database, SubwayCommunityModel, CommunityModel, \
+    CommunityDetailStateModel
+from lianjia.archive import archive_page
+from lianjia.browser import BrowserPool
+from lianjia.frontier import Frontier
+from lianjia.info_crawlers import get_cache_file
+from lianjia.normalize import normalize_row
+from lianjia.utils import get_html_content, run_with_threads, check_block, logger
 
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import WebDriverException
 
 """
      由于需要用selenium下载
@@ -95,8 +103,12 @@ class LianjiaXiaoquDetailCrawler:
 
     def __init__(self):
         self.lock_flag = 0
+        self.stats = {"static": 0, "browser": 0, "failed": 0}
+        self._stats_lock = threading.Lock()
+        # 这次运行里基本信息已经写进库的小区, 重试的时候只需要再用浏览器补周边
+        self._info_saved = set()
 
-    def parse_html(self, html, default_info=None, default_subway_info=None):
+    def parse_html(self, html, default_info=None, default_subway_info=None, rendered=False):
         if default_subway_info is None:
             default_subway_info = {}
 
@@ -127,9 +139,14 @@ class LianjiaXiaoquDetailCrawler:
             except:
                 continue
 
-        # 周边
+        # 周边, 是 js 渲染出来的, 静态页面里拿不到的时候返回 None
+        # 浏览器渲染过的页面 (rendered) 容器在但没有列表项, 说明周边本来就是空的, 返回空列表
         around_section = soup.find("div", {"id": "around"})
+        if around_section is None:
+            return community_detail_info, None
         subway_sections = around_section.findAll("li", {"data-index": True})
+        if not subway_sections:
+            return community_detail_info, [] if rendered else None
         for subway_section in subway_sections:
             if "subway" in subway_section.get("data-index"):
                 try:
@@ -146,49 +163,170 @@ class LianjiaXiaoquDetailCrawler:
                     continue
         return community_detail_info, subway_data_source
 
-    def get_community_detail(self):
-        candidate_urls = load_cache("xiaoqu", "detail")
-        if candidate_urls is None:
-            candidate_urls = [r['link'] for r in CommunityModel.select().dicts()]
-            save_cache("xiaoqu", "detail", candidate_urls)
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
 
-        n_total = len(candidate_urls)
+    def _get_detail_with_browser(self, url, community_id, pool):
+        try:
+            with pool.browser() as browser:
+                html = pool.get_page(browser, url)
+        except WebDriverException as e:
+            logger.error(f"Browser failed on {url}: {e!r}")
+            return None
+        if html is None:
+            return None
+        archive_page(url, html)
+        return self.parse_html(html=html, default_subway_info={"community_id": community_id}, rendered=True)
+
+    def get_detail(self, url, community_id, pool):
+        """
+            先用普通的 http 请求拿静态页面, 基本信息和周边的地铁都解析到了就不用开浏览器
+            缺哪部分再用浏览器渲染补哪部分, 返回 (基本信息, 地铁), 拿不到的部分是 None
+            基本信息这次运行里已经存过的小区不再请求静态页面, 只用浏览器补周边
+        """
+        community_info, subway_data_source = None, None
+        if settings.DETAIL_STATIC_FIRST and community_id not in self._info_saved:
+            html = get_html_content(url)
+            if html is not None:
+                static_result = self.parse_html(html=html, default_subway_info={"community_id": community_id})
+                if static_result is not None:
+                    community_info, subway_data_source = static_result
+        has_info = bool(community_info) or community_id in self._info_saved
+        if has_info and subway_data_source is not None:
+            self._count("static")
+            return community_info or None, subway_data_source
+
+        browser_result = self._get_detail_with_browser(url, community_id, pool)
+        if browser_result is not None:
+            if not has_info:
+                community_info = browser_result[0]
+            if subway_data_source is None:
+                subway_data_source = browser_result[1]
+        # 渲染完了还是没有周边的列表, 当作失败留给 frontier 重试, 不要把空的地铁信息当成结果
+        self._count("failed" if subway_data_source is None else "browser")
+        return community_info or None, subway_data_source
+
+    def report(self):
+        n_total = sum(self.stats.values())
+        if n_total == 0:
+            return
+        logger.info(f"Community detail: {self.stats['static']} static, {self.stats['browser']} browser, "
+                    f"{self.stats['failed']} failed, static hit rate {self.stats['static'] / n_total:.1%}")
+
+    def get_community_detail(self, n_threads=None, top_n=None, time_budget=None):
+        """
+            增量刷新小区详情: 只刷新 rank_stale_communities 排出来的前 top_n 个, 超过 time_budget 秒就停下
+            没做完的留在 frontier 里, 当天再跑会接着做
+        """
+        if n_threads is None:
+            n_threads = settings.DETAIL_CRAWLER_THREADS
+        if time_budget is None:
+            time_budget = settings.DETAIL_REFRESH_BUDGET
+        frontier = Frontier(get_cache_file("xiaoqu", "detail", "frontier") + ".sqlite")
+        if not frontier.is_seeded():
+            frontier.seed(rank_stale_communities(top_n))
+        # 当天的详情 frontier 只有这一个进程在用, 上次中断留下的 in_flight 直接放回 pending
+        frontier.recover(lease=0)
+
+        n_total = frontier.counts()[Frontier.PENDING]
         progress_bar = tqdm.tqdm(total=n_total + 1)
-        lock = threading.Lock()
-        self.lock_flag = 0
+        deadline = time.monotonic() + time_budget
+
+        pool = BrowserPool(size=n_threads)
 
         def _t():
-            chrome_options = Options()
-            chrome_options.add_argument("--headless")
-            browser = webdriver.Chrome(options=chrome_options)
-
-            while len(candidate_urls) > 0:
-                url = candidate_urls.pop(0)
-                if url[-1] == "/":
-                    url = url[:-1]
-                progress_bar.update(1)
-                community_id = url.split("/")[-1].split(".")[0]
-                browser.get(url)
-                time.sleep(5)
-                html = browser.execute_script("return document.getElementsByTagName('html')[0].innerHTML")
-                community_info, subway_data_source = self.parse_html(html=html,
-                                                                     default_subway_info={"community_id": community_id})
-                with database.atomic():
-                    if subway_data_source:
-                        SubwayCommunityModel.insert_many(subway_data_source).on_conflict_replace().execute()
+            # 每个线程从连接池里拿自己的连接, 线程结束时还回去
+            with database.connection_context():
+                while time.monotonic() < deadline:
+                    claimed = frontier.claim(1)
+                    if not claimed:
+                        break
+                    claimed_url = claimed[0]
+                    url = claimed_url
+                    if url[-1] == "/":
+                        url = url[:-1]
+                    progress_bar.update(1)
+                    community_id = url.split("/")[-1].split(".")[0]
+                    community_info, subway_data_source = self.get_detail(url, community_id, pool)
+                    # 拿到的部分先存下来, 周边没拿到的重新排队, 重试时只补周边
+                    with database.atomic():
+                        if subway_data_source:
+                            SubwayCommunityModel.insert_many(subway_data_source).on_conflict_replace().execute()
+                        if community_info:
+                            CommunityModel.update(normalize_row(CommunityModel, {**community_info})).where(
+                                CommunityModel.id == community_id).execute()
+                        if subway_data_source is not None:
+                            mark_community_refreshed(community_id)
                     if community_info:
-                        CommunityModel.update({**community_info}).where(
-                            CommunityModel.id == community_id).execute()
-                lock.acquire()
-                self.lock_flag += 1
-                if self.lock_flag % 10 == 0:
-                    # 每10个保存一次
-                    save_cache("xiaoqu", "detail", candidate_urls)
-                lock.release()
-                time.sleep(1)
-
-        run_with_threads(_t, 1)
+                        self._info_saved.add(community_id)
+                    if subway_data_source is None:
+                        frontier.fail(claimed_url)
+                        continue
+                    frontier.complete(claimed_url)
+            frontier.close()
+
+        try:
+            run_with_threads(_t, n_threads)
+        finally:
+            pool.close()
+            self.report()
+        if time.monotonic() >= deadline:
+            logger.info(f"Time budget of {time_budget}s used up, {frontier.counts()[Frontier.PENDING]} left for next run")
+
 
+def _to_int(value):
+    try:
+        return int(value)
+    except:
+        return None
+
+
+def rank_stale_communities(top_n=None, now=None):
+    """
+        按详情的陈旧程度给小区排序, 返回最该刷新的 top_n 个小区的 link
+        分数 = 距离上次刷新的天数 + DETAIL_ACTIVITY_WEIGHT * (在售套数的变化 + 在租套数的变化)
+        从来没刷新过的排在最前面
+    """
+    top_n = top_n or settings.DETAIL_REFRESH_TOP_N
+    now = now or datetime.datetime.now()
+    query = (CommunityModel
+             .select(CommunityModel.link, CommunityModel.on_sale, CommunityModel.on_rent,
+                     CommunityDetailStateModel.detail_updated_at,
+                     CommunityDetailStateModel.on_sale.alias("last_on_sale"),
+                     CommunityDetailStateModel.on_rent.alias("last_on_rent"))
+             .join(CommunityDetailStateModel, JOIN.LEFT_OUTER,
+                   on=(CommunityModel.id == CommunityDetailStateModel.community_id))
+             .dicts())
+
+    def _score(row):
+        if row["detail_updated_at"] is None:
+            return float("inf")
+        age = (now - row["detail_updated_at"]).total_seconds() / 86400
+        activity = 0
+        for current, last in ((row["on_sale"], row["last_on_sale"]), (row["on_rent"], row["last_on_rent"])):
+            current = _to_int(current)
+            if current is not None and last is not None:
+                activity += abs(current - last)
+        return age + settings.DETAIL_ACTIVITY_WEIGHT * activity
+
+    rows = heapq.nlargest(top_n, query, key=_score)
+    logger.info(f"Picked {len(rows)} communities to refresh")
+    return [row["link"] for row in rows]
+
+
+def mark_community_refreshed(community_id):
+    """
+        记下刷新时间和当时的在售 / 在租套数, 下次排序时和最新的列表页数据比较
+    """
+    community = CommunityModel.select(CommunityModel.on_sale, CommunityModel.on_rent).where(
+        CommunityModel.id == community_id).first()
+    CommunityDetailStateModel.insert(
+        community_id=community_id,
+        detail_updated_at=datetime.datetime.now(),
+        on_sale=_to_int(community.on_sale) if community else None,
+        on_rent=_to_int(community.on_rent) if community else None,
+    ).on_conflict_replace().execute()
 
 if __name__ == '__main__':
     database_init()
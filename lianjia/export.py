@@ -0,0 +1,295 @@
+import argparse
+import datetime
+import json
+import os
+from collections import OrderedDict
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc
+import pyarrow.parquet as pq
+from peewee import (JOIN, MySQLDatabase, BigIntegerField, IntegerField, FloatField, DateTimeField, DateField,
+                    AutoField, BooleanField)
+
+import db.settings as settings
+from db.model import database, database_init, CommunityModel, HouseInfoModel, SellInfoModel, RentInfoModel, \
+    HistoricalPriceModel, PriceHistoryModel, SubwayCommunityModel
+from lianjia.utils import logger
+
+"""
+    把表导出成 Parquet 或者 Arrow IPC 文件给下游用, 不用再对着爬虫在写的库做整表的 select
+    每张表一条查询, 用服务端游标 (MySQL 的 SSCursor) 按 chunk_size 分块取, 内存里最多只有一块数据
+    按 城市 / 区域 / 爬取日期 分区, 目录是 hive 的格式:
+        <output>/house_info/city=sh/region=pudong/crawl_date=2026-10-18/part-20261018T150000-0000.parquet
+    分区的值从 link 的域名 (城市), region 列和每张表的更新时间列 (爬取日期) 来
+    没有这些列的表 (价格历史, 小区地铁) join 房源 / 小区取
+
+    --incremental 只导出更新时间在上次导出之后的行, 上次导出到哪里记在 <output>/_export_state.json
+    为了不漏掉导出时正在写的行, 每次会和上一次重叠 EXPORT_OVERLAP 秒, 下游按主键去重
+    小区地铁表没有更新时间, 每次都全量导出
+
+    python -m lianjia.export
+    python -m lianjia.export --incremental --format arrow --tables house_info sell_info
+"""
+
+STATE_FILE = "_export_state.json"
+
+_CITY = r"^https?://(?P<city>[a-z]+)\.lianjia\.com"
+
+
+class ExportSpec:
+    """
+        一张表怎么导出: 更新时间列 (增量导出和爬取日期用), 分区列从哪里来
+        link 和 region 在别的表上的时候给出要 join 的 model 和连接条件
+    """
+
+    def __init__(self, model, changed_at=None, join=None, on=None):
+        self.model = model
+        self.changed_at = changed_at
+        self.join = join
+        self.on = on
+
+    @property
+    def name(self):
+        return self.model._meta.table_name
+
+    def partition_fields(self):
+        source = self.join or self.model
+        changed_at = self.changed_at or source.valid_date
+        return [source.link.alias("_link"), source.region.alias("_region"), changed_at.alias("_changed_at")]
+
+    def query(self, since=None):
+        fields = self.model._meta.sorted_fields
+        query = self.model.select(*fields, *self.partition_fields())
+        if self.join is not None:
+            query = query.join_from(self.model, self.join, JOIN.LEFT_OUTER, on=self.on)
+        if since is not None and self.changed_at is not None:
+            query = query.where(self.changed_at > since)
+        return query
+
+
+EXPORTS = OrderedDict((spec.name, spec) for spec in [
+    ExportSpec(CommunityModel, CommunityModel.valid_date),
+    ExportSpec(HouseInfoModel, HouseInfoModel.valid_date),
+    ExportSpec(SellInfoModel, SellInfoModel.update_date),
+    ExportSpec(RentInfoModel, RentInfoModel.update_date),
+    ExportSpec(HistoricalPriceModel, HistoricalPriceModel.date, join=HouseInfoModel,
+               on=(HistoricalPriceModel.house_id == HouseInfoModel.house_id)),
+    ExportSpec(PriceHistoryModel, PriceHistoryModel.last_observed_at, join=HouseInfoModel,
+               on=(PriceHistoryModel.house_id == HouseInfoModel.house_id)),
+    ExportSpec(SubwayCommunityModel, join=CommunityModel,
+               on=(SubwayCommunityModel.community_id == CommunityModel.id)),
+])
+
+
+def arrow_type(field):
+    if isinstance(field, (BigIntegerField, IntegerField, AutoField)):
+        return pa.int64()
+    if isinstance(field, FloatField):
+        return pa.float64()
+    if isinstance(field, BooleanField):
+        return pa.bool_()
+    if isinstance(field, DateTimeField):
+        return pa.timestamp("us")
+    if isinstance(field, DateField):
+        return pa.date32()
+    return pa.string()
+
+
+def arrow_schema(model):
+    return pa.schema([pa.field(field.column_name, arrow_type(field)) for field in model._meta.sorted_fields])
+
+
+def to_array(values, type_):
+    """
+        sqlite 把日期时间存成文本, 先按字符串读进来再让 arrow 转换
+    """
+    try:
+        return pa.array(values, type=type_)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pc.cast(pa.array([None if value is None else str(value) for value in values], type=pa.string()),
+                       type_)
+
+
+def open_cursor():
+    """
+        MySQL 默认的游标会把结果全部取到客户端, 用 SSCursor 边读边取
+    """
+    connection = database.connection()
+    if isinstance(database, MySQLDatabase):
+        import MySQLdb.cursors
+        return connection.cursor(MySQLdb.cursors.SSCursor)
+    return connection.cursor()
+
+
+def iter_chunks(spec, since=None, chunk_size=None):
+    """
+        按块返回 (数据的 arrow Table, 分区键的数组)
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    schema = arrow_schema(spec.model)
+    sql, params = spec.query(since).sql()
+    cursor = open_cursor()
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            n_fields = len(schema)
+            table = pa.Table.from_arrays(
+                [to_array(values, field.type) for values, field in zip(columns[:n_fields], schema)], schema=schema)
+            link, region, changed_at = columns[n_fields:]
+            yield table, partition_keys(link, region, changed_at)
+    finally:
+        cursor.close()
+
+
+def _clean(array):
+    array = pc.fill_null(array, "unknown")
+    array = pc.replace_substring(array, "/", "_")
+    return pc.if_else(pc.equal(array, ""), "unknown", array)
+
+
+def partition_keys(link, region, changed_at):
+    city = pc.struct_field(pc.extract_regex(pa.array(link, type=pa.string()), _CITY), "city")
+    crawl_date = pc.strftime(to_array(changed_at, pa.timestamp("us")), format="%Y-%m-%d")
+    return pc.binary_join_element_wise(
+        pc.binary_join_element_wise("city=", _clean(city), ""),
+        pc.binary_join_element_wise("region=", _clean(pa.array(region, type=pa.string())), ""),
+        pc.binary_join_element_wise("crawl_date=", _clean(crawl_date), ""),
+        "/")
+
+
+class PartitionedWriter:
+    """
+        每个分区一个打开的文件, 一块数据按分区拆开追加到各自的文件里
+        同时打开的文件最多 max_open_files 个, 超过时关掉最久没写的, 之后再写这个分区就开一个新的 part 文件
+        文件先写成 .tmp, close 的时候才改名, 导出失败时 abort 删掉这次写的所有文件
+    """
+
+    def __init__(self, root, schema, export_id, file_format=None, max_open_files=None):
+        self.root = root
+        self.schema = schema
+        self.export_id = export_id
+        self.file_format = file_format or settings.EXPORT_FORMAT
+        self.max_open_files = max_open_files or settings.EXPORT_MAX_OPEN_FILES
+        self._writers = OrderedDict()
+        self._n_parts = 0
+        self.paths = []
+        self.n_rows = 0
+
+    def _open(self, partition):
+        directory = os.path.join(self.root, partition)
+        os.makedirs(directory, exist_ok=True)
+        suffix = "parquet" if self.file_format == "parquet" else "arrow"
+        path = os.path.join(directory, f"part-{self.export_id}-{self._n_parts:04d}.{suffix}")
+        self._n_parts += 1
+        if self.file_format == "parquet":
+            writer = pq.ParquetWriter(path + ".tmp", self.schema, compression="zstd")
+        else:
+            writer = pa.ipc.new_file(path + ".tmp", self.schema)
+        self.paths.append(path)
+        return path, writer
+
+    def _close_one(self, partition):
+        path, writer = self._writers.pop(partition)
+        writer.close()
+        os.replace(path + ".tmp", path)
+
+    def write(self, table, keys):
+        for partition in pc.unique(keys).to_pylist():
+            part = table.filter(pc.equal(keys, partition))
+            if partition in self._writers:
+                self._writers.move_to_end(partition)
+            else:
+                if len(self._writers) >= self.max_open_files:
+                    self._close_one(next(iter(self._writers)))
+                self._writers[partition] = self._open(partition)
+            self._writers[partition][1].write_table(part)
+        self.n_rows += len(table)
+
+    def close(self):
+        while self._writers:
+            self._close_one(next(iter(self._writers)))
+
+    def abort(self):
+        for path, writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+        for path in self.paths:
+            for name in (path, path + ".tmp"):
+                if os.path.exists(name):
+                    os.remove(name)
+
+
+def load_state(root):
+    try:
+        with open(os.path.join(root, STATE_FILE)) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(root, state):
+    path = os.path.join(root, STATE_FILE)
+    with open(path + ".tmp", "w") as fp:
+        json.dump(state, fp, indent=2, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def export_table(spec, root, export_id, since=None, file_format=None, chunk_size=None):
+    writer = PartitionedWriter(os.path.join(root, spec.name), arrow_schema(spec.model), export_id, file_format)
+    try:
+        for table, keys in iter_chunks(spec, since, chunk_size):
+            writer.write(table, keys)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.n_rows, len(writer.paths)
+
+
+def export(root=None, tables=None, incremental=False, file_format=None, chunk_size=None):
+    """
+        导出 tables 里的表 (默认全部), 返回 {表名: 行数}
+    """
+    root = root or settings.EXPORT_DIR
+    os.makedirs(root, exist_ok=True)
+    state = load_state(root)
+    started_at = datetime.datetime.now()
+    export_id = started_at.strftime("%Y%m%dT%H%M%S")
+    result = {}
+    for name in tables or list(EXPORTS):
+        spec = EXPORTS[name]
+        since = None
+        if incremental and spec.changed_at is not None and name in state:
+            since = datetime.datetime.fromisoformat(state[name]["watermark"])
+        n_rows, n_files = export_table(spec, root, export_id, since, file_format, chunk_size)
+        logger.info(f"Exported {n_rows} rows of {name} into {n_files} files"
+                    + (f" (changed since {since})" if since is not None else ""))
+        # 导出开始之前写进去但还没提交的行时间戳会早于 started_at, 留一段重叠
+        watermark = started_at - datetime.timedelta(seconds=settings.EXPORT_OVERLAP)
+        state[name] = {"watermark": watermark.isoformat(), "export_id": export_id, "rows": n_rows}
+        save_state(root, state)
+        result[name] = n_rows
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把表按 城市 / 区域 / 爬取日期 分区导出成 Parquet 或 Arrow")
+    parser.add_argument("--tables", nargs="+", choices=list(EXPORTS), default=list(EXPORTS))
+    parser.add_argument("--output", default=settings.EXPORT_DIR)
+    parser.add_argument("--format", choices=["parquet", "arrow"], default=settings.EXPORT_FORMAT)
+    parser.add_argument("--incremental", action="store_true", help="只导出上次导出之后有变化的行")
+    parser.add_argument("--chunk-size", type=int, default=settings.EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    database_init()
+    with database.connection_context():
+        export(args.output, args.tables, args.incremental, args.format, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
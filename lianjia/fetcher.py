@@ -0,0 +1,211 @@
+import asyncio
+import collections
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import db.settings as settings
+from lianjia.archive import archive_page
+from lianjia.http_cache import HttpCache
+from lianjia.throttle import HostThrottle, classify, OK, RETRYABLE
+from lianjia.utils import hds, logger
+
+
+class TokenBucket:
+    """
+        令牌桶限速, 替代原来每页固定的 time.sleep(1)
+        rate 是每秒补充的令牌数, capacity 是允许的突发请求数
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class AsyncFetcher:
+    """
+        基于 asyncio 的抓取引擎
+        所有请求共享一个 aiohttp 连接池, 每个 host 有自己的并发上限和令牌桶
+        事件循环跑在后台线程里, 所以同步的爬虫代码也可以直接调用
+    """
+
+    def __init__(self, concurrency_per_host=None, rate_per_host=None, burst=None, timeout=None, cache=None):
+        self.concurrency_per_host = concurrency_per_host or settings.FETCH_CONCURRENCY_PER_HOST
+        self.rate_per_host = rate_per_host or settings.FETCH_RATE_PER_HOST
+        self.burst = burst
+        self.timeout = timeout or settings.FETCH_TIMEOUT
+        # 顺序返回结果时最多提前提交的请求数
+        self.window = self.concurrency_per_host * 2
+        self.cache = cache
+
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._throttles = {}
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.concurrency_per_host)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def _get_throttle(self, host):
+        if host not in self._throttles:
+            bucket = TokenBucket(self.rate_per_host, self.burst)
+            self._throttles[host] = HostThrottle(host, bucket, self.concurrency_per_host)
+        return self._throttles[host]
+
+    async def _request(self, url, headers, throttle):
+        """
+            发一次请求, 返回 (状态码, 最终的url, 内容, 响应头), 请求失败时状态码是 None
+        """
+        await throttle.wait()
+        async with throttle.limit:
+            await throttle.bucket.acquire()
+            try:
+                async with self._get_session().get(url, headers=headers) as response:
+                    return response.status, response.url, await response.read(), response.headers
+            except Exception as e:
+                logger.error(f"Failed to fetch {url}: {e!r}")
+                return None, url, None, {}
+
+    async def _fetch(self, url, max_age=0):
+        loop = asyncio.get_running_loop()
+        cached = None
+        if self.cache is not None:
+            cached = await loop.run_in_executor(None, self.cache.lookup, url, max_age)
+            # 缓存命中的页面也是这次抓到的页面, 同样要进归档, 归档按内容去重, 只多记一行
+            if cached is not None and cached.fresh:
+                await loop.run_in_executor(None, archive_page, url, cached.body)
+                return cached.body
+
+        headers = dict(random.choice(hds))
+        if cached is not None:
+            headers.update(cached.validators())
+        throttle = self._get_throttle(urlsplit(url).netloc)
+        # 被封 / 验证码 / 5xx 的页面不能当成正常页面交给解析, 减速之后重试, 都失败了返回 None,
+        # 由调用方 (frontier.fail) 重新排队
+        for attempt in range(settings.THROTTLE_MAX_RETRIES + 1):
+            status, final_url, html, response_headers = await self._request(url, headers, throttle)
+            if status == 304 and cached is not None:
+                await throttle.record(OK)
+                await loop.run_in_executor(None, self.cache.revalidated, url)
+                await loop.run_in_executor(None, archive_page, url, cached.body)
+                return cached.body
+            kind = classify(status, final_url, html)
+            await throttle.record(kind)
+            if kind not in RETRYABLE:
+                break
+            logger.warning(f"{url}: {kind} (attempt {attempt + 1})")
+        else:
+            return None
+        if kind != OK:
+            logger.warning(f"{url}: {kind} ({status})")
+            return None
+        # 归档和写缓存都要写盘, 放到线程池里做, 不卡事件循环
+        await loop.run_in_executor(None, archive_page, url, html)
+        if self.cache is not None and status == 200:
+            etag, last_modified = response_headers.get("ETag"), response_headers.get("Last-Modified")
+            # 只缓存用得上的: 探测页 (max_age > 0) 和能发条件请求的页面, 已经缓存过的也要更新
+            # 普通的列表页已经在归档里了, 再存一份只会多写一次盘, 还会把探测页挤出缓存
+            if max_age > 0 or etag or last_modified or cached is not None:
+                await loop.run_in_executor(None, self.cache.store, url, html, etag, last_modified,
+                                           cached is not None)
+        return html
+
+    def submit(self, url, max_age=0):
+        """
+            提交一个请求, 返回 concurrent.futures.Future
+            max_age 秒以内缓存过的页面直接用缓存, 不发请求
+        """
+        return asyncio.run_coroutine_threadsafe(self._fetch(url, max_age), self._ensure_loop())
+
+    def get(self, url, max_age=0):
+        return self.submit(url, max_age).result()
+
+    def get_many(self, urls):
+        """
+            并发抓取一组 url, 按输入顺序返回 html 列表
+        """
+        futures = [self.submit(url) for url in urls]
+        return [future.result() for future in futures]
+
+    def fetch(self, urls):
+        """
+            按输入顺序逐个 yield (url, html)
+            同时在后台保持最多 window 个请求在飞, 消费者处理慢的时候不会无限制地堆积
+        """
+        pending = collections.deque()
+        try:
+            for url in urls:
+                pending.append((url, self.submit(url)))
+                if len(pending) >= self.window:
+                    url, future = pending.popleft()
+                    yield url, future.result()
+            while pending:
+                url, future = pending.popleft()
+                yield url, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    def close(self):
+        for throttle in self._throttles.values():
+            throttle.report()
+        if self.cache is not None:
+            self.cache.report()
+        if self._loop is None:
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+            self._session = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+        self._throttles = {}
+
+
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+
+def get_default_fetcher():
+    """
+        所有爬虫默认共享同一个抓取引擎, 这样连接池和每个 host 的限速是全局的
+    """
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = AsyncFetcher(cache=HttpCache() if settings.HTTP_CACHE_ENABLED else None)
+        return _default_fetcher
@@ -0,0 +1,137 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+import db.settings as settings
+
+
+class Frontier:
+    """
+        持久化的待爬队列, 用 sqlite 存, 替代原来每爬一页就整个重写一遍的 url 缓存文件
+        每个 url 有状态 pending / in_flight / done / failed 和重试次数
+        claim / complete / fail 都只改动涉及的那几行, 多个线程或者进程可以同时从同一个文件里领任务
+    """
+    PENDING = "pending"
+    IN_FLIGHT = "in_flight"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, path, max_retries=None):
+        self.path = path
+        self.max_retries = max_retries if max_retries is not None else settings.FRONTIER_MAX_RETRIES
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS urls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL UNIQUE,
+                state TEXT NOT NULL DEFAULT 'pending',
+                retries INTEGER NOT NULL DEFAULT 0,
+                claimed_at REAL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS urls_state ON urls (state, id)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _connection(self):
+        # sqlite 的连接不能跨线程用, 每个线程一个
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE 直接拿写锁, 多个进程同时 claim 不会领到同一个url
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def is_seeded(self):
+        row = self._connection().execute("SELECT value FROM meta WHERE key = 'seeded'").fetchone()
+        return row is not None
+
+    def seed(self, urls):
+        """
+            写入全部候选url并打上标记, 同一个文件重复打开时不会再重新生成候选url
+        """
+        with self._transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO urls (url) VALUES (?)", ((url,) for url in urls))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seeded', ?)", (str(time.time()),))
+
+    def add(self, urls):
+        with self._transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO urls (url) VALUES (?)", ((url,) for url in urls))
+
+    def claim(self, n=1):
+        """
+            领取最多 n 个 pending 的url, 标记为 in_flight
+        """
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, url FROM urls WHERE state = ? ORDER BY id LIMIT ?", (self.PENDING, n)).fetchall()
+            conn.executemany(
+                "UPDATE urls SET state = ?, claimed_at = ? WHERE id = ?",
+                ((self.IN_FLIGHT, time.time(), row_id) for row_id, _ in rows))
+        return [url for _, url in rows]
+
+    def iter_claims(self, batch_size=None):
+        """
+            一批一批地领取, 直到没有 pending 的url
+        """
+        batch_size = batch_size or settings.FRONTIER_CLAIM_BATCH
+        while True:
+            urls = self.claim(batch_size)
+            if not urls:
+                return
+            yield from urls
+
+    def complete(self, urls):
+        if isinstance(urls, str):
+            urls = [urls]
+        with self._transaction() as conn:
+            conn.executemany("UPDATE urls SET state = ? WHERE url = ?", ((self.DONE, url) for url in urls))
+
+    def fail(self, url):
+        """
+            失败的url重新排队, 超过 max_retries 次就标记为 failed
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE urls SET retries = retries + 1, state = CASE WHEN retries + 1 >= ? THEN ? ELSE ? END "
+                "WHERE url = ?", (self.max_retries, self.FAILED, self.PENDING, url))
+
+    def recover(self, lease=None):
+        """
+            租约过期 (领取超过 lease 秒还没完成) 的 in_flight url放回 pending, 通常是上次运行中断留下的
+            别的进程刚领走, 还在爬的url不动, 否则会被爬两遍
+        """
+        lease = settings.FRONTIER_LEASE_TIMEOUT if lease is None else lease
+        with self._transaction() as conn:
+            n = conn.execute(
+                "UPDATE urls SET state = ? WHERE state = ? AND claimed_at <= ?",
+                (self.PENDING, self.IN_FLIGHT, time.time() - lease)).rowcount
+        return n
+
+    def counts(self):
+        result = {self.PENDING: 0, self.IN_FLIGHT: 0, self.DONE: 0, self.FAILED: 0}
+        for state, n in self._connection().execute("SELECT state, COUNT(*) FROM urls GROUP BY state"):
+            result[state] = n
+        return result
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
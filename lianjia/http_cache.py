@@ -0,0 +1,165 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import db.settings as settings
+from lianjia.utils import logger
+
+
+class CachedResponse:
+
+    def __init__(self, body, etag, last_modified, fresh):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh = fresh
+
+    def validators(self):
+        """
+            条件请求用的请求头
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class HttpCache:
+    """
+        本地的 http 响应缓存
+        页面内容按 url 的 sha1 存成文件, 索引 (ETag / Last-Modified / 存入时间 / 最后使用时间 / 大小) 放在 sqlite 里
+        max_age 之内的缓存直接返回, 过期的带上 ETag / Last-Modified 发条件请求, 304 就继续用缓存
+        总大小超过 max_bytes 时按最后使用时间淘汰
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or settings.HTTP_CACHE_DIR
+        self.max_bytes = max_bytes or settings.HTTP_CACHE_MAX_BYTES
+        os.makedirs(self.root, exist_ok=True)
+        self.stats = {"hit": 0, "revalidated": 0, "changed": 0, "miss": 0}
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(self.root, "index.sqlite"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                stored_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_used_at ON entries (used_at)")
+        self._conn.commit()
+        self.total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def _path(self, url):
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def lookup(self, url, max_age=0):
+        """
+            没有缓存返回 None; 有的话返回 CachedResponse, 存入时间在 max_age 秒以内的 fresh 为 True
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified, stored_at FROM entries WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, stored_at = row
+        try:
+            with open(self._path(url), "rb") as fp:
+                body = fp.read()
+        except FileNotFoundError:
+            self._delete(url)
+            return None
+        fresh = max_age > 0 and time.time() - stored_at < max_age
+        if fresh:
+            self._count("hit")
+            self._touch(url, refresh=False)
+        return CachedResponse(body, etag, last_modified, fresh)
+
+    def _touch(self, url, refresh):
+        now = time.time()
+        with self._lock:
+            if refresh:
+                self._conn.execute("UPDATE entries SET stored_at = ?, used_at = ? WHERE url = ?", (now, now, url))
+            else:
+                self._conn.execute("UPDATE entries SET used_at = ? WHERE url = ?", (now, url))
+            self._conn.commit()
+
+    def revalidated(self, url):
+        """
+            服务器返回 304, 缓存重新算作新鲜的
+        """
+        self._count("revalidated")
+        self._touch(url, refresh=True)
+
+    def store(self, url, body, etag=None, last_modified=None, revalidation=False):
+        """
+            revalidation 为 True 表示发了条件请求但页面变了 (返回 200), 单独计为 changed, 不算 miss
+        """
+        self._count("changed" if revalidation else "miss")
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(body)
+        os.replace(path + ".tmp", path)
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM entries WHERE url = ?", (url,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (url, etag, last_modified, stored_at, used_at, size) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (url, etag, last_modified, now, now, len(body)))
+            self._conn.commit()
+            self.total_bytes += len(body) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def _delete(self, url):
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM entries WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return
+            self._conn.execute("DELETE FROM entries WHERE url = ?", (url,))
+            self._conn.commit()
+            self.total_bytes -= row[0]
+        try:
+            os.remove(self._path(url))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """
+            按最后使用时间从旧到新淘汰, 直到总大小降到 max_bytes 的 90%
+        """
+        target = self.max_bytes * 0.9
+        with self._lock:
+            n_evicted = 0
+            for url, size in self._conn.execute("SELECT url, size FROM entries ORDER BY used_at").fetchall():
+                if self.total_bytes <= target:
+                    break
+                self._delete(url)
+                n_evicted += 1
+        logger.debug(f"Evicted {n_evicted} cached pages, {self.total_bytes} bytes left")
+
+    def hit_rate(self):
+        n_total = sum(self.stats.values())
+        return (self.stats["hit"] + self.stats["revalidated"]) / n_total if n_total else 0.0
+
+    def report(self):
+        logger.info(f"HTTP cache: {self.stats['hit']} hits, {self.stats['revalidated']} revalidated, "
+                    f"{self.stats['changed']} changed, {self.stats['miss']} misses, "
+                    f"hit rate {self.hit_rate():.1%}, {self.total_bytes} bytes cached")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,16 +1,28 @@
+import json
 import os
-import time
+import re
 import traceback
 import urllib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from shutil import copyfile
 
 from bs4 import BeautifulSoup
 from tqdm import tqdm
 
-from db.model import database, HouseInfoModel, HistoricalPriceModel, database_init, RentInfoModel, CommunityModel, \
+import db.settings as settings
+from db.model import database, HouseInfoModel, PriceHistoryModel, RentInfoModel, CommunityModel, \
     SellInfoModel
-from lianjia.utils import get_html_content, logger, check_block
+from lianjia import parsers
+from lianjia.dedup import Deduplicator
+from lianjia.fetcher import get_default_fetcher
+from lianjia.frontier import Frontier
+from lianjia.normalize import normalize_rows
+from lianjia.pipeline import CrawlPipeline
+from lianjia.planner import FilterPlanner
+from lianjia.utils import logger, check_block, make_url, strip_list
+from lianjia.writer import BatchWriter, insert_rows
+
+_PAGE_IN_URL = re.compile(r"/pg(\d+)")
 
 ER_SHOU_FANG_PRICE_FILTERS = [f"p{i}" for i in range(1, 8)]
 ER_SHOU_FANG_ROOM_FILTERS = [f"l{i}" for i in range(1, 7)]
@@ -43,73 +55,352 @@ CHENG_JIAO_FILTERS = [
 ]
 
 
-def make_url(base_url, region, parameters):
-    return base_url + "{region}/{parameters}/".format(
-        region=region, parameters="".join(parameters)
-    ).replace("//", "/")
-
-
-def strip_list(content_list):
-    for i, raw_content in enumerate(content_list):
-        while "  " in raw_content:
-            raw_content = raw_content.replace("  ", " ")
-        content_list[i] = raw_content.strip()
-
-
-def load_cache(prefix, region):
-    date = datetime.now().strftime("%Y-%m-%d")
-    cache_file = f"../.cache/{date}_{prefix}_url_candidates_{region}"
-    if os.path.exists(cache_file):
-        with open(cache_file, "r") as fp:
-            candidate_urls = [line.strip() for line in fp.readlines()]
-        return candidate_urls
-    return None
-
-
-def save_cache(prefix, region, cache):
+def get_cache_file(prefix, region, name="url_candidates", city=None):
+    # 多个城市可能有同名的区域, 列表页爬虫的缓存文件要带上城市
     date = datetime.now().strftime("%Y-%m-%d")
-    cache_file = f"../.cache/{date}_{prefix}_url_candidates_{region}"
-    if os.path.exists(cache_file) and not os.path.exists(f"{cache_file}_all"):
-        copyfile(cache_file, f"{cache_file}_all")
-
-    with open(cache_file, "w") as fp:
-        fp.write("\n".join(cache))
+    if city is not None:
+        return f"../.cache/{date}_{city}_{prefix}_{name}_{region}"
+    return f"../.cache/{date}_{prefix}_{name}_{region}"
 
 
 class BaseCrawler:
     """
             抽象了一些公共方法
     """
+    DELTA_SORT = None
+    SEEN_MODEL = None
 
-    def __init__(self, base_url, filters, max_page=100):
+    def __init__(self, base_url, filters, max_page=100, fetcher=None):
         self.base_url = base_url
         self.filters = filters
         self.max_page = max_page
+        self.fetcher = fetcher if fetcher is not None else get_default_fetcher()
+        self.writer = None
+        self.dedup = None
+        # 重放归档时是页面的抓取时间, 价格历史按它记, 平时是 None (用写库的时间)
+        self.observed_at = None
+
+    def __getstate__(self):
+        # 抓取引擎里有事件循环和连接池, 不能传到解析进程里, 解析进程也用不到它
+        state = self.__dict__.copy()
+        state["fetcher"] = None
+        state["writer"] = None
+        state["dedup"] = None
+        return state
 
     def get_number_of_pages(self, *args, **kwargs):
         raise NotImplemented()
 
-    def get_candidate_urls(self, urls, region, filters=None, filter_level=0):
+    def parse_html(self, html, default_info=None):
+        if settings.PARSER_BACKEND == "lxml":
+            return self.parse_html_lxml(html, default_info=default_info)
+        return self.parse_html_bs4(html, default_info=default_info)
+
+    def parse_html_bs4(self, html, default_info=None):
+        raise NotImplemented()
+
+    def parse_html_lxml(self, html, default_info=None):
+        raise NotImplemented()
+
+    def get_number_of_pages_lxml(self, html):
+        return parsers.get_number_of_pages(html)
+
+    def save_data(self, data):
+        raise NotImplemented()
+
+    def write(self, model, rows):
+        """
+            crawl_region 里走攒批写入, 单独调用 save_data 的时候还是每次直接写
+        """
+        if self.dedup is not None:
+            rows = self.dedup.filter(model, rows)
+        normalize_rows(model, rows)
+        if not rows:
+            return
+        if self.writer is not None:
+            self.writer.add(model, rows)
+            return
+        with database.atomic():
+            insert_rows(model, rows)
+
+    def build_candidate_urls(self, prefix, region):
+        """
+            展开过滤器树, 得到一个区域所有要爬的列表页
+        """
+        candidate_urls = []
+        state_file = get_cache_file(prefix, region, "page_counts", city=self.city)
+        if settings.FILTER_PLANNER:
+            planner = FilterPlanner(self, region,
+                                    stats_file=f"../.cache/{self.city}_{prefix}_page_stats_{region}.json",
+                                    state_file=state_file)
+            planner.get_candidate_urls(candidate_urls)
+        else:
+            self.get_candidate_urls(candidate_urls, region, state_file=state_file)
+        logger.info(f"Total urls {len(candidate_urls)}")
+        return candidate_urls
+
+    def crawl_region(self, prefix, region):
+        """
+            列表页爬虫的公共流程: 生成候选url -> 并发抓取 -> 解析 -> 入库
+            抓取由 self.fetcher 完成, 限速由它的令牌桶负责
+            待爬的url放在 Frontier 里, 中断之后重跑会接着上次的进度
+        """
+        frontier = Frontier(get_cache_file(prefix, region, "frontier", city=self.city) + ".sqlite")
+        if not frontier.is_seeded():
+            frontier.seed(self.build_candidate_urls(prefix, region))
+        # 每天每个区域的 frontier 只有这一个爬虫在用, 还在 in_flight 的都是上次中断留下的, 不用等租约过期
+        frontier.recover(lease=0)
+        counts = frontier.counts()
+        logger.info(f"Frontier {counts}")
+
+        # 页面的数据真正写进数据库之后才算完成
+        pending = set()
+        # 满页后面还有的页 (节点比规划时预测的大), 和完成的页一起写进 frontier
+        next_urls = set()
+
+        def _on_flush():
+            if next_urls:
+                frontier.add(list(next_urls))
+                next_urls.clear()
+            frontier.complete(list(pending))
+            pending.clear()
+
+        def _on_error(url):
+            frontier.fail(url)
+
+        def _on_next_page(url):
+            if url is not None:
+                next_urls.add(url)
+
+        self.writer = BatchWriter(on_flush=_on_flush)
+        self.dedup = Deduplicator() if settings.DEDUP_ENABLED else None
+        try:
+            while counts[Frontier.PENDING]:
+                urls = frontier.iter_claims()
+                if settings.PARSER_PROCESSES > 0:
+                    CrawlPipeline(self).run(urls, default_info={"region": region}, on_done=pending.add,
+                                            on_error=_on_error, on_next_page=_on_next_page,
+                                            total=counts[Frontier.PENDING])
+                else:
+                    pages = self.fetcher.fetch(urls)
+                    for url, html in tqdm(pages, total=counts[Frontier.PENDING]):
+                        try:
+                            data = self.parse_html(html=html, default_info={"region": region})
+                        except Exception:
+                            logger.error(f"Failed to parse {url}:\n{traceback.format_exc()}")
+                            _on_error(url)
+                            continue
+                        self.save_data(data)
+                        pending.add(url)
+                        _on_next_page(self.next_page_url(url, html, data))
+                # 补出来的页和重新排队的失败页要等 flush 之后才回到 pending, 还有的话再来一轮
+                self.writer.flush()
+                counts = frontier.counts()
+        finally:
+            self.writer.close()
+            self.writer = None
+            self._finish_dedup(prefix, region)
+        counts = frontier.counts()
+        logger.info(f"Frontier {counts}")
+        frontier.close()
+        if counts[Frontier.IN_FLIGHT]:
+            # 不应该发生: 领走的url都已经完成或者重新排队了, 有剩下的说明有页面没爬, 不能当作成功
+            raise RuntimeError(f"{counts[Frontier.IN_FLIGHT]} urls of {prefix} {region} are still in flight")
+
+    def _finish_dedup(self, prefix, region):
+        if self.dedup is not None:
+            self.dedup.report(f"{prefix} {region}")
+            self.dedup = None
+
+    def probe_number_of_pages(self, url):
+        # 探测页只用来看页数, 短时间内重复探测直接用缓存
+        html = self.fetcher.get(url, max_age=settings.HTTP_CACHE_PROBE_TTL)
+        if html is None:
+            return None
+        if settings.PARSER_BACKEND == "lxml":
+            return self.get_number_of_pages_lxml(html)
+        return self.get_number_of_pages(BeautifulSoup(html, 'lxml'))
+
+    def expand_filter_tree(self, region, filters=None, filter_level=0, state_file=None):
+        """
+            按层展开过滤器树: 同一层所有兄弟节点一起丢进线程池探测页数
+            已经探测过的节点页数会写进 state_file, 中断后重跑可以从上次的位置继续
+            返回 {过滤器组合: 页数}
+        """
         if filters is None:
             filters = []
-        url = make_url(self.base_url, region, filters)
-        logger.debug(f"Visiting {url}")
-        number_of_pages = self.get_number_of_pages(
-            BeautifulSoup(get_html_content(url), 'lxml'))
-        logger.debug(f"#pages {number_of_pages}")
-        if number_of_pages >= self.max_page and filter_level < len(self.filters):
-            for f in self.filters[filter_level]:
-                self.get_candidate_urls(urls, region, filters + [f], filter_level + 1)
-        else:
-            if number_of_pages >= self.max_page and filter_level >= len(self.filters):
-                logger.debug(f"{url} can NOT find all!!")
+        page_counts = {}
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file, "r") as fp:
+                page_counts = {tuple(k.split(",")) if k else (): v for k, v in json.load(fp).items()}
+
+        def _save():
+            if state_file is not None:
+                with open(state_file, "w") as fp:
+                    json.dump({",".join(k): v for k, v in page_counts.items()}, fp)
+
+        frontier = [(tuple(filters), filter_level)]
+        with ThreadPoolExecutor(max_workers=settings.PROBE_CONCURRENCY) as executor:
+            try:
+                while frontier:
+                    to_probe = [node for node, _ in frontier if node not in page_counts]
+                    for _ in range(settings.PROBE_RETRIES):
+                        if not to_probe:
+                            break
+                        logger.debug(f"Probing {len(to_probe)} nodes")
+                        futures = {
+                            executor.submit(self.probe_number_of_pages, make_url(self.base_url, region, node)): node
+                            for node in to_probe
+                        }
+                        for future in as_completed(futures):
+                            number_of_pages = future.result()
+                            if number_of_pages is not None:
+                                page_counts[futures[future]] = number_of_pages
+                        to_probe = [node for node in to_probe if node not in page_counts]
+                    if to_probe:
+                        raise RuntimeError(f"Failed to probe {len(to_probe)} filter combinations, rerun to resume")
+
+                    next_frontier = []
+                    for node, level in frontier:
+                        if page_counts[node] >= self.max_page and level < len(self.filters):
+                            next_frontier.extend((node + (f,), level + 1) for f in self.filters[level])
+                    frontier = next_frontier
+                    _save()
+            finally:
+                _save()
+        return page_counts
+
+    def get_leaf_nodes(self, page_counts, region, filters=None, filter_level=0):
+        """
+            从展开好的过滤器树里按深度优先的顺序取出叶子节点, 返回 [(过滤器组合, 页数)]
+        """
+        if filters is None:
+            filters = []
+        leaves = []
+
+        def _collect(node, level):
+            url = make_url(self.base_url, region, node)
+            number_of_pages = page_counts[node]
+            logger.debug(f"{url} #pages {number_of_pages}")
+            if number_of_pages >= self.max_page and level < len(self.filters):
+                for f in self.filters[level]:
+                    _collect(node + (f,), level + 1)
             else:
-                logger.debug(f"{url} can find all!!")
+                if number_of_pages >= self.max_page and level >= len(self.filters):
+                    logger.debug(f"{url} can NOT find all!!")
+                else:
+                    logger.debug(f"{url} can find all!!")
+                leaves.append((node, min([
+                    number_of_pages, self.max_page  # 过滤器不够的到100到情况
+                ])))
+
+        _collect(tuple(filters), filter_level)
+        return leaves
+
+    def get_candidate_urls(self, urls, region, filters=None, filter_level=0, state_file=None):
+        page_counts = self.expand_filter_tree(region, filters, filter_level, state_file)
+        for node, number_of_pages in self.get_leaf_nodes(page_counts, region, filters, filter_level):
+            for i in range(number_of_pages):
+                urls.append(make_url(self.base_url, region, [f"pg{i + 1}"] + list(node)))
+
+    def get_rows(self, data):
+        """
+            parse_html 的结果里主表的那些行
+        """
+        return data
 
-            for i in range(min([
-                number_of_pages, self.max_page  # 过滤器不够的到100到情况
-            ])):
-                urls.append(make_url(self.base_url, region, [f"pg{i + 1}"] + filters))
+    def next_page_url(self, url, html, data):
+        """
+            规划器按历史页数生成的节点没有探测过, 节点变大了的话后面的页会漏掉
+            爬到的页是满的, 而且页面上的总页数比这一页的页码大, 返回下一页的url, 否则返回 None
+            下一页已经在队列里的由调用方去重 (Frontier.add / WorkQueue.seed 都会忽略重复的url)
+        """
+        if len(self.get_rows(data)) < settings.LIST_PAGE_SIZE:
+            return None
+        match = _PAGE_IN_URL.search(url)
+        if match is None:
+            return None
+        page = int(match.group(1))
+        if page >= min(parsers.scan_number_of_pages(html), self.max_page):
+            return None
+        return url[:match.start(1)] + str(page + 1) + url[match.end(1):]
+
+    def is_seen_page(self, rows, recent=None):
+        """
+            这一页的房源库里 (或者这次爬取已经爬到但还没写库的 recent 里) 都已经有了, 而且总价都没变
+        """
+        if not rows:
+            return True
+        recent = recent or {}
+        stored = {row["house_id"]: recent[row["house_id"]] for row in rows if row["house_id"] in recent}
+        missing = [row["house_id"] for row in rows if row["house_id"] not in stored]
+        if missing:
+            model = self.SEEN_MODEL
+            stored.update(model.select(model.house_id, model.total_price).where(
+                model.house_id.in_(missing)).tuples())
+        return all(stored.get(row["house_id"]) == row["total_price"] for row in rows)
+
+    def delta_crawl_region(self, prefix, region):
+        """
+            增量爬取: 每个过滤器叶子节点按 DELTA_SORT 从新到旧一页一页往后翻
+            某一页的房源全都已经入库而且价格没变, 说明后面都是旧的, 这个分支就不再往后翻
+            所有还没停下的分支同一轮一起抓, 每一轮每个分支抓一页
+            老房源只改价不会排到前面来, 这种变化要靠定期的全量爬取
+            抓取或者解析失败的页下一轮重试, 超过 DELTA_MAX_RETRIES 次放弃这个分支, 最后报告放弃了几个
+        """
+        state_file = get_cache_file(prefix, region, "page_counts", city=self.city)
+        page_counts = self.expand_filter_tree(region, state_file=state_file)
+        leaves = self.get_leaf_nodes(page_counts, region)
+        n_full = sum(n for _, n in leaves)
+        sort = [self.DELTA_SORT] if self.DELTA_SORT else []
+
+        active = {node: (1, number_of_pages) for node, number_of_pages in leaves if number_of_pages > 0}
+        n_pages = 0
+        failures = {}
+        given_up = []
+        # 这次爬到的房源, 还在 writer 里没写库的也要算见过
+        recent = {}
+        self.writer = BatchWriter()
+        self.dedup = Deduplicator() if settings.DEDUP_ENABLED else None
+        try:
+            with tqdm(total=n_full) as progress_bar:
+                while active:
+                    urls = {
+                        make_url(self.base_url, region, [f"pg{page}"] + sort + list(node)): node
+                        for node, (page, _) in active.items()
+                    }
+                    for url, html in self.fetcher.fetch(list(urls)):
+                        node = urls[url]
+                        page, number_of_pages = active.pop(node)
+                        try:
+                            data = self.parse_html(html=html, default_info={"region": region})
+                        except Exception:
+                            logger.error(f"Failed to parse {url}:\n{traceback.format_exc()}")
+                            failures[node] = failures.get(node, 0) + 1
+                            if failures[node] < settings.DELTA_MAX_RETRIES:
+                                active[node] = (page, number_of_pages)
+                            else:
+                                given_up.append(url)
+                            continue
+                        failures.pop(node, None)
+                        n_pages += 1
+                        progress_bar.update(1)
+                        # 先判断再写, 写进去之后就都算见过了
+                        rows = self.get_rows(data)
+                        seen = self.is_seen_page(rows, recent)
+                        recent.update((row["house_id"], row["total_price"]) for row in rows)
+                        self.save_data(data)
+                        if not seen and page < number_of_pages:
+                            active[node] = (page + 1, number_of_pages)
+        finally:
+            self.writer.close()
+            self.writer = None
+            self._finish_dedup(prefix, region)
+        logger.info(f"Delta crawl of {prefix} {region}: {n_pages} of {n_full} pages")
+        if given_up:
+            logger.warning(f"Delta crawl of {prefix} {region} gave up {len(given_up)} branches at: "
+                           + ", ".join(given_up))
+        return given_up
 
 
 class LianjiaErShouFangCrawler(BaseCrawler):
@@ -117,10 +408,13 @@ class LianjiaErShouFangCrawler(BaseCrawler):
         暂时就是列表的信息
         后续我们还可以整一个detail的
     """
+    # 增量爬取用: 按最新发布排序, 用二手房表判断见没见过
+    DELTA_SORT = "co32"
+    SEEN_MODEL = HouseInfoModel
 
-    def __init__(self, city):
+    def __init__(self, city, fetcher=None):
         super().__init__(
-            f"http://{city}.lianjia.com/ershoufang/", ER_SHOU_FANG_FILTERS)
+            f"http://{city}.lianjia.com/ershoufang/", ER_SHOU_FANG_FILTERS, fetcher=fetcher)
         self.city = city
 
     def get_number_of_pages(self, soup):
@@ -132,7 +426,10 @@ class LianjiaErShouFangCrawler(BaseCrawler):
         except:
             return 0
 
-    def parse_html(self, html, default_info=None):
+    def parse_html_lxml(self, html, default_info=None):
+        return parsers.parse_ershoufang(html, default_info=default_info)
+
+    def parse_html_bs4(self, html, default_info=None):
         house_info_data_source = []
         historical_price_data_source = []
         soup = BeautifulSoup(html, 'lxml')
@@ -194,27 +491,26 @@ class LianjiaErShouFangCrawler(BaseCrawler):
 
         return house_info_data_source, historical_price_data_source
 
-    def get_home_info_for_region(self, region):
+    def get_rows(self, data):
+        return data[0]
+
+    def save_data(self, data):
+        house_info_data_source, historical_price_data_source = data
+        self.write(HouseInfoModel, house_info_data_source)
+        # 每次看到的价格都记下来, 没变的只延长当前那一段
+        if self.observed_at is not None:
+            for row in historical_price_data_source:
+                row["observed_at"] = self.observed_at
+        self.write(PriceHistoryModel, historical_price_data_source)
+
+    def get_home_info_for_region(self, region, delta=None):
         """
             对于每个区的二手房的爬虫
         """
-        candidate_urls = load_cache("ershoufang", region)
-        if candidate_urls is None:
-            candidate_urls = []
-            self.get_candidate_urls(candidate_urls, region)
-            save_cache("ershoufang", region, candidate_urls)
-
-        for i, url in enumerate(tqdm(candidate_urls)):
-            house_info_data_source, historical_price_data_source = self.parse_html(
-                html=get_html_content(url), default_info={"region": region})
-            with database.atomic():
-                if house_info_data_source:
-                    HouseInfoModel.insert_many(house_info_data_source).on_conflict_replace().execute()
-                if historical_price_data_source:
-                    HistoricalPriceModel.insert_many(
-                        historical_price_data_source).on_conflict_replace().execute()
-            save_cache("ershoufang", region, candidate_urls[i + 1:])
-            time.sleep(1)
+        if settings.DELTA_CRAWL if delta is None else delta:
+            self.delta_crawl_region("ershoufang", region)
+        else:
+            self.crawl_region("ershoufang", region)
 
 
 class LianjiaZuFangCrawler(BaseCrawler):
@@ -223,9 +519,9 @@ class LianjiaZuFangCrawler(BaseCrawler):
         现在也是从列表来
     """
 
-    def __init__(self, city):
+    def __init__(self, city, fetcher=None):
         super().__init__(
-            f"http://{city}.lianjia.com/zufang/", ZU_FANG_FILTERS)
+            f"http://{city}.lianjia.com/zufang/", ZU_FANG_FILTERS, fetcher=fetcher)
         self.city = city
 
     def get_number_of_pages(self, soup):
@@ -235,7 +531,13 @@ class LianjiaZuFangCrawler(BaseCrawler):
         except:
             return 0
 
-    def parse_html(self, html, default_info=None):
+    def get_number_of_pages_lxml(self, html):
+        return parsers.get_number_of_pages_zufang(html)
+
+    def parse_html_lxml(self, html, default_info=None):
+        return parsers.parse_zufang(html, self.base_url, default_info=default_info)
+
+    def parse_html_bs4(self, html, default_info=None):
         rent_info_data_source = []
         soup = BeautifulSoup(html, 'lxml')
 
@@ -295,21 +597,11 @@ class LianjiaZuFangCrawler(BaseCrawler):
                 continue
         return rent_info_data_source
 
+    def save_data(self, rent_info_data_source):
+        self.write(RentInfoModel, rent_info_data_source)
+
     def get_rent_info_for_region(self, region):
-        candidate_urls = load_cache("zufang", region)
-        if candidate_urls is None:
-            candidate_urls = []
-            self.get_candidate_urls(candidate_urls, region)
-            save_cache("zufang", region, candidate_urls)
-
-        for i, url in enumerate(tqdm(candidate_urls)):
-            rent_info_data_source = self.parse_html(
-                html=get_html_content(url), default_info={"region": region})
-            with database.atomic():
-                if rent_info_data_source:
-                    RentInfoModel.insert_many(rent_info_data_source).on_conflict_replace().execute()
-            save_cache("zufang", region, candidate_urls[i + 1:])
-            time.sleep(1)
+        self.crawl_region("zufang", region)
 
 
 class LianjiaXiaoQuCrawler(BaseCrawler):
@@ -317,8 +609,8 @@ class LianjiaXiaoQuCrawler(BaseCrawler):
         小区的列表
     """
 
-    def __init__(self, city):
-        super().__init__(f"http://{city}.lianjia.com/xiaoqu/", XIAO_QU_FILTERS, max_page=30)
+    def __init__(self, city, fetcher=None):
+        super().__init__(f"http://{city}.lianjia.com/xiaoqu/", XIAO_QU_FILTERS, max_page=30, fetcher=fetcher)
         self.city = city
 
     def get_number_of_pages(self, soup):
@@ -330,7 +622,10 @@ class LianjiaXiaoQuCrawler(BaseCrawler):
         except:
             return 0
 
-    def parse_html(self, html, default_info=None):
+    def parse_html_lxml(self, html, default_info=None):
+        return parsers.parse_xiaoqu(html, self.city, default_info=default_info)
+
+    def parse_html_bs4(self, html, default_info=None):
         if default_info is None:
             default_info = {}
 
@@ -366,7 +661,7 @@ class LianjiaXiaoQuCrawler(BaseCrawler):
         for item in soup.findAll("li", {"class": "clear"}):
             info_dict = {
                 **default_info,
-                'city': 'sh',
+                'city': self.city,
             }
             try:
                 community_title = item.find("div", {"class": "title"})
@@ -406,26 +701,20 @@ class LianjiaXiaoQuCrawler(BaseCrawler):
 
         return community_data_source
 
+    def save_data(self, community_data_source):
+        self.write(CommunityModel, community_data_source)
+
     def get_community_info_for_region(self, region):
-        candidate_urls = load_cache("xiaoqu", region)
-        if candidate_urls is None:
-            candidate_urls = []
-            self.get_candidate_urls(candidate_urls, region)
-            save_cache("xiaoqu", region, candidate_urls)
-
-        for i, url in enumerate(tqdm(candidate_urls)):
-            community_data_source = self.parse_html(
-                html=get_html_content(url), default_info={"region": region})
-            with database.atomic():
-                if community_data_source:
-                    CommunityModel.insert_many(community_data_source).on_conflict_replace().execute()
-            save_cache("xiaoqu", region, candidate_urls[i + 1:])
-            time.sleep(1)
+        self.crawl_region("xiaoqu", region)
 
 
 class LianjiaChengJiaoCrawler(BaseCrawler):
-    def __init__(self, city):
-        super().__init__(f"http://{city}.lianjia.com/chengjiao/", CHENG_JIAO_FILTERS)
+    # 成交默认就是按成交时间从新到旧排的
+    DELTA_SORT = None
+    SEEN_MODEL = SellInfoModel
+
+    def __init__(self, city, fetcher=None):
+        super().__init__(f"http://{city}.lianjia.com/chengjiao/", CHENG_JIAO_FILTERS, fetcher=fetcher)
         self.city = city
 
     def get_number_of_pages(self, soup):
@@ -437,7 +726,10 @@ class LianjiaChengJiaoCrawler(BaseCrawler):
         except:
             return 0
 
-    def parse_html(self, html, default_info=None):
+    def parse_html_lxml(self, html, default_info=None):
+        return parsers.parse_chengjiao(html, default_info=default_info)
+
+    def parse_html_bs4(self, html, default_info=None):
         if default_info is None:
             default_info = {}
         data_source = []
@@ -511,55 +803,18 @@ class LianjiaChengJiaoCrawler(BaseCrawler):
                     continue
         return data_source
 
-    def get_transaction_info_for_region(self, region):
-        candidate_urls = load_cache("chengjiao", region)
-        if candidate_urls is None:
-            candidate_urls = []
-            self.get_candidate_urls(candidate_urls, region)
-            print("Total urls", len(candidate_urls))
-            save_cache("chengjiao", region, candidate_urls)
+    def save_data(self, sale_data_source):
+        self.write(SellInfoModel, sale_data_source)
 
-        for i, url in enumerate(tqdm(candidate_urls)):
-            sale_data_source = self.parse_html(
-                html=get_html_content(url), default_info={"region": region})
-            with database.atomic():
-                if sale_data_source:
-                    SellInfoModel.insert_many(sale_data_source).on_conflict_replace().execute()
-            save_cache("chengjiao", region, candidate_urls[i + 1:])
-            time.sleep(1)
+    def get_transaction_info_for_region(self, region, delta=None):
+        if settings.DELTA_CRAWL if delta is None else delta:
+            self.delta_crawl_region("chengjiao", region)
+        else:
+            self.crawl_region("chengjiao", region)
 
 
 if __name__ == '__main__':
-    database_init()
-    region_list = [
-        "pudong",  # 浦东
-        "jingan",  # 静安
-        "xuhui",  # 徐汇
-        "huangpu",  # 黄浦
-        "changning",  # 长宁
-        "putuo",  # 普陀
-        "baoshan",  # 宝山
-        "hongkou",  # 虹口
-        "yangpu",  # 杨浦
-        "minhang",  # 闵行
-        "jinshan",  # 金山
-        "jiading",  # 嘉定
-        "chongming",  # 崇明
-        "fengxian",  # 奉贤
-        "songjiang",  # 松江
-        "qingpu"  # 青浦
-    ]
-    while len(region_list) > 0:
-        region = region_list.pop(0)
-        try:
-            # ershoufang_crawler = LianjiaErShouFangCrawler("sh")
-            # ershoufang_crawler.get_home_info_for_region(region)
-            # zufang_crawler = LianjiaZuFangCrawler("sh")
-            # zufang_crawler.get_rent_info_for_region(region)
-            xiaoqu_crawler = LianjiaXiaoQuCrawler("sh")
-            xiaoqu_crawler.get_community_info_for_region(region)
-            # chengjiao_crawler = LianjiaChengJiaoCrawler("sh")
-            # chengjiao_crawler.get_transaction_info_for_region(region)
-        except:
-            region_list.append(region)
-            time.sleep(10)
+    # 按区域调度的入口在 lianjia.scheduler
+    from lianjia.scheduler import main
+
+    main()
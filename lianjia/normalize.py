@@ -0,0 +1,169 @@
+import argparse
+import datetime
+import re
+
+from tqdm import tqdm
+
+import db.settings as settings
+from db.model import database, database_init, HouseInfoModel, SellInfoModel, RentInfoModel, CommunityModel
+from lianjia.utils import logger
+
+"""
+    把解析出来的文本字段 ("89.5平米", "5000 元/月", "挂牌350万", "2019-05-12") 转成数值和日期
+    写库之前对每一行做一遍, 结果放在 model 里单独的带类型的列上, 原来的文本列不变
+    已经在库里的行用 backfill 补:
+        python -m lianjia.normalize
+        python -m lianjia.normalize --models sell_info
+"""
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+_YEAR = re.compile(r"(?<!\d)(?:19|20)\d{2}(?!\d)")
+_DATE = re.compile(r"(\d{4})[-./年](\d{1,2})(?:[-./月](\d{1,2}))?")
+
+
+def to_float(text):
+    """
+        文本里的第一个数字, 没有数字或者被打了码 (成交价 "2**万") 的返回 None
+        范围 ("3000-4000元/月", "1.2至2.5元/平米/月") 取下限
+    """
+    if text is None:
+        return None
+    text = str(text).replace(",", "")
+    if "*" in text:
+        return None
+    match = _NUMBER.search(text)
+    return float(match.group()) if match else None
+
+
+def to_int(text):
+    value = to_float(text)
+    return None if value is None else int(round(value))
+
+
+def to_year(text):
+    if text is None:
+        return None
+    match = _YEAR.search(str(text))
+    return int(match.group()) if match else None
+
+
+def to_date(text):
+    """
+        "2019-05-12", "2019.05.12", "2019-05" (取当月 1 号)
+    """
+    if text is None:
+        return None
+    match = _DATE.search(str(text))
+    if match is None:
+        return None
+    year, month, day = match.groups()
+    try:
+        return datetime.date(int(year), int(month), int(day or 1))
+    except ValueError:
+        return None
+
+
+# model -> {带类型的列: (文本列, 转换函数)}
+NORMALIZERS = {
+    HouseInfoModel: {
+        "area_m2": ("square", to_float),
+        "total_price_wan": ("total_price", to_float),
+        "unit_price_yuan": ("unit_price", to_int),
+        "build_year": ("years", to_year),
+    },
+    SellInfoModel: {
+        "area_m2": ("square", to_float),
+        "list_price_wan": ("list_price", to_float),
+        "total_price_wan": ("total_price", to_float),
+        "unit_price_yuan": ("unit_price", to_int),
+        "turnover_days": ("turnover", to_int),
+        "deal_day": ("deal_date", to_date),
+        "build_year": ("years", to_year),
+    },
+    RentInfoModel: {
+        "area_m2": ("square", to_float),
+        "monthly_rent_yuan": ("price", to_int),
+    },
+    CommunityModel: {
+        "avg_price_yuan": ("price", to_int),
+        "on_sale_count": ("on_sale", to_int),
+        "on_rent_count": ("on_rent", to_int),
+        "build_year": ("year", to_year),
+        "cost_yuan": ("cost", to_float),
+        "building_count": ("building_num", to_int),
+        "house_count": ("house_num", to_int),
+    },
+}
+
+
+def normalize_row(model, row):
+    """
+        row 里有的文本列才转换, 小区详情只更新一部分列的时候不会把其它的数值列清成 NULL
+    """
+    for column, (source, convert) in NORMALIZERS.get(model, {}).items():
+        if source in row:
+            row[column] = convert(row[source])
+    return row
+
+
+def normalize_rows(model, rows):
+    if model in NORMALIZERS:
+        for row in rows:
+            normalize_row(model, row)
+    return rows
+
+
+def backfill(model, batch_size=None):
+    """
+        给已经在库里的行补上数值列: 按主键分批读文本列, 算好之后逐行 update
+        只处理数值列全是 NULL 的行, 中断了重新跑会接着做
+    """
+    batch_size = batch_size or settings.NORMALIZE_BACKFILL_BATCH
+    normalizers = NORMALIZERS[model]
+    primary_key = model._meta.primary_key
+    sources = sorted({source for source, _ in normalizers.values()})
+    pending = None
+    for column in normalizers:
+        condition = getattr(model, column).is_null()
+        pending = condition if pending is None else pending & condition
+    fields = [primary_key] + [getattr(model, source) for source in sources]
+
+    n_updated = 0
+    last_key = None
+    progress_bar = tqdm(desc=model._meta.table_name)
+    while True:
+        query = model.select(*fields).where(pending)
+        if last_key is not None:
+            query = query.where(primary_key > last_key)
+        rows = list(query.order_by(primary_key).limit(batch_size).dicts())
+        if not rows:
+            break
+        last_key = rows[-1][primary_key.name]
+        with database.atomic():
+            for row in rows:
+                values = {column: value for column, value in normalize_row(model, dict(row)).items()
+                          if column in normalizers}
+                if any(value is not None for value in values.values()):
+                    model.update(values).where(primary_key == row[primary_key.name]).execute()
+                    n_updated += 1
+        progress_bar.update(len(rows))
+    progress_bar.close()
+    logger.info(f"Backfilled {n_updated} rows of {model._meta.table_name}")
+    return n_updated
+
+
+def main():
+    models = {model._meta.table_name: model for model in NORMALIZERS}
+    parser = argparse.ArgumentParser(description="给已有的行补上数值列")
+    parser.add_argument("--models", nargs="+", choices=sorted(models), default=sorted(models))
+    parser.add_argument("--batch-size", type=int, default=settings.NORMALIZE_BACKFILL_BATCH)
+    args = parser.parse_args()
+
+    database_init()
+    with database.connection_context():
+        for name in args.models:
+            backfill(models[name], args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
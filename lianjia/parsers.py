@@ -0,0 +1,399 @@
+import re
+import traceback
+import urllib
+
+from bs4 import UnicodeDammit
+from lxml import etree
+
+from lianjia.utils import strip_list
+
+"""
+    直接基于 lxml 的列表页解析
+    选择器全部预编译, 每种爬虫一套, 输出和 BeautifulSoup 版本的 parse_html 完全一致
+    BeautifulSoup 的 find 语义对应关系:
+        find(tag, {"class": "x"})       -> 第一个 class 里含有 x 的后代
+        find(tag, {"class": "x y"})     -> 第一个 class 规整后正好等于 "x y" 的后代
+        tag.a                           -> 第一个 a 后代
+        get_text()                      -> 所有后代文本, 不含注释和 script/style/template 里的内容
+"""
+
+
+def _has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+def _class_equals(value):
+    return f"normalize-space(@class)='{value}'"
+
+
+_TEXT = etree.XPath(".//text()[not(ancestor::script or ancestor::style or ancestor::template)]")
+_FIRST_A = etree.XPath(".//a")
+_FIRST_SPAN = etree.XPath(".//span")
+_ALL_LI = etree.XPath(".//li")
+
+
+def _first(xpath, element, **variables):
+    result = xpath(element, **variables)
+    return result[0] if result else None
+
+
+def _text(element):
+    # element 为 None 时抛 AttributeError, 跟 BeautifulSoup 版本一样由外层的 except 跳过这一条
+    return "".join(_TEXT(element))
+
+
+def build_tree(html):
+    """
+        编码识别和 BeautifulSoup 一致 (UnicodeDammit), 空文档返回 None
+    """
+    if html is None:
+        raise TypeError("Incoming markup is of an invalid type: None.")
+    if isinstance(html, bytes):
+        html = UnicodeDammit(html, is_html=True).unicode_markup
+    if not html.strip():
+        return None
+    return etree.fromstring(html, etree.HTMLParser())
+
+
+_PAGE_BOX = etree.XPath(f".//div[{_class_equals('page-box house-lst-page-box')}]")
+_PAGE_NAVIGATION = etree.XPath(".//div[@data-el='page_navigation']")
+
+
+def get_number_of_pages(html):
+    try:
+        page_info = _first(_PAGE_BOX, build_tree(html))
+        page_info_str = page_info.get('page-data').split(',')[0]
+        return int(page_info_str.split(':')[1])
+    except:
+        return 0
+
+
+_TOTAL_PAGE = re.compile(rb'"totalPage"\s*:\s*(\d+)|data-totalpage="(\d+)"')
+
+
+def scan_number_of_pages(html):
+    """
+        不建树, 直接在原始 html 里找总页数 (page-data 里的 totalPage, 租房是 data-totalpage), 找不到返回 0
+        列表页解析完之后顺便看一眼页数用, 比 get_number_of_pages 少一次 lxml 解析
+    """
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    # 页码在页面的最后面, 从后往前找
+    start = max(html.rfind(b'"totalPage"'), html.rfind(b'data-totalpage='))
+    match = _TOTAL_PAGE.match(html, start) if start >= 0 else None
+    if match is None:
+        return 0
+    return int(match.group(1) or match.group(2))
+
+
+def get_number_of_pages_zufang(html):
+    try:
+        page_navigation = _first(_PAGE_NAVIGATION, build_tree(html))
+        return int(page_navigation.get('data-totalpage'))
+    except:
+        return 0
+
+
+class ErShouFangSelectors:
+    list_items = etree.XPath(f".//ul[{_has_class('sellListContent')}]")
+    title = etree.XPath(f".//div[{_has_class('title')}]")
+    house_info = etree.XPath(f".//div[{_has_class('houseInfo')}]")
+    position_info = etree.XPath(f".//div[{_has_class('positionInfo')}]")
+    follow_info = etree.XPath(f".//div[{_has_class('followInfo')}]")
+    tax_free = etree.XPath(f".//span[{_has_class('taxfree')}]")
+    total_price = etree.XPath(f".//div[{_has_class('totalPrice')}]")
+    unit_price = etree.XPath(f".//div[{_has_class('unitPrice')}]")
+
+
+def parse_ershoufang(html, default_info=None):
+    house_info_data_source = []
+    historical_price_data_source = []
+    root = build_tree(html)
+    if root is None:
+        return house_info_data_source, historical_price_data_source
+    s = ErShouFangSelectors
+    for ul_tag in s.list_items(root):
+        for item in _ALL_LI(ul_tag):
+            info_dict = {}
+            if default_info is not None:
+                info_dict.update(default_info)
+            try:
+                house_title = _first(_FIRST_A, _first(s.title, item))
+                info_dict['title'] = _text(house_title).strip()
+                info_dict['link'] = house_title.get('href')
+                house_id = house_title.get('data-housecode')
+                if house_id is None:
+                    house_id = house_title.get('data-lj_action_housedel_id')
+                info_dict['house_id'] = house_id
+
+                info = _text(_first(s.house_info, item)).split('|')
+                info_dict['house_type'] = info[0]
+                info_dict['square'] = info[1]
+                info_dict['direction'] = info[2]
+                info_dict['decoration'] = info[3]
+                info_dict['floor'] = info[4]
+                info_dict['years'] = info[5]
+
+                community_info = _text(_first(s.position_info, item)).split('-')
+                info_dict['community'] = community_info[0]
+                if len(community_info) >= 2:
+                    info_dict['zone'] = community_info[1]
+
+                info_dict['follow_info'] = _text(_first(s.follow_info, item)).strip()
+
+                tax_free = _first(s.tax_free, item)
+                info_dict['tax_type'] = "" if tax_free is None else _text(tax_free).strip()
+
+                info_dict['total_price'] = _text(_first(_FIRST_SPAN, _first(s.total_price, item)))
+                info_dict['unit_price'] = _first(s.unit_price, item).get("data-price")
+            except:
+                continue
+
+            house_info_data_source.append(info_dict)
+            historical_price_data_source.append(
+                {"house_id": info_dict["house_id"], "total_price": info_dict["total_price"]})
+
+    return house_info_data_source, historical_price_data_source
+
+
+class ZuFangSelectors:
+    list_items = etree.XPath(f".//div[{_has_class('content__list--item')} and @data-house_code]")
+    title = etree.XPath(f".//p[{_class_equals('content__list--item--title twoline')}]")
+    # 原来的代码写的是集合 {"class", "content__list--item--des"}, BeautifulSoup 当作 class 在集合里处理
+    description = etree.XPath(f".//p[{_has_class('class')} or {_has_class('content__list--item--des')}]")
+    price = etree.XPath(f".//span[{_has_class('content__list--item-price')}]")
+    decoration = etree.XPath(f".//i[{_has_class('content__item__tag--decoration')}]")
+    subway = etree.XPath(f".//i[{_has_class('content__item__tag--is_subway_house')}]")
+
+
+def parse_zufang(html, base_url, default_info=None):
+    rent_info_data_source = []
+    root = build_tree(html)
+    if root is None:
+        return rent_info_data_source
+    s = ZuFangSelectors
+    for list_item in s.list_items(root):
+        try:
+            info_dict = {
+                "rent_type": "",
+                "decoration": "",
+                "subway": ""
+            }
+
+            if default_info is not None:
+                info_dict.update(default_info)
+
+            info_dict['house_id'] = list_item.get('data-house_code')
+
+            house_ref = _first(_FIRST_A, _first(s.title, list_item))
+            house_title = _text(house_ref).strip()
+            info_dict['title'] = house_title
+
+            if "·" in house_title:
+                info_dict["rent_type"] = house_title.split("·")[0]
+
+            info_dict['link'] = urllib.parse.urljoin(base_url, house_ref.get('href'))
+
+            description_list = _text(_first(s.description, list_item)).strip().split("\n")
+            strip_list(description_list)
+
+            location_info = description_list[0].split("-")
+            info_dict["region"] = location_info[0]
+            info_dict["zone"] = location_info[1]
+            info_dict["community"] = location_info[2]
+
+            info_dict["square"] = description_list[2]
+            info_dict["direction"] = description_list[3].replace("/", "").strip()
+            info_dict["house_type"] = description_list[4]
+            info_dict["floor"] = description_list[6]
+
+            info_dict["price"] = _text(_first(s.price, list_item)).strip()
+
+            decoration_field = _first(s.decoration, list_item)
+            if decoration_field is not None:
+                info_dict["decoration"] = _text(decoration_field).strip()
+
+            subway_field = _first(s.subway, list_item)
+            if subway_field is not None:
+                info_dict["subway"] = _text(subway_field).strip()
+            rent_info_data_source.append(info_dict)
+        except:
+            traceback.print_exc()
+            continue
+    return rent_info_data_source
+
+
+class XiaoQuSelectors:
+    list_items = etree.XPath(f".//li[{_has_class('clear')}]")
+    title = etree.XPath(f".//div[{_has_class('title')}]")
+    district = etree.XPath(f".//a[{_has_class('district')}]")
+    biz_circle = etree.XPath(f".//a[{_has_class('bizcircle')}]")
+    tag_list = etree.XPath(f".//div[{_has_class('tagList')}]")
+    on_sale = etree.XPath(f".//a[{_has_class('totalSellCount')}]")
+    on_rent = etree.XPath(".//a[@title=$title]")
+    price = etree.XPath(f".//div[{_has_class('totalPrice')}]")
+
+
+def parse_xiaoqu(html, city, default_info=None):
+    if default_info is None:
+        default_info = {}
+    community_data_source = []
+    root = build_tree(html)
+    if root is None:
+        return community_data_source
+    s = XiaoQuSelectors
+    for item in s.list_items(root):
+        info_dict = {
+            **default_info,
+            'city': city,
+        }
+        try:
+            community_title = _first(s.title, item)
+            title = _text(community_title).strip('\n')
+            link = _first(_FIRST_A, community_title).get('href')
+            info_dict['title'] = title
+            info_dict['link'] = link
+
+            info_dict['district'] = _text(_first(s.district, item))
+            info_dict['biz_circle'] = _text(_first(s.biz_circle, item))
+            info_dict['tag_list'] = _text(_first(s.tag_list, item)).strip('\n')
+
+            on_sale = _first(s.on_sale, item)
+            info_dict['on_sale'] = _text(_first(_FIRST_SPAN, on_sale)).strip('\n')
+
+            on_rent = _first(s.on_rent, item, title=title + "租房")
+            info_dict['on_rent'] = _text(on_rent).strip('\n').split('套')[0]
+
+            info_dict['id'] = item.get('data-housecode')
+
+            price = _first(s.price, item)
+            info_dict['price'] = _text(_first(_FIRST_SPAN, price)).strip('\n')
+            community_data_source.append(info_dict)
+        except:
+            continue
+
+    return community_data_source
+
+
+class ChengJiaoSelectors:
+    list_items = etree.XPath(f".//ul[{_has_class('listContent')}]")
+    title = etree.XPath(f".//div[{_has_class('title')}]")
+    house_info = etree.XPath(f".//div[{_has_class('houseInfo')}]")
+    position_info = etree.XPath(f".//div[{_has_class('positionInfo')}]")
+    total_price = etree.XPath(f".//div[{_has_class('totalPrice')}]")
+    unit_price = etree.XPath(f".//div[{_has_class('unitPrice')}]")
+    deal_date = etree.XPath(f".//div[{_has_class('dealDate')}]")
+    deal_cycle = etree.XPath(f".//span[{_has_class('dealCycleTxt')}]")
+
+
+def parse_chengjiao(html, default_info=None):
+    if default_info is None:
+        default_info = {}
+    data_source = []
+    root = build_tree(html)
+    if root is None:
+        return data_source
+    s = ChengJiaoSelectors
+    for ul_tag in s.list_items(root):
+        for item in _ALL_LI(ul_tag):
+            info_dict = {
+                "turnover": "",
+                "list_price": "",
+                **default_info
+            }
+
+            try:
+                house_title = _first(s.title, item)
+                title = _text(house_title).strip()
+                info_dict['title'] = title
+                href = _first(_FIRST_A, house_title).get('href')
+                info_dict['link'] = href
+                info_dict['house_id'] = href.split("/")[-1].split(".")[0].strip()
+
+                house = title.split(' ')
+                info_dict['community'] = house[0].strip() if 0 < len(house) else ''
+                info_dict['house_type'] = house[1].strip() if 1 < len(house) else ''
+                info_dict['square'] = house[2].strip() if 2 < len(house) else ''
+
+                info = _text(_first(s.house_info, item)).split('|')
+                info_dict['direction'] = info[0].strip()
+                info_dict['decoration'] = info[1].strip() if 1 < len(info) else ''
+
+                floor_all = _text(_first(s.position_info, item)).strip().split(' ')
+                info_dict['floor'] = floor_all[0].strip()
+                info_dict['years'] = floor_all[-1].strip()
+
+                for key, selector in (('total_price', s.total_price), ('unit_price', s.unit_price)):
+                    price = _first(selector, item)
+                    span = _first(_FIRST_SPAN, price)
+                    info_dict[key] = _text(price if span is None else span).strip()
+
+                info_dict['deal_date'] = _text(_first(s.deal_date, item)).strip().replace('.', '-')
+
+                turnover_item = _first(s.deal_cycle, item)
+                if turnover_item is not None:
+                    turnover_info = _FIRST_SPAN(turnover_item)
+                    if len(turnover_info) == 2:
+                        info_dict.update({
+                            "list_price": _text(turnover_info[0]).strip(),
+                            "turnover": _text(turnover_info[1]).strip()
+                        })
+                data_source.append(info_dict)
+            except Exception as e:
+                continue
+    return data_source
+
+
+def compare_backends(crawler, html, default_info=None):
+    """
+        差分检查: 同一个页面分别用 BeautifulSoup 和 lxml 解析, 返回两边不一致的结果, 一致时返回 None
+    """
+    bs4_result = crawler.parse_html_bs4(html, default_info=default_info)
+    lxml_result = crawler.parse_html_lxml(html, default_info=default_info)
+    if bs4_result == lxml_result:
+        return None
+    return bs4_result, lxml_result
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+
+    from lianjia.info_crawlers import LianjiaErShouFangCrawler, LianjiaZuFangCrawler, LianjiaXiaoQuCrawler, \
+        LianjiaChengJiaoCrawler
+
+    from benchmarks import fixtures
+
+    # 用法: python -m lianjia.parsers [语料目录]
+    # 语料目录下按 ershoufang/zufang/xiaoqu/chengjiao 分子目录存放保存下来的列表页 html
+    # 默认用 benchmarks 的语料, 不存在就先生成; 一个页面都没有比较到也算失败
+    if len(sys.argv) > 1:
+        corpus_dir = sys.argv[1]
+    else:
+        corpus_dir = fixtures.CORPUS_DIR
+        fixtures.build_corpus(corpus_dir)
+    crawlers = {
+        "ershoufang": LianjiaErShouFangCrawler("sh"),
+        "zufang": LianjiaZuFangCrawler("sh"),
+        "xiaoqu": LianjiaXiaoQuCrawler("sh"),
+        "chengjiao": LianjiaChengJiaoCrawler("sh"),
+    }
+    n_pages, n_mismatch = 0, 0
+    for prefix, crawler in crawlers.items():
+        page_dir = os.path.join(corpus_dir, prefix)
+        if not os.path.isdir(page_dir):
+            continue
+        for file_name in sorted(os.listdir(page_dir)):
+            with open(os.path.join(page_dir, file_name), "rb") as fp:
+                html = fp.read()
+            n_pages += 1
+            diff = compare_backends(crawler, html, default_info={"region": "corpus"})
+            if diff is not None:
+                n_mismatch += 1
+                print(f"MISMATCH {prefix}/{file_name}")
+                print(f"  bs4:  {diff[0]}")
+                print(f"  lxml: {diff[1]}")
+    print(f"{n_pages} pages, {n_mismatch} mismatches")
+    if n_pages == 0:
+        print(f"No pages found under {corpus_dir}")
+    sys.exit(1 if n_mismatch or n_pages == 0 else 0)
@@ -0,0 +1,131 @@
+import multiprocessing
+import queue
+import threading
+import traceback
+
+from tqdm import tqdm
+
+import db.settings as settings
+from lianjia.utils import logger
+
+"""
+    抓取 / 解析 / 入库 三段流水线
+    抓取在后台线程里跑 (异步抓取引擎), 解析放到多进程里绕开 GIL, 入库在主线程
+    段与段之间的队列都是有界的, 整个城市爬下来内存也是平的
+"""
+
+_DONE = None
+
+
+def _parse_worker(crawler, html_queue, row_queue, default_info):
+    while True:
+        task = html_queue.get()
+        if task is _DONE:
+            row_queue.put(_DONE)
+            return
+        url, html = task
+        try:
+            data = crawler.parse_html(html=html, default_info=default_info)
+            row_queue.put((url, data, crawler.next_page_url(url, html, data), None))
+        except Exception:
+            row_queue.put((url, None, None, traceback.format_exc()))
+
+
+def _get_context():
+    """
+        不用默认的 fork: 调度器在线程池里跑流水线, fork 出来的子进程会带上别的线程 (事件循环, 连接池) 持有的锁,
+        子进程里可能死锁
+    """
+    method = settings.PARSER_START_METHOD
+    if method not in multiprocessing.get_all_start_methods():
+        method = "spawn"
+    return multiprocessing.get_context(method)
+
+
+class CrawlPipeline:
+
+    def __init__(self, crawler, n_parsers=None, queue_size=None):
+        self.crawler = crawler
+        self.n_parsers = n_parsers or settings.PARSER_PROCESSES
+        self.queue_size = queue_size or settings.PIPELINE_QUEUE_SIZE
+        self._stop = threading.Event()
+
+    def _put(self, q, item):
+        # 下游挂掉的时候不要一直卡在满的队列上
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fetch_stage(self, urls, html_queue):
+        try:
+            for url, html in self.crawler.fetcher.fetch(urls):
+                if not self._put(html_queue, (url, html)):
+                    return
+        except Exception:
+            logger.error(f"Fetch stage failed:\n{traceback.format_exc()}")
+        finally:
+            for _ in range(self.n_parsers):
+                self._put(html_queue, _DONE)
+
+    def run(self, urls, default_info=None, on_done=None, on_error=None, on_next_page=None, total=None):
+        """
+            urls 可以是生成器, 抓取线程会按需消费
+            on_done(url) 在一页交给 save_data 之后调用, 用来记录进度
+            解析失败的页调用 on_error(url), 不会调用 on_done
+            on_next_page(url) 在 on_done 之后调用, url 是 crawler.next_page_url 的结果 (可能是 None)
+        """
+        context = _get_context()
+        html_queue = context.Queue(maxsize=self.queue_size)
+        row_queue = context.Queue(maxsize=self.queue_size)
+        self._stop.clear()
+
+        parsers = [
+            context.Process(target=_parse_worker, args=(self.crawler, html_queue, row_queue, default_info), daemon=True)
+            for _ in range(self.n_parsers)
+        ]
+        for p in parsers:
+            p.start()
+        fetcher = threading.Thread(target=self._fetch_stage, args=(urls, html_queue), daemon=True)
+        fetcher.start()
+
+        n_running = self.n_parsers
+        progress_bar = tqdm(total=total if total is not None else len(urls))
+        try:
+            while n_running > 0:
+                try:
+                    result = row_queue.get(timeout=1)
+                except queue.Empty:
+                    # 解析进程被杀掉 (比如 OOM) 就不会再发 _DONE, 不检查的话这里会永远等下去
+                    # 正常退出的进程一定先发了 _DONE, 只看非 0 的退出码; 它手上的页面还在 frontier 的 in_flight 里,
+                    # 下次运行会重新排队
+                    dead = [p.exitcode for p in parsers if p.exitcode not in (None, 0)]
+                    if dead:
+                        raise RuntimeError(f"{len(dead)} parser processes died (exit codes {dead})")
+                    continue
+                if result is _DONE:
+                    n_running -= 1
+                    continue
+                url, data, next_url, error = result
+                progress_bar.update(1)
+                if error is not None:
+                    logger.error(f"Failed to parse {url}:\n{error}")
+                    if on_error is not None:
+                        on_error(url)
+                    continue
+                self.crawler.save_data(data)
+                if on_done is not None:
+                    on_done(url)
+                if on_next_page is not None:
+                    on_next_page(next_url)
+        finally:
+            progress_bar.close()
+            self._stop.set()
+            fetcher.join()
+            for p in parsers:
+                if n_running > 0:
+                    p.terminate()
+                p.join()
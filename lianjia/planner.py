@@ -0,0 +1,213 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import db.settings as settings
+from lianjia.utils import logger, make_url
+
+
+class PageCountStats:
+    """
+        跨天保存每个 (区域, 过滤器组合) 探测到的页数
+        文件格式: {"p1,a2": [页数, "2019-01-01"], ...}
+    """
+
+    def __init__(self, stats_file=None):
+        self.stats_file = stats_file
+        self.records = {}
+        if stats_file is not None and os.path.exists(stats_file):
+            with open(stats_file, "r") as fp:
+                self.records = json.load(fp)
+
+    @staticmethod
+    def key(node):
+        return ",".join(node)
+
+    def get(self, node, max_age=None):
+        record = self.records.get(self.key(node))
+        if record is None:
+            return None
+        number_of_pages, date = record
+        if max_age is not None and (datetime.now() - datetime.strptime(date, "%Y-%m-%d")).days > max_age:
+            return None
+        return number_of_pages
+
+    def update(self, node, number_of_pages):
+        self.records[self.key(node)] = [number_of_pages, datetime.now().strftime("%Y-%m-%d")]
+
+    def save(self):
+        if self.stats_file is not None:
+            with open(self.stats_file, "w") as fp:
+                json.dump(self.records, fp)
+
+
+class FilterPlanner:
+    """
+        自适应的过滤器拆分
+        1. 页数超过 max_page 的节点, 根据历史页数挑一个拆得最干净的维度, 而不是固定按 self.filters 的顺序
+        2. 历史页数明显小于 max_page 的子节点不再探测, 直接按历史页数 (+PLANNER_PAD_PAGES) 生成url
+           预测的页数不一定对, 节点变大了的话爬虫爬到满的最后一页时会把后面的页补进队列 (BaseCrawler.next_page_url)
+        3. 对比按固定顺序完整展开需要的探测次数, 报告省下了多少次请求
+    """
+
+    def __init__(self, crawler, region, stats_file=None, state_file=None):
+        self.crawler = crawler
+        self.region = region
+        self.max_page = crawler.max_page
+        self.stats = PageCountStats(stats_file)
+        self.state_file = state_file
+        self.dimension_of = {f: i for i, values in enumerate(crawler.filters) for f in values}
+
+        # 本次运行中真实探测到的页数, 和 expand_filter_tree 的 state_file 格式一致, 可以中断续跑
+        self.page_counts = {}
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file, "r") as fp:
+                self.page_counts = {tuple(k.split(",")) if k else (): v for k, v in json.load(fp).items()}
+        self.n_probes = 0
+        self.n_predicted = 0
+
+    def canonical(self, node):
+        # url 里参数的顺序始终和 self.filters 的维度顺序一致, 跟原来的 url 保持相同
+        return tuple(sorted(node, key=lambda f: self.dimension_of[f]))
+
+    def predict(self, node):
+        """
+            历史页数足够小 (不会再被拆分) 时直接返回历史页数, 否则返回 None 表示需要探测
+        """
+        number_of_pages = self.stats.get(node, max_age=settings.PLANNER_STATS_MAX_AGE)
+        if number_of_pages is None or number_of_pages > self.max_page * settings.PLANNER_SAFE_RATIO:
+            return None
+        return number_of_pages
+
+    def choose_dimension(self, node):
+        """
+            选一个预计后续探测次数最少的维度:
+            能预测的子节点不用探测, 其余每个要探测一次, 历史上还是超出 max_page 的还要继续往下拆
+            只比较子节点历史数据齐全的维度, 一个都没有的时候退化成原来固定的顺序
+        """
+        used = {self.dimension_of[f] for f in node}
+        unused = [dimension for dimension in range(len(self.crawler.filters)) if dimension not in used]
+        if not unused:
+            return None
+
+        best_dimension, best_cost = None, None
+        for dimension in unused:
+            cost = 0
+            for f in self.crawler.filters[dimension]:
+                child = self.canonical(node + (f,))
+                history = self.stats.get(child, max_age=settings.PLANNER_STATS_MAX_AGE)
+                if history is None:
+                    break
+                if self.predict(child) is not None:
+                    continue
+                cost += 1
+                if history >= self.max_page:
+                    cost += settings.PLANNER_SPLIT_PENALTY
+            else:
+                if best_cost is None or cost < best_cost:
+                    best_dimension, best_cost = dimension, cost
+        if best_dimension is None:
+            return unused[0]
+        return best_dimension
+
+    def _probe_all(self, executor, nodes):
+        for _ in range(settings.PROBE_RETRIES):
+            nodes = [node for node in nodes if node not in self.page_counts]
+            if not nodes:
+                return
+            futures = {
+                executor.submit(self.crawler.probe_number_of_pages,
+                                make_url(self.crawler.base_url, self.region, node)): node
+                for node in nodes
+            }
+            for future in as_completed(futures):
+                self.n_probes += 1
+                number_of_pages = future.result()
+                if number_of_pages is not None:
+                    self.page_counts[futures[future]] = number_of_pages
+                    self.stats.update(futures[future], number_of_pages)
+        nodes = [node for node in nodes if node not in self.page_counts]
+        if nodes:
+            raise RuntimeError(f"Failed to probe {len(nodes)} filter combinations, rerun to resume")
+
+    def _save(self):
+        self.stats.save()
+        if self.state_file is not None:
+            with open(self.state_file, "w") as fp:
+                json.dump({",".join(k): v for k, v in self.page_counts.items()}, fp)
+
+    def plan(self):
+        """
+            返回 [(过滤器组合, 要爬的页数)], 顺序和深度优先遍历一致
+        """
+        children = {}
+        leaves = {}
+        frontier = [()]
+        with ThreadPoolExecutor(max_workers=settings.PROBE_CONCURRENCY) as executor:
+            try:
+                while frontier:
+                    self._probe_all(executor, frontier)
+                    next_frontier = []
+                    for node in frontier:
+                        number_of_pages = self.page_counts[node]
+                        dimension = None
+                        if number_of_pages >= self.max_page:
+                            dimension = self.choose_dimension(node)
+                        if dimension is None:
+                            if number_of_pages >= self.max_page:
+                                logger.debug(f"{node} can NOT find all!!")
+                            leaves[node] = min(number_of_pages, self.max_page)
+                            continue
+
+                        children[node] = []
+                        for f in self.crawler.filters[dimension]:
+                            child = self.canonical(node + (f,))
+                            children[node].append(child)
+                            predicted = self.predict(child)
+                            if predicted is not None and child not in self.page_counts:
+                                self.n_predicted += 1
+                                leaves[child] = min(predicted + settings.PLANNER_PAD_PAGES, self.max_page)
+                            else:
+                                next_frontier.append(child)
+                    frontier = next_frontier
+                    self._save()
+            finally:
+                self._save()
+
+        result = []
+
+        def _collect(node):
+            if node in leaves:
+                result.append((node, leaves[node]))
+            else:
+                for child in children[node]:
+                    _collect(child)
+
+        _collect(())
+        return result
+
+    def naive_probes(self):
+        """
+            估算按固定顺序完整展开需要的探测次数, 没见过的节点当作叶子
+        """
+
+        def _count(node, level):
+            number_of_pages = self.page_counts.get(node)
+            if number_of_pages is None:
+                number_of_pages = self.stats.get(node)
+            n = 1
+            if number_of_pages is not None and number_of_pages >= self.max_page and level < len(self.crawler.filters):
+                for f in self.crawler.filters[level]:
+                    n += _count(node + (f,), level + 1)
+            return n
+
+        return _count((), 0)
+
+    def get_candidate_urls(self, urls):
+        for node, number_of_pages in self.plan():
+            for i in range(number_of_pages):
+                urls.append(make_url(self.crawler.base_url, self.region, [f"pg{i + 1}"] + list(node)))
+        naive = self.naive_probes()
+        logger.info(f"Planner probes {self.n_probes}, predicted {self.n_predicted}, "
+                    f"naive tree ~{naive}, saved ~{naive - self.n_probes}")
@@ -0,0 +1,109 @@
+import datetime
+
+import db.settings as settings
+from db.model import PriceHistoryModel
+from lianjia.normalize import to_float
+
+"""
+    二手房挂牌价的时间序列, 存在 PriceHistoryModel 里, 价格没变的连续观测合并成一段 (游程编码)
+    每次爬到一批房源只需要: 一次按主键前缀查出这些房源当前的那一段, 一条 update 延长没变的,
+    一条 update 结束变了的, 一次 insert_many 新开的段; 库里的行数随价格变化的次数增长, 不随爬取次数增长
+"""
+
+
+def _chunks(items, size=None):
+    size = size or settings.WRITER_INSERT_CHUNK
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def record_prices(rows, observed_at=None):
+    """
+        rows 是 [{"house_id": ..., "total_price": ...}], 同一个房源出现多次时以最后一次为准
+        行里可以带 observed_at (重放归档时是页面的抓取时间), 没有的用参数 observed_at, 默认是现在
+        按观测时间从早到晚合并, 在调用方的事务里执行, 返回新开的段数
+    """
+    observed_at = observed_at or datetime.datetime.now()
+    groups = {}
+    for row in rows:
+        groups.setdefault(row.get("observed_at") or observed_at, []).append(row)
+    return sum(_record_prices(group, at) for at, group in sorted(groups.items()))
+
+
+def _record_prices(rows, observed_at):
+    prices = {row["house_id"]: row["total_price"] for row in rows}
+    house_ids = list(prices)
+
+    current = {}
+    for chunk in _chunks(house_ids):
+        query = PriceHistoryModel.select(
+            PriceHistoryModel.house_id, PriceHistoryModel.total_price, PriceHistoryModel.total_price_wan,
+            PriceHistoryModel.last_observed_at
+        ).where(PriceHistoryModel.house_id.in_(chunk) & PriceHistoryModel.latest)
+        for house_id, total_price, total_price_wan, last_observed_at in query.tuples():
+            current[house_id] = (total_price, total_price_wan, last_observed_at)
+
+    unchanged = []
+    changed = []
+    new_runs = []
+    for house_id, total_price in prices.items():
+        old = current.get(house_id)
+        if old is not None and old[2] is not None and old[2] >= observed_at:
+            # 比当前那一段最后一次观测还早 (重放了更早的一天), 接上去会打乱时间线, 跳过
+            continue
+        if old is not None and old[0] == total_price:
+            unchanged.append(house_id)
+            continue
+        total_price_wan = to_float(total_price)
+        previous_price_wan = None if old is None else old[1]
+        price_change = None
+        if total_price_wan is not None and previous_price_wan is not None:
+            price_change = total_price_wan - previous_price_wan
+        if old is not None:
+            changed.append(house_id)
+        new_runs.append({
+            "house_id": house_id, "observed_at": observed_at, "last_observed_at": observed_at,
+            "n_observations": 1, "total_price": total_price, "total_price_wan": total_price_wan,
+            "previous_price_wan": previous_price_wan, "price_change": price_change, "latest": True,
+        })
+
+    for chunk in _chunks(unchanged):
+        PriceHistoryModel.update(
+            last_observed_at=observed_at, n_observations=PriceHistoryModel.n_observations + 1
+        ).where(PriceHistoryModel.house_id.in_(chunk) & PriceHistoryModel.latest).execute()
+    for chunk in _chunks(changed):
+        PriceHistoryModel.update(latest=False).where(
+            PriceHistoryModel.house_id.in_(chunk) & PriceHistoryModel.latest).execute()
+    for chunk in _chunks(new_runs):
+        PriceHistoryModel.insert_many(chunk).execute()
+    return len(new_runs)
+
+
+def price_histories(house_ids):
+    """
+        一批房源的价格历史, 返回 {house_id: [(开始时间, 最后一次看到的时间, 总价 (万元), 原始的总价文本)]},
+        每个房源按时间从早到晚, 走 (house_id, observed_at) 主键
+    """
+    result = {house_id: [] for house_id in house_ids}
+    for chunk in _chunks(list(house_ids)):
+        query = PriceHistoryModel.select(
+            PriceHistoryModel.house_id, PriceHistoryModel.observed_at, PriceHistoryModel.last_observed_at,
+            PriceHistoryModel.total_price_wan, PriceHistoryModel.total_price
+        ).where(PriceHistoryModel.house_id.in_(chunk)).order_by(
+            PriceHistoryModel.house_id, PriceHistoryModel.observed_at)
+        for house_id, *run in query.tuples():
+            result[house_id].append(tuple(run))
+    return result
+
+
+def price_cuts(days, min_cut=None, now=None):
+    """
+        最近 days 天里降过价的房源, 返回 PriceHistoryModel 的查询, 每行是降价之后的那一段
+        min_cut (万元) 只要降了至少这么多的
+        走 (observed_at, price_change) 索引: 只扫最近 days 天新开的段, 和总的观测次数无关
+    """
+    since = (now or datetime.datetime.now()) - datetime.timedelta(days=days)
+    condition = (PriceHistoryModel.observed_at >= since) & (PriceHistoryModel.price_change < 0)
+    if min_cut is not None:
+        condition &= PriceHistoryModel.price_change <= -min_cut
+    return PriceHistoryModel.select().where(condition).order_by(PriceHistoryModel.price_change)
@@ -0,0 +1,170 @@
+import argparse
+import heapq
+import itertools
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import db.settings as settings
+from db.model import database_init, database
+from lianjia.info_crawlers import LianjiaErShouFangCrawler, LianjiaZuFangCrawler, LianjiaXiaoQuCrawler, \
+    LianjiaChengJiaoCrawler
+from lianjia.utils import logger
+
+"""
+    多城市 / 多区域的调度
+    每个 (爬虫, 城市, 区域) 是一个任务, 最多同时跑 SCHEDULER_CONCURRENCY 个
+    任务的顺序按爬虫类型轮流排, 不会一个类型的所有区域都跑完了才轮到下一个类型
+    失败的任务按指数退避重新排队, 不影响其它任务
+
+    python -m lianjia.scheduler
+    python -m lianjia.scheduler --crawlers ershoufang chengjiao --regions pudong jingan --delta
+"""
+
+# 爬虫类型 -> (类, 爬一个区域的方法名)
+CRAWLERS = {
+    "ershoufang": (LianjiaErShouFangCrawler, "get_home_info_for_region"),
+    "zufang": (LianjiaZuFangCrawler, "get_rent_info_for_region"),
+    "xiaoqu": (LianjiaXiaoQuCrawler, "get_community_info_for_region"),
+    "chengjiao": (LianjiaChengJiaoCrawler, "get_transaction_info_for_region"),
+}
+
+# 支持增量爬取的爬虫
+DELTA_CRAWLERS = {"ershoufang", "chengjiao"}
+
+
+def get_city_regions(cities=None, regions=None):
+    """
+        从参数或者 settings.CITY / settings.REGION_LIST 得到 {城市: [区域]}
+    """
+    if cities is None:
+        cities = [settings.CITY] if isinstance(settings.CITY, str) else list(settings.CITY)
+    result = {}
+    for city in cities:
+        if regions is not None:
+            result[city] = list(regions)
+        elif isinstance(settings.REGION_LIST, dict):
+            result[city] = list(settings.REGION_LIST.get(city, []))
+        else:
+            result[city] = list(settings.REGION_LIST)
+        if not result[city]:
+            logger.warning(f"No regions configured for {city}")
+    return result
+
+
+def interleave(crawler_names, city_regions):
+    """
+        按爬虫类型轮流排任务: (ershoufang, sh, pudong), (zufang, sh, pudong), ..., (ershoufang, sh, jingan), ...
+        多个城市的区域也轮流排
+    """
+    places = [
+        place for places in itertools.zip_longest(*[[(city, region) for region in regions]
+                                                    for city, regions in city_regions.items()])
+        for place in places if place is not None
+    ]
+    return [(name, city, region) for city, region in places for name in crawler_names]
+
+
+class Task:
+
+    def __init__(self, crawler_name, city, region):
+        self.crawler_name = crawler_name
+        self.city = city
+        self.region = region
+        self.attempts = 0
+
+    def __str__(self):
+        return f"{self.crawler_name}/{self.city}/{self.region}"
+
+
+class Scheduler:
+
+    def __init__(self, tasks, concurrency=None, max_retries=None, backoff_base=None, backoff_max=None,
+                 delta=None):
+        self.concurrency = concurrency or settings.SCHEDULER_CONCURRENCY
+        self.max_retries = settings.SCHEDULER_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = backoff_base or settings.SCHEDULER_BACKOFF_BASE
+        self.backoff_max = backoff_max or settings.SCHEDULER_BACKOFF_MAX
+        self.delta = delta
+        self._seq = itertools.count()
+        # (可以开始的时间, 入队顺序, 任务), 入队顺序保证同时可以开始的任务按轮流排好的顺序出队
+        self._queue = [(0.0, next(self._seq), Task(*task)) for task in tasks]
+        heapq.heapify(self._queue)
+        self.succeeded = []
+        self.failed = []
+
+    def _backoff(self, attempts):
+        return min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+
+    def run_task(self, task):
+        crawler_class, method = CRAWLERS[task.crawler_name]
+        crawler = crawler_class(task.city)
+        kwargs = {}
+        if self.delta is not None and task.crawler_name in DELTA_CRAWLERS:
+            kwargs["delta"] = self.delta
+        # 每个任务线程用自己的数据库连接
+        with database.connection_context():
+            getattr(crawler, method)(task.region, **kwargs)
+
+    def _on_finished(self, task, future):
+        try:
+            future.result()
+        except Exception:
+            task.attempts += 1
+            if task.attempts > self.max_retries:
+                logger.error(f"{task} failed {task.attempts} times, giving up:\n{traceback.format_exc()}")
+                self.failed.append(task)
+                return
+            delay = self._backoff(task.attempts)
+            logger.error(f"{task} failed (attempt {task.attempts}), retry in {delay}s:\n{traceback.format_exc()}")
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._seq), task))
+            return
+        logger.info(f"{task} done")
+        self.succeeded.append(task)
+
+    def run(self):
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while self._queue or running:
+                now = time.monotonic()
+                while self._queue and len(running) < self.concurrency and self._queue[0][0] <= now:
+                    _, _, task = heapq.heappop(self._queue)
+                    logger.info(f"Start {task}")
+                    running[executor.submit(self.run_task, task)] = task
+
+                timeout = None
+                if self._queue and len(running) < self.concurrency:
+                    timeout = max(0.0, self._queue[0][0] - now)
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._on_finished(running.pop(future), future)
+        logger.info(f"{len(self.succeeded)} tasks done, {len(self.failed)} failed")
+        if self.failed:
+            logger.error(f"Failed tasks: {', '.join(str(task) for task in self.failed)}")
+        return not self.failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按城市和区域并行调度列表页爬虫")
+    parser.add_argument("--crawlers", nargs="+", choices=sorted(CRAWLERS), default=settings.SCHEDULER_CRAWLERS)
+    parser.add_argument("--cities", nargs="+", help="默认取 settings.CITY")
+    parser.add_argument("--regions", nargs="+", help="默认取 settings.REGION_LIST")
+    parser.add_argument("--concurrency", type=int, default=settings.SCHEDULER_CONCURRENCY)
+    parser.add_argument("--max-retries", type=int, default=settings.SCHEDULER_MAX_RETRIES)
+    parser.add_argument("--delta", action="store_true", default=None, help="二手房和成交只做增量爬取")
+    parser.add_argument("--full", action="store_false", dest="delta", help="二手房和成交做全量爬取")
+    args = parser.parse_args()
+
+    database_init()
+    tasks = interleave(args.crawlers, get_city_regions(args.cities, args.regions))
+    logger.info(f"Scheduling {len(tasks)} tasks with concurrency {args.concurrency}")
+    scheduler = Scheduler(tasks, concurrency=args.concurrency, max_retries=args.max_retries, delta=args.delta)
+    if not scheduler.run():
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import asyncio
+import re
+import time
+
+import db.settings as settings
+from lianjia.utils import logger, is_block_title, BLOCK_TITLES
+
+"""
+    被封检测和自适应限速
+    每个响应先分类, 被封 (验证码 / 403 / 414 / 429) 时立刻把这个 host 的速率和并发减半并暂停一段时间,
+    之后连续成功才慢慢加回去; 加到上次被封时的速率附近会放慢加速的步子 (AIMD)
+"""
+
+OK = "ok"
+EMPTY = "empty"
+CAPTCHA = "captcha"
+BLOCKED = "blocked"
+SERVER_ERROR = "server_error"
+# 403 / 414 / 429 以外的 4xx (比如 404), 页面不能用, 重试也没用, 直接交给调用方
+CLIENT_ERROR = "client_error"
+NETWORK_ERROR = "network_error"
+
+# 这些结果的页面不能用, 要重新抓
+RETRYABLE = {EMPTY, CAPTCHA, BLOCKED, SERVER_ERROR, NETWORK_ERROR}
+# 这些结果说明被限制了, 要减速
+BLOCK_SIGNALS = {CAPTCHA, BLOCKED}
+
+_TITLE = re.compile(rb"<title[^>]*>(.*?)</title>", re.I | re.S)
+CAPTCHA_URL_KEYWORDS = ("captcha", "verify")
+
+
+def classify(status, url, body):
+    """
+        status 是 http 状态码, url 是跟随跳转之后最终的地址, 请求本身失败时 status 和 body 都是 None
+    """
+    if status is None:
+        return NETWORK_ERROR
+    if status in (403, 414, 429):
+        return BLOCKED
+    if any(keyword in str(url).lower() for keyword in CAPTCHA_URL_KEYWORDS):
+        return CAPTCHA
+    if status >= 500:
+        return SERVER_ERROR
+    if status >= 400:
+        return CLIENT_ERROR
+    if not body or not body.strip():
+        return EMPTY
+    match = _TITLE.search(body[:4096])
+    title = match.group(1).decode("utf-8", "ignore") if match else None
+    if title is not None and title.strip() in BLOCK_TITLES:
+        return BLOCKED
+    if is_block_title(title):
+        return CAPTCHA
+    return OK
+
+
+class AdaptiveLimit:
+    """
+        上限可以随时调整的 asyncio 信号量
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def __aexit__(self, *args):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    async def set_limit(self, limit):
+        async with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+
+class HostThrottle:
+    """
+        一个 host 的限速状态: 并发上限, 令牌桶速率, 暂停到什么时候
+        只在抓取引擎的事件循环里使用
+    """
+
+    def __init__(self, host, bucket, concurrency):
+        self.host = host
+        self.bucket = bucket
+        self.max_concurrency = concurrency
+        self.limit = AdaptiveLimit(concurrency)
+        self.min_rate = settings.THROTTLE_MIN_RATE
+        self.max_rate = max(settings.THROTTLE_MAX_RATE, bucket.rate)
+        # 上次被封时的速率, 加速到它附近时放慢
+        self.ceiling = None
+        self.paused_until = 0.0
+        self.n_ok_in_row = 0
+        self.counts = {}
+
+    async def wait(self):
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def record(self, kind):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        if not settings.THROTTLE_ENABLED:
+            return
+        if kind in BLOCK_SIGNALS:
+            await self._slow_down(settings.THROTTLE_DECREASE, pause=settings.THROTTLE_BLOCK_PAUSE, kind=kind)
+        elif kind == SERVER_ERROR:
+            await self._slow_down(settings.THROTTLE_SERVER_ERROR_DECREASE, pause=0, kind=kind)
+        elif kind == OK:
+            self.n_ok_in_row += 1
+            if self.n_ok_in_row >= settings.THROTTLE_INCREASE_EVERY:
+                self.n_ok_in_row = 0
+                await self._speed_up()
+
+    async def _slow_down(self, factor, pause, kind):
+        self.n_ok_in_row = 0
+        if kind in BLOCK_SIGNALS:
+            if time.monotonic() < self.paused_until:
+                # 暂停前已经发出去的请求陆续被封, 同一次被封只减一次速
+                return
+            self.ceiling = self.bucket.rate
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        self.bucket.rate = max(self.min_rate, self.bucket.rate * factor)
+        await self.limit.set_limit(max(1, int(self.limit.limit * factor)))
+        logger.warning(f"{self.host}: {kind}, slow down to {self.bucket.rate:.2f}/s, "
+                       f"concurrency {self.limit.limit}" + (f", pause {pause}s" if pause else ""))
+
+    async def _speed_up(self):
+        step = settings.THROTTLE_INCREASE
+        if self.ceiling is not None and self.bucket.rate + step > self.ceiling * 0.8:
+            step /= 4
+        self.bucket.rate = min(self.max_rate, self.bucket.rate + step)
+        if self.limit.limit < self.max_concurrency:
+            await self.limit.set_limit(self.limit.limit + 1)
+        logger.debug(f"{self.host}: speed up to {self.bucket.rate:.2f}/s, concurrency {self.limit.limit}")
+
+    def report(self):
+        logger.info(f"{self.host}: {self.counts}, rate {self.bucket.rate:.2f}/s, concurrency {self.limit.limit}")
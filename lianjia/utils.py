@@ -1,7 +1,5 @@
 import logging
 
-import requests
-import random
 from datetime import datetime
 from bs4 import BeautifulSoup
 import threading
@@ -59,15 +57,24 @@ hd = {
 
 
 def get_html_content(url):
-    try:
-        result = requests.get(
-            url, headers=hds[random.randint(0, len(hds) - 1)])
-        html_content = result.content
-    except Exception as e:
-        print(e)
-        return
+    """
+        走共享的异步抓取引擎 (lianjia.fetcher), 复用连接池并受每个 host 的限速约束
+    """
+    from lianjia.fetcher import get_default_fetcher
+    return get_default_fetcher().get(url)
 
-    return html_content
+
+def make_url(base_url, region, parameters):
+    return base_url + "{region}/{parameters}/".format(
+        region=region, parameters="".join(parameters)
+    ).replace("//", "/")
+
+
+def strip_list(content_list):
+    for i, raw_content in enumerate(content_list):
+        while "  " in raw_content:
+            raw_content = raw_content.replace("  ", " ")
+        content_list[i] = raw_content.strip()
 
 
 def run_with_threads(func, n_threads):
@@ -81,8 +88,19 @@ def run_with_threads(func, n_threads):
         t.join()
 
 
+# 被封和验证码页面的标题, 抓取引擎 (lianjia.throttle) 也用它们给响应分类
+BLOCK_TITLES = ("414 Request-URI Too Large",)
+CAPTCHA_TITLES = ("人机认证", "验证", "CAPTCHA")
+
+
+def is_block_title(title):
+    if title is None:
+        return False
+    return title.strip() in BLOCK_TITLES or any(keyword in title for keyword in CAPTCHA_TITLES)
+
+
 def check_block(soup):
-    if soup.title.string == "414 Request-URI Too Large":
+    if soup.title is not None and is_block_title(soup.title.string):
         logging.error(
             "Lianjia block your ip, please verify captcha manually at lianjia.com")
         return True
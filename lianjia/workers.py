@@ -0,0 +1,267 @@
+import argparse
+import datetime
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from peewee import fn
+from tqdm import tqdm
+
+import db.settings as settings
+from db.model import database, database_init, CrawlTaskModel, CrawlWorkerModel
+from lianjia.scheduler import CRAWLERS, get_city_regions
+from lianjia.utils import logger
+from lianjia.writer import BatchWriter
+
+"""
+    分布式爬取: 多个 worker 进程 (可以在不同的机器上) 从同一个数据库里的 crawl_task 表领任务
+    队列就放在 db.model 用的库里, 本地试的时候把 DB_ENGINE 设成 sqlite 就行
+
+    领取: 一次领一批, 写上 worker id, 随机的 claim_token 和租约到期时间
+    心跳: 后台线程定时刷新 crawl_worker 的心跳时间, 同时给自己手上还没完成的任务续约
+    收回: 租约过期还是 in_flight 的任务 (worker 挂了) 会被别的 worker 放回 pending
+    完成: 和 crawl_region 一样, 页面的数据真正写进库之后才标记 done
+
+    python -m lianjia.workers seed chengjiao --regions pudong jingan
+    python -m lianjia.workers work chengjiao
+    python -m lianjia.workers status chengjiao
+"""
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+
+class WorkQueue:
+
+    def __init__(self, queue, lease_seconds=None, max_retries=None):
+        self.queue = queue
+        self.lease_seconds = lease_seconds or settings.WORKER_LEASE_SECONDS
+        self.max_retries = settings.WORKER_MAX_RETRIES if max_retries is None else max_retries
+
+    def _lease_until(self):
+        return datetime.datetime.now() + datetime.timedelta(seconds=self.lease_seconds)
+
+    def seed(self, urls, region, city=None):
+        rows = [{"queue": self.queue, "url": url, "region": region, "city": city} for url in urls]
+        with database.atomic():
+            for i in range(0, len(rows), settings.WRITER_INSERT_CHUNK):
+                CrawlTaskModel.insert_many(rows[i:i + settings.WRITER_INSERT_CHUNK]).on_conflict_ignore().execute()
+        return len(rows)
+
+    def claim(self, worker_id, n):
+        """
+            领取最多 n 个任务, 返回 [(id, url, region, city, claim_token)]
+            先挑出候选的 id, 再带着 state = pending 的条件更新, 多个 worker 同时领也不会领到同一个;
+            被别人抢先的就少领几个
+        """
+        candidates = [row_id for row_id, in CrawlTaskModel.select(CrawlTaskModel.id).where(
+            (CrawlTaskModel.queue == self.queue) & (CrawlTaskModel.state == PENDING)
+        ).order_by(CrawlTaskModel.id).limit(n).tuples()]
+        if not candidates:
+            return []
+        token = uuid.uuid4().hex
+        CrawlTaskModel.update(
+            state=IN_FLIGHT, worker=worker_id, claim_token=token, lease_until=self._lease_until(),
+            updated_at=datetime.datetime.now()
+        ).where(CrawlTaskModel.id.in_(candidates) & (CrawlTaskModel.state == PENDING)).execute()
+        return list(CrawlTaskModel.select(
+            CrawlTaskModel.id, CrawlTaskModel.url, CrawlTaskModel.region, CrawlTaskModel.city,
+            CrawlTaskModel.claim_token
+        ).where(CrawlTaskModel.claim_token == token).order_by(CrawlTaskModel.id).tuples())
+
+    def extend_leases(self, worker_id):
+        return CrawlTaskModel.update(lease_until=self._lease_until()).where(
+            (CrawlTaskModel.worker == worker_id) & (CrawlTaskModel.state == IN_FLIGHT)).execute()
+
+    def reclaim_expired(self):
+        """
+            租约过期的任务放回 pending, 算一次重试, 重试次数用完的标记为 failed
+        """
+        expired = ((CrawlTaskModel.queue == self.queue) & (CrawlTaskModel.state == IN_FLIGHT) &
+                   (CrawlTaskModel.lease_until < datetime.datetime.now()))
+        CrawlTaskModel.update(
+            state=FAILED, worker=None, claim_token=None, retries=CrawlTaskModel.retries + 1,
+            updated_at=datetime.datetime.now()
+        ).where(expired & (CrawlTaskModel.retries + 1 >= self.max_retries)).execute()
+        n = CrawlTaskModel.update(
+            state=PENDING, worker=None, claim_token=None, retries=CrawlTaskModel.retries + 1,
+            updated_at=datetime.datetime.now()
+        ).where(expired).execute()
+        if n:
+            logger.info(f"Reclaimed {n} expired tasks of {self.queue}")
+        return n
+
+    def complete(self, claims):
+        """
+            claims 是 [(id, claim_token)], 只标记还是自己领着的任务
+            租约过期被收回 (可能又被别的 worker 领走) 的任务 claim_token 已经变了, 不会被改成 done
+        """
+        by_token = {}
+        for task_id, claim_token in claims:
+            by_token.setdefault(claim_token, []).append(task_id)
+        n = 0
+        for claim_token, task_ids in by_token.items():
+            n += CrawlTaskModel.update(state=DONE, updated_at=datetime.datetime.now()).where(
+                CrawlTaskModel.id.in_(task_ids) & (CrawlTaskModel.claim_token == claim_token) &
+                (CrawlTaskModel.state == IN_FLIGHT)).execute()
+        if n < len(claims):
+            logger.warning(f"{len(claims) - n} tasks of {self.queue} were reclaimed before they were completed")
+        return n
+
+    def fail(self, task_id, claim_token):
+        """
+            失败的任务重新排队, 超过 max_retries 次标记为 failed; 已经被收回的任务不动
+        """
+        task = CrawlTaskModel.get_by_id(task_id)
+        retries = task.retries + 1
+        CrawlTaskModel.update(
+            state=FAILED if retries >= self.max_retries else PENDING, retries=retries, worker=None,
+            claim_token=None, updated_at=datetime.datetime.now()
+        ).where((CrawlTaskModel.id == task_id) & (CrawlTaskModel.claim_token == claim_token) &
+                (CrawlTaskModel.state == IN_FLIGHT)).execute()
+
+    def counts(self):
+        result = {PENDING: 0, IN_FLIGHT: 0, DONE: 0, FAILED: 0}
+        query = CrawlTaskModel.select(CrawlTaskModel.state, fn.COUNT(CrawlTaskModel.id)).where(
+            CrawlTaskModel.queue == self.queue).group_by(CrawlTaskModel.state).tuples()
+        for state, n in query:
+            result[state] = n
+        return result
+
+
+class Worker:
+
+    def __init__(self, crawler, queue, worker_id=None, batch_size=None):
+        self.crawler = crawler
+        self.queue = queue
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.batch_size = batch_size or settings.WORKER_BATCH_SIZE
+        self.n_done = 0
+        # 已经交给 writer 的任务 {(id, claim_token)}
+        self._pending = set()
+        # 满页后面还有的页 {url: (区域, 城市)}, flush 的时候加进队列
+        self._next_urls = {}
+        # 队列里的任务可能来自多个城市, 每个城市一个爬虫, 共用抓取引擎和 writer; 没有城市的任务用 crawler
+        self._crawlers = {}
+        self._stop = threading.Event()
+
+    def _heartbeat(self):
+        with database.connection_context():
+            while not self._stop.wait(settings.WORKER_HEARTBEAT_INTERVAL):
+                try:
+                    self.queue.extend_leases(self.worker_id)
+                    CrawlWorkerModel.update(heartbeat_at=datetime.datetime.now(), n_done=self.n_done).where(
+                        CrawlWorkerModel.worker_id == self.worker_id).execute()
+                except Exception as e:
+                    logger.error(f"Heartbeat of {self.worker_id} failed: {e!r}")
+
+    def _crawler_for(self, city):
+        if city is None or city == self.crawler.city:
+            return self.crawler
+        if city not in self._crawlers:
+            crawler = type(self.crawler)(city, fetcher=self.crawler.fetcher)
+            crawler.writer = self.crawler.writer
+            self._crawlers[city] = crawler
+        return self._crawlers[city]
+
+    def _process(self, tasks):
+        by_url = {url: (task_id, region, city, claim_token) for task_id, url, region, city, claim_token in tasks}
+        for url, html in self.crawler.fetcher.fetch(list(by_url)):
+            task_id, region, city, claim_token = by_url[url]
+            crawler = self._crawler_for(city)
+            try:
+                data = crawler.parse_html(html=html, default_info={"region": region})
+            except Exception:
+                logger.error(f"Failed to parse {url}:\n{traceback.format_exc()}")
+                self.queue.fail(task_id, claim_token)
+                continue
+            crawler.save_data(data)
+            self._pending.add((task_id, claim_token))
+            next_url = crawler.next_page_url(url, html, data)
+            if next_url is not None:
+                self._next_urls[next_url] = (region, city)
+
+    def run(self):
+        """
+            一直领任务直到队列里没有 pending 也没有别人在做的任务
+        """
+        CrawlWorkerModel.insert(worker_id=self.worker_id, queue=self.queue.queue,
+                                host=socket.gethostname()).on_conflict_replace().execute()
+        logger.info(f"Worker {self.worker_id} started on {self.queue.queue}")
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+
+        # 页面的数据真正写进数据库之后才算完成
+        def _on_flush():
+            regions = {}
+            for url, region_city in self._next_urls.items():
+                regions.setdefault(region_city, []).append(url)
+            for (region, city), urls in regions.items():
+                self.queue.seed(urls, region, city)
+            self._next_urls.clear()
+            self.n_done += self.queue.complete(self._pending)
+            self._pending.clear()
+
+        self.crawler.writer = BatchWriter(on_flush=_on_flush)
+        progress_bar = tqdm()
+        try:
+            while True:
+                self.queue.reclaim_expired()
+                tasks = self.queue.claim(self.worker_id, self.batch_size)
+                if not tasks:
+                    # 先把自己手上攒着的写掉, 剩下的 in_flight 才都是别人的
+                    # flush 的时候可能补进了满页后面的页, 又有 pending 的就接着领
+                    self.crawler.writer.flush()
+                    counts = self.queue.counts()
+                    if counts[PENDING] > 0:
+                        continue
+                    if counts[IN_FLIGHT] == 0:
+                        break
+                    # 别的 worker 还有任务在做, 它们挂了的话租约到期后收回来接着做
+                    time.sleep(settings.WORKER_POLL_INTERVAL)
+                    continue
+                self._process(tasks)
+                progress_bar.update(len(tasks))
+        finally:
+            progress_bar.close()
+            self.crawler.writer.close()
+            self.crawler.writer = None
+            self._crawlers.clear()
+            self._stop.set()
+            heartbeat.join()
+        logger.info(f"Worker {self.worker_id} finished, {self.n_done} pages done, queue {self.queue.counts()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分布式爬取的 worker")
+    parser.add_argument("command", choices=["seed", "work", "status"])
+    parser.add_argument("crawler", choices=sorted(CRAWLERS))
+    parser.add_argument("--cities", nargs="+", help="seed 用, 默认取 settings.CITY")
+    parser.add_argument("--regions", nargs="+", help="seed 用, 默认取 settings.REGION_LIST")
+    parser.add_argument("--city", default=settings.CITY if isinstance(settings.CITY, str) else settings.CITY[0],
+                        help="work 用, 只用于没有记下城市的老任务, 真正的 url 和城市来自队列")
+    parser.add_argument("--batch-size", type=int, default=settings.WORKER_BATCH_SIZE)
+    args = parser.parse_args()
+
+    database_init()
+    crawler_class, _ = CRAWLERS[args.crawler]
+    queue = WorkQueue(args.crawler)
+    with database.connection_context():
+        if args.command == "seed":
+            for city, regions in get_city_regions(args.cities, args.regions).items():
+                crawler = crawler_class(city)
+                for region in regions:
+                    n = queue.seed(crawler.build_candidate_urls(args.crawler, region), region, city)
+                    logger.info(f"Seeded {n} urls of {args.crawler}/{city}/{region}")
+        elif args.command == "work":
+            Worker(crawler_class(args.city), queue, batch_size=args.batch_size).run()
+        logger.info(f"Queue {args.crawler}: {queue.counts()}")
+
+
+if __name__ == '__main__':
+    main()
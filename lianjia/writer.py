@@ -0,0 +1,157 @@
+import atexit
+import hashlib
+import json
+import threading
+import time
+
+import db.settings as settings
+from peewee import MySQLDatabase
+
+from db.model import database as default_database, HouseInfoModel, PriceHistoryModel, RentInfoModel, \
+    SellInfoModel, CommunityModel
+from lianjia.price_history import record_prices
+from lianjia.utils import logger
+
+# 计算内容摘要时忽略的字段: 写入时间, 摘要本身, 还有二手房每天都会变的 "xx人关注 / x天以前发布"
+HASH_EXCLUDED_FIELDS = {
+    HouseInfoModel: {"valid_date", "content_hash", "follow_info"},
+    RentInfoModel: {"update_date", "content_hash"},
+    SellInfoModel: {"update_date", "content_hash"},
+}
+
+
+# 主键冲突时保留旧值的字段, 其余字段用新值覆盖; 不在这里的 model 冲突时整行替换
+# 小区的详情字段是详情爬虫写的, 重新爬列表页的时候不能清掉
+KEEP_ON_CONFLICT = {
+    CommunityModel: {"year", "house_type", "cost", "service", "company", "building_num", "house_num",
+                     "build_year", "cost_yuan", "building_count", "house_count"},
+}
+
+
+def insert_rows(model, rows):
+    if model is PriceHistoryModel:
+        # 价格历史不是覆盖写, 按游程合并到已有的段上
+        return record_prices(rows)
+    query = model.insert_many(rows)
+    keep = KEEP_ON_CONFLICT.get(model)
+    if keep is None:
+        return query.on_conflict_replace().execute()
+    preserve = [field for field in model._meta.sorted_fields if field.name not in keep and not field.primary_key]
+    # MySQL 的 ON DUPLICATE KEY UPDATE 不能也不需要指定冲突的列
+    conflict_target = None if isinstance(model._meta.database, MySQLDatabase) else [model._meta.primary_key]
+    return query.on_conflict(conflict_target=conflict_target, preserve=preserve).execute()
+
+
+def content_hash(row, excluded=()):
+    payload = json.dumps({k: v for k, v in row.items() if k not in excluded},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class BatchWriter:
+    """
+        攒批写库
+        各个 model 的行先放在内存里, 攒够 batch_size 行或者距离上次写入超过 flush_interval 秒时
+        在一个事务里用多行 insert_many 一次性写进去
+        with 退出 (包括异常退出) 和进程退出时都会把剩下的行写掉
+
+        upsert=True 时 HASH_EXCLUDED_FIELDS 里的 model 只写内容摘要变了的行
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, database=None, on_flush=None, upsert=None):
+        self.batch_size = batch_size or settings.WRITER_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.WRITER_FLUSH_INTERVAL
+        self.database = database or default_database
+        self.on_flush = on_flush
+        self.upsert = settings.WRITER_UPSERT if upsert is None else upsert
+
+        self.buffers = {}
+        self.n_buffered = 0
+        self.n_written = 0
+        self.n_unchanged = 0
+        self.n_flushes = 0
+        self.write_seconds = 0.0
+        self.started_at = time.time()
+        self.last_flush_at = time.time()
+        self._lock = threading.RLock()
+        atexit.register(self.close)
+
+    def add(self, model, rows):
+        if not rows:
+            return
+        with self._lock:
+            self.buffers.setdefault(model, []).extend(rows)
+            self.n_buffered += len(rows)
+            if self.n_buffered >= self.batch_size or time.time() - self.last_flush_at >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self.n_buffered > 0:
+                start = time.time()
+                n_written = 0
+                with self.database.atomic():
+                    buffers = self.buffers
+                    if self.upsert:
+                        buffers = self._select_changed(buffers)
+                    for model, rows in buffers.items():
+                        for i in range(0, len(rows), settings.WRITER_INSERT_CHUNK):
+                            insert_rows(model, rows[i:i + settings.WRITER_INSERT_CHUNK])
+                        n_written += len(rows)
+                self.write_seconds += time.time() - start
+                self.n_written += n_written
+                self.n_flushes += 1
+                logger.debug(f"Flushed {self.n_buffered} rows in {time.time() - start:.2f}s")
+                self.buffers = {}
+                self.n_buffered = 0
+            self.last_flush_at = time.time()
+            if self.on_flush is not None:
+                self.on_flush()
+
+    def _select_changed(self, buffers):
+        """
+            和库里存的摘要比较, 只留下新增或者内容变化的行
+        """
+        result = {}
+        for model, rows in buffers.items():
+            if model not in HASH_EXCLUDED_FIELDS:
+                result.setdefault(model, []).extend(rows)
+                continue
+            excluded = HASH_EXCLUDED_FIELDS[model]
+            primary_key = model._meta.primary_key
+            latest = {}
+            for row in rows:
+                latest[row[primary_key.name]] = {**row, "content_hash": content_hash(row, excluded)}
+
+            stored = {}
+            keys = list(latest)
+            for i in range(0, len(keys), settings.WRITER_INSERT_CHUNK):
+                for key, stored_hash in model.select(primary_key, model.content_hash).where(
+                        primary_key.in_(keys[i:i + settings.WRITER_INSERT_CHUNK])).tuples():
+                    stored[key] = stored_hash
+
+            changed = [row for key, row in latest.items() if stored.get(key) != row["content_hash"]]
+            self.n_unchanged += len(rows) - len(changed)
+            result.setdefault(model, []).extend(changed)
+        return result
+
+    def rows_per_second(self):
+        elapsed = time.time() - self.started_at
+        return self.n_written / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        logger.info(f"Wrote {self.n_written} rows in {self.n_flushes} batches, skipped {self.n_unchanged} unchanged, "
+                    f"{self.rows_per_second():.1f} rows/s overall, {self.write_seconds:.1f}s spent in the database")
+
+    def close(self):
+        atexit.unregister(self.close)
+        try:
+            self.flush()
+        finally:
+            self.report()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()